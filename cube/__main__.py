@@ -2,25 +2,32 @@
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import configparser
+import errno
 import logging
 import logging.config
 from logging import getLogger, FileHandler
 import os
 from pathlib import Path
-from pystray import Icon, Menu, MenuItem
-from PIL import Image
 import re
 import shutil
 import sys
 import subprocess
-import time
-import tkinter
-from tkinter import filedialog, messagebox
-import threading
 from threading import Thread, Event
-import yaml
 
 from constant import *
+from cube import events
+from cube import lazy
+from cube import logs
+
+with lazy.timed('tray', 'pystray, PIL') :
+  from pystray import Icon, Menu, MenuItem
+  from PIL import Image
+
+# ダイアログはログメニューのエラー表示と保存先の選択でのみ使用する
+tkinter = lazy.load('tkinter', 'dialog')
+filedialog = lazy.load('tkinter.filedialog', 'dialog')
+messagebox = lazy.load('tkinter.messagebox', 'dialog')
+simpledialog = lazy.load('tkinter.simpledialog', 'dialog')
 
 # ##############################################################################
 # ログ定義
@@ -28,6 +35,7 @@ from constant import *
 try:
   logging.config.fileConfig(LOGGING_CONFIG_FILE)
 except (configparser.MissingSectionHeaderError, KeyError):
+  import yaml
   with open(LOGGING_CONFIG_FILE) as f:
     try:
       yaml_conf = yaml.safe_load(f)
@@ -43,35 +51,32 @@ logger = getLogger(__name__)
 def get_logfile_path():
   """"""
   root_logger = logging.getLogger()
-    # ハンドラを探してファイル名を表示します
-  for handler in root_logger.handlers:
+    # ハンドラを探してファイル名を表示します (キューの書き込み先も含む)
+  for handler in logs.iter_handlers(root_logger):
     if isinstance(handler, FileHandler):
       return handler.baseFilename
 
 
 root_logger = logging.getLogger()
-logger .info(f"logger.handlers {root_logger.handlers}")
+logger .info(f"logger.handlers {root_logger.handlers} {list(logs.iter_handlers(root_logger))}")
 
 
 # ##############################################################################
 #
 # ##############################################################################
+from . import diagnostics
 from . import medcube
+from . import supervisor
+from .configs import SHUTDOWN_DEADLINE, DIAG_PORT, DIAG_PROFILE_SECONDS, DIAG_PROFILE_INTERVAL
 
-_g_stop_event = Event()
+_g_supervisor = supervisor.Supervisor(shutdown_deadline=SHUTDOWN_DEADLINE)
+_g_cube_task = None
 
 def quit(icon: Icon):
   """"""
-  if not _g_stop_event.is_set() :
-    _g_stop_event.set()
-    logger.info('app.quit()')
-
-    medcube.stop()
-    logger.info('medcube.stop()')
-
-    if icon :
-      icon.stop()
-      logger.info('quit() - icon.stop()')
+  logger.info('app.quit()')
+  # 各サブシステム (medcube, アイコン) の停止は supervisor が並行して行う
+  _g_supervisor.stop('quit')
 
 
 def show_error_messagebox(error_strings: str, title: str = "Error"):
@@ -84,6 +89,16 @@ def show_error_messagebox(error_strings: str, title: str = "Error"):
     root.destroy()  # tkinter のインスタンスを閉じる
 
 
+def show_info_messagebox(info_strings: str, title: str = "Info"):
+  """"""
+  root = tkinter.Tk()
+  try:
+    root.withdraw()  # 余分なウィンドウを非表示にする
+    messagebox.showinfo(title, info_strings)
+  finally:
+    root.destroy()  # tkinter のインスタンスを閉じる
+
+
 def icon_menu_log_display(icon: Icon = None, item=None):
   """"""
   def _display() :
@@ -112,6 +127,34 @@ def icon_menu_log_display(icon: Icon = None, item=None):
   t.start()
 
 
+def get_default_save_dir() -> Path:
+  """ ログの保存先の初期値 (デスクトップ) """
+  if os.name == 'nt':  # Windows
+    userprofile = os.getenv('USERPROFILE')
+    logger.debug(f"userprofile {userprofile}")
+    if userprofile :
+      home_dir = Path(userprofile)
+      if not home_dir.is_dir() :
+        home_dir = Path.home()
+    else :
+      home_dir = Path.home()
+  else:  # Linux and MacOS
+    home_dir = Path.home()
+
+  default_dir = home_dir / "Desktop"
+  logger.debug(
+      f"Desktop {default_dir} type:{type(default_dir)} is_dir:{default_dir.is_dir()}")
+  if not default_dir.is_dir() :
+    default_dir = home_dir / "デスクトップ"
+    logger.debug(
+        f"デスクトップ {default_dir} type:{type(default_dir)} is_dir:{default_dir.is_dir()}")
+    if not default_dir.is_dir():
+      default_dir = home_dir
+      logger.debug(
+          f"エラー {default_dir} type:{type(default_dir)} is_dir:{default_dir.is_dir()}")
+  return default_dir
+
+
 def icon_menu_log_save_as(icon: Icon = None, item=None):
   """"""
   def _save_as() :
@@ -123,29 +166,7 @@ def icon_menu_log_save_as(icon: Icon = None, item=None):
 
         base_filename = "cube"
         extension = ".log"
-        if os.name == 'nt':  # Windows
-          userprofile = os.getenv('USERPROFILE')
-          logger.debug(f"userprofile {userprofile}")
-          if userprofile :
-            home_dir = Path(userprofile)
-            if not home_dir.is_dir() :
-              home_dir = Path.home()
-          else :
-            home_dir = Path.home()
-        else:  # Linux and MacOS
-          home_dir = Path.home()
-
-        default_dir = home_dir / "Desktop"
-        logger.debug(
-            f"Desktop {default_dir} type:{type(default_dir)} is_dir:{default_dir.is_dir()}")
-        if not default_dir.is_dir() :
-          default_dir = home_dir / "デスクトップ"
-          logger.debug(
-              f"デスクトップ {default_dir} type:{type(default_dir)} is_dir:{default_dir.is_dir()}")
-          if not default_dir.is_dir():
-            default_dir = home_dir
-            logger.debug(
-                f"エラー {default_dir} type:{type(default_dir)} is_dir:{default_dir.is_dir()}")
+        default_dir = get_default_save_dir()
 
         file_full_path = default_dir / (base_filename + extension)
         logger.debug(
@@ -201,6 +222,79 @@ def icon_menu_log_save_as(icon: Icon = None, item=None):
   t = Thread(target=_save_as)
   t.start()
 
+def icon_menu_log_save_all(icon: Icon = None, item=None):
+  """ ローテートした (圧縮した) ファイルも含めて、全てのログを1つのファイルに保存する """
+  def _save_all() :
+    """"""
+    log_file = get_logfile_path()
+    if not log_file :
+      show_error_messagebox(f"ログファイルが見つかりません。")
+      return
+    try :
+      root = tkinter.Tk()
+      try:
+        root.withdraw()  # 余分なウィンドウを非表示にする
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".log", initialdir=get_default_save_dir(), initialfile="cube-all.log",
+            filetypes=[("Log files", "*.log"), ("All files", "*.*")])
+        if file_path:
+          with open(file_path, 'wb') as f :
+            for chunk in logs.read_all(log_file) :
+              f.write(chunk)
+      finally:
+        root.destroy()  # tkinter のインスタンスを閉じる
+    except :
+      logger.exception(f"save all logs")
+      show_error_messagebox(f"ログファイルの保存に失敗しました。:{log_file}")
+
+  t = Thread(target=_save_all)
+  t.start()
+
+
+def icon_menu_log_extract(icon: Icon = None, item=None):
+  """ 1回の診察 (予約ID または IDm) のログだけを索引を使って抽出して保存する """
+  def _extract() :
+    """"""
+    sessions = logs.find_sessions()
+    if not sessions :
+      show_error_messagebox(f"診察のログが見つかりません。")
+      return
+
+    latest = sessions[-1]
+    initial = latest['reservation_id'] if latest['reservation_id'] is not None else latest['idm']
+    try :
+      root = tkinter.Tk()
+      try:
+        root.withdraw()  # 余分なウィンドウを非表示にする
+        key = simpledialog.askstring(
+            "Extract Session", "予約ID または IDm を入力してください。", initialvalue=initial, parent=root)
+        if not key :
+          return
+        key = key.strip()
+        data = logs.extract(reservation_id=key)
+        if not data :
+          data = logs.extract(idm=key)
+        if not data :
+          show_error_messagebox(f"該当する診察のログがありません。:{key}")
+          return
+
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".log", initialdir=get_default_save_dir(), initialfile=f"cube-{key}.log",
+            filetypes=[("Log files", "*.log"), ("All files", "*.*")])
+        if file_path:
+          with open(file_path, 'wb') as f :
+            f.write(data)
+          logger.info(f"extract session log {key} {len(data)} bytes -> {file_path}")
+      finally:
+        root.destroy()  # tkinter のインスタンスを閉じる
+    except :
+      logger.exception(f"extract session log")
+      show_error_messagebox(f"診察のログの抽出に失敗しました。")
+
+  t = Thread(target=_extract)
+  t.start()
+
+
 def icon_menu_log_open_folder(icon: Icon = None, item=None):
   """"""
   def _open_folder() :
@@ -232,51 +326,107 @@ def icon_menu_log_open_folder(icon: Icon = None, item=None):
   t.start()
 
 
-def cube_task(loop: asyncio.AbstractEventLoop, callback) -> None:
-  """"""
-  asyncio.set_event_loop(loop)
-  while not _g_stop_event.is_set():
+def icon_menu_diagnostics_stacks(icon: Icon = None, item=None):
+  """ 全てのスレッドのスタックをログのフォルダへ出力する """
+  def _stacks() :
+    """"""
     try:
-      medcube.set_callback_on_serving(callback)
-      loop.run_until_complete(medcube.start_async())
-    except OSError as e:
-
-      import errno
-      if e.errno == (errno.EADDRNOTAVAIL, errno.WSAEADDRNOTAVAIL):
-        logger.info(
-            f"cube_task has occured OSError. Cannot assign requested address {e}")
-        time.sleep(10.0)
-        continue
-      elif e.errno in (errno.EADDRINUSE, errno.WSAEADDRINUSE):
-        logger.info(f"cube_task has occured OSError. Address already in use {e}")
-        time.sleep(10.0)
-        continue
+      path = diagnostics.write_stacks()
+      show_info_messagebox(f"スレッドのスタックを出力しました。:{path}")
+    except Exception as e:
+      logger.exception(f"diagnostics stacks")
+      show_error_messagebox(f"スレッドのスタックの出力に失敗しました。:{e}")
+
+  t = Thread(target=_stacks)
+  t.start()
+
+
+def icon_menu_diagnostics_profile(icon: Icon = None, item=None):
+  """ プロファイルを採取してログのフォルダへ出力する """
+  def _profile() :
+    """"""
+    try:
+      profiler = diagnostics.profile(DIAG_PROFILE_SECONDS, DIAG_PROFILE_INTERVAL)
+      if profiler is None:
+        show_error_messagebox(f"プロファイルは採取中です。")
       else:
-        logger.exception('cube.__main__ OSError!')
-        break
-    except:
-      logger.exception('cube.__main__ Except!')
-      break
+        show_info_messagebox(f"プロファイルを出力しました。:{profiler.path}")
+    except Exception as e:
+      logger.exception(f"diagnostics profile")
+      show_error_messagebox(f"プロファイルの採取に失敗しました。:{e}")
+
+  t = Thread(target=_profile)
+  t.start()
+
+
+def diagnostics_start():
+  """ シグナルとローカルのソケットで診断機能を呼び出せるようにする """
+  log_file = get_logfile_path()
+  diagnostics.configure(os.path.dirname(log_file) if log_file else None)
+  signals = diagnostics.install_signal_handlers(DIAG_PROFILE_SECONDS)
+  logger.info(f"diagnostics signals {signals}")
+  if DIAG_PORT:
+    try:
+      diagnostics.serve('127.0.0.1', DIAG_PORT,
+                        profile_seconds=DIAG_PROFILE_SECONDS, profile_interval=DIAG_PROFILE_INTERVAL)
+    except OSError:
+      logger.exception(f"diagnostics server is not available. port:{DIAG_PORT}")
+
+
+# 待ち受けアドレスのエラーは、ネットワークの準備ができるまで再起動する
+_RESTART_ERRNOS = tuple(
+    getattr(errno, name) for name in ('EADDRNOTAVAIL', 'WSAEADDRNOTAVAIL', 'EADDRINUSE', 'WSAEADDRINUSE')
+    if hasattr(errno, name))
+
+
+def cube_task(loop: asyncio.AbstractEventLoop, on_serving) -> None:
+  """ medcube を実行する。再起動は supervisor が行う """
+  global _g_cube_task
+  asyncio.set_event_loop(loop)
+  subscription = events.subscribe(medcube.Serving, on_serving, name='main.serving')
+  _g_cube_task = loop.create_task(medcube.start_async())
+  try:
+    loop.run_until_complete(_g_cube_task)
+  except asyncio.CancelledError:
+    if not _g_supervisor.is_stopping:
+      raise
+  finally:
+    _g_cube_task = None
+    subscription.unsubscribe()
+
+
+def cube_stop(loop: asyncio.AbstractEventLoop) -> None:
+  """"""
+  medcube.stop()
+  logger.info('medcube.stop()')
+  # 待ち受けを始める前 (起動中) は medcube.stop() が効かないため、タスクを取り消す
+  task = _g_cube_task
+  if task is not None and not medcube.is_running():
+    loop.call_soon_threadsafe(task.cancel)
+
+
+def cube_should_restart(exception) -> bool:
+  """"""
+  if exception is None:
+    # 停止の要求以外で終了した (サブシステムの生成に失敗した等)
+    return not _g_supervisor.is_stopping
+  if isinstance(exception, OSError) and exception.errno in _RESTART_ERRNOS:
+    logger.info(f"cube_task has occured OSError. Cannot use the address {exception}")
+    return True
+  return False
 
 
 def cube_start():
   """"""
   _is_serving = Event()
 
-  def callback_on_serving_cube():
+  def on_serving_cube(event):
     _is_serving.set()
 
   loop = asyncio.new_event_loop()
-  t = Thread(target=cube_task, args=(loop, callback_on_serving_cube))
-  t.start()
-  return t
-  # try :
-  #   future = executor.submit(cube_task, loop, callback_on_serving_cube)
-  #   _is_serving.wait()
-  #   return future
-  # except :
-  #   loop.close()
-  #   raise
+  return _g_supervisor.add(
+      'cube', lambda: cube_task(loop, on_serving_cube), lambda: cube_stop(loop),
+      restart=cube_should_restart)
 
 
 def icon_start():
@@ -284,50 +434,31 @@ def icon_start():
   try:
     image = Image.open(ICON_FILE)
     submenu_log = Menu(MenuItem('Display', icon_menu_log_display), MenuItem(
-        'Save As', icon_menu_log_save_as), MenuItem('Open Folder', icon_menu_log_open_folder))
-    menu = Menu(MenuItem('Log', submenu_log), MenuItem('Quit', quit))
+        'Save As', icon_menu_log_save_as), MenuItem('Save All', icon_menu_log_save_all),
+        MenuItem('Extract Session', icon_menu_log_extract),
+        MenuItem('Open Folder', icon_menu_log_open_folder))
+    submenu_diagnostics = Menu(MenuItem('Dump Threads', icon_menu_diagnostics_stacks),
+        MenuItem(f'Profile ({DIAG_PROFILE_SECONDS:g}s)', icon_menu_diagnostics_profile))
+    menu = Menu(MenuItem('Log', submenu_log), MenuItem('Diagnostics', submenu_diagnostics),
+        MenuItem('Quit', quit))
     icon = Icon("onlineMed Cube", icon=image,
                 menu=menu, title='OnlineMed Cube')
 
-    # future = executor.submit(icon.run)
-    # return future, icon
-
-    t = Thread(target=icon.run)
-    t.start()
-    return t, icon
+    # アイコンが終了したらアプリを終了する
+    _g_supervisor.add('icon', icon.run, icon.stop)
+    return icon
   except:
     logger.exception(f"icon create has occured exception.")
   return None
 
 exit_code = -1
 try:
-  cube_thread = cube_start()
-
-  try :
-    icon_thread = None
-    icon = None
-    result = icon_start()
-    if result is not None:
-      icon_thread, icon = result
-    try :
-      while not _g_stop_event.is_set() :
-        if not cube_thread.is_alive() :
-          logger.info(f"cube_thread done.")
-          break
-        if icon_thread is not None :
-          if not icon_thread.is_alive():
-            logger.info(f"icon_thread done.")
-            break
-        time.sleep(0.1)
-      logger.info(f"loop exit.")
-    finally :
-      logger.info(f"loop finally.")
-      quit(icon)
-      logger.info(f"icon quit.")
-      icon_thread.join()
-      logger.info(f"icon stop.")
-  finally :
-    cube_thread.join()
+  diagnostics_start()
+  cube_start()
+  icon_start()
+  # いずれかのサブシステムが (再起動せずに) 終了するか、quit() が呼ばれるまで戻らない
+  _g_supervisor.run()
+  logger.info(f"supervisor exit. {_g_supervisor.shutdown_report} log:{logs.stats()}")
 
   exit_code = 0
 
@@ -348,28 +479,23 @@ finally:
   logger.debug('cube.__main__.finnally')
 
   try :
-    while True:
-      is_there_not_daemon_thread = False
-      for thread in threading.enumerate():
-        if thread is threading.current_thread():
-          logger.info(f"--current:{thread}")
-        else :
-          logger.info(thread)
-          if not thread.daemon :
-            is_not_there_daemon_thread = True
-      logger.info("--")
-      if is_there_not_daemon_thread:
-        time.sleep(1.0)
-      else :
-        break
+    _g_supervisor.shutdown()
+    diagnostics.shutdown()
+    # 期限までに終了しないスレッドがあれば、待たずに終了する
+    if _g_supervisor.wait_threads() :
+      # 終了しないスレッドを調べられるよう、スタックを残しておく
+      try :
+        diagnostics.write_stacks()
+      except Exception :
+        logger.exception('diagnostics stacks')
+      logging.shutdown()
+      os._exit(exit_code)
   except KeyboardInterrupt:
     if os.name == 'posix':
       print()
     else:
       print('^C')
   finally :
-    pass
     logger.debug('cube.__main__ final')
-    # quit(_g_icon)
 
 sys.exit(exit_code)
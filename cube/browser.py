@@ -1,24 +1,116 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from selenium import webdriver
 from selenium.webdriver.edge.service import Service as EdgeService
 from selenium.webdriver.edge.options import Options as EdgeOptions
 from selenium.webdriver.firefox import service as fs
 from selenium.webdriver.chrome import service as cs
+from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchElementException, WebDriverException
 
 
 from logging import getLogger
 import os
 from pathlib import PurePath, Path
+import shutil
+import tempfile
+from threading import Condition, Lock, Thread
 import time
+from urllib.parse import urlsplit
+
+from cube import leaks
+from cube import metrics
+import utils
 
 logger = getLogger(__name__)
 
 _URL = "https://patient.cubemed.hosoya.onlinemed.biz/index.html?reservation_id=0"
 
+BLANK_PAGE = Path.cwd() / 'html' / 'blank.html'
+
+# Performance Timing API から navigationStart からの経過時間(ms)を取得する
+_PERFORMANCE_TIMING_SCRIPT = """
+var t = window.performance.timing;
+return [t.navigationStart, t.domContentLoadedEventEnd, t.loadEventEnd];
+"""
+
+
+class _Timing(object):
+  """ 計測値の集計 """
+
+  __slots__ = ('count', 'last', 'total', 'max')
+
+  def __init__(self):
+    self.count = 0
+    self.last = 0.0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, value: float):
+    self.count += 1
+    self.last = value
+    self.total += value
+    if self.max < value:
+      self.max = value
+
+  def to_dict(self) -> dict:
+    return {
+      'count' : self.count,
+      'last' : self.last,
+      'avg' : self.total / self.count if self.count else 0.0,
+      'max' : self.max,
+    }
+
+
+class PageLoadStats(object):
+  """ ブラウザの起動時間とサイトごとのページ読み込み時間(秒) """
+
+  def __init__(self):
+    self._lock = Lock()
+    self._spawn = _Timing()
+    self._sites = {}
+    self._health = {'probe' : 0, 'hung' : 0, 'dead' : 0, 'restart' : 0}
+
+  def record_spawn(self, seconds: float):
+    with self._lock:
+      self._spawn.add(seconds)
+    logger.info(f"webdriver spawn {seconds:0.3f}")
+
+  def record_navigation(self, url: str, navigation: float, dom_content_loaded: float | None, load: float | None):
+    site = urlsplit(url).netloc or urlsplit(url).scheme
+    with self._lock:
+      timings = self._sites.get(site)
+      if timings is None:
+        timings = self._sites[site] = {
+          'navigation' : _Timing(), 'dom_content_loaded' : _Timing(), 'load' : _Timing()}
+      timings['navigation'].add(navigation)
+      if dom_content_loaded is not None:
+        timings['dom_content_loaded'].add(dom_content_loaded)
+      if load is not None:
+        timings['load'].add(load)
+    logger.info(
+        f"page load {site} navigation {navigation:0.3f} domcontentloaded {dom_content_loaded} load {load}")
+
+  def record_health(self, key: str):
+    with self._lock:
+      self._health[key] += 1
+
+  def to_dict(self) -> dict:
+    with self._lock:
+      return {
+        'spawn' : self._spawn.to_dict(),
+        'sites' : {site : {name : timing.to_dict() for name, timing in timings.items()}
+                    for site, timings in self._sites.items()},
+        'health' : dict(self._health),
+      }
+
+
+page_load_stats = PageLoadStats()
+metrics.collector('browser', page_load_stats.to_dict)
+
 class Webbrowser(metaclass=ABCMeta):
   """docstring for Webblowser."""
 
@@ -39,6 +131,7 @@ class Webbrowser(metaclass=ABCMeta):
 
       self._kiosk = bool(kiosk)
       self._safe_mode = bool(safe_mode)
+      leaks.track(self)
 
   def __enter__(self):
       return self.open()
@@ -57,7 +150,20 @@ class Webbrowser(metaclass=ABCMeta):
       return self
 
   def get(self, url):
+    t = time.time()
     self._driver.get(url)
+    navigation = time.time() - t
+    dom_content_loaded = load = None
+    try:
+      start, dcl_end, load_end = self._driver.execute_script(_PERFORMANCE_TIMING_SCRIPT)
+      if start:
+        if dcl_end:
+          dom_content_loaded = (dcl_end - start) / 1000.0
+        if load_end:
+          load = (load_end - start) / 1000.0
+    except (WebDriverException, TypeError, ValueError):
+      pass
+    page_load_stats.record_navigation(url, navigation, dom_content_loaded, load)
 
   def close(self):
     if self._driver is not None:
@@ -68,16 +174,67 @@ class Webbrowser(metaclass=ABCMeta):
       if self._proc:
         self._proc.close()
 
+  def is_alive(self) -> bool:
+    """ WebDriverのセッションが応答するかを確認する。
+    """
+    if self._driver is None:
+      return False
+    try:
+      self._driver.current_url
+      return True
+    except WebDriverException:
+      return False
+
+  def hide(self):
+    """ ウィンドウを最小化して、裏でページを読み込めるようにする。
+    """
+    try:
+      self._driver.minimize_window()
+    except WebDriverException:
+      logger.debug("webbrowser minimize window failed.")
+
+  def show(self):
+    """ hide()で隠したウィンドウを表示する。
+    """
+    try:
+      if self._kiosk:
+        self._driver.fullscreen_window()
+      else:
+        self._driver.maximize_window()
+    except WebDriverException:
+      logger.debug("webbrowser show window failed.")
+
+  def reset(self, url=None):
+    """ ブラウザを終了せずに、セッションの状態を初期化する。
+
+    余分なタブを閉じ、cookie, localStorage, sessionStorage を削除して
+    url(未指定時は起動時のURL)へ移動する。
+    """
+    handles = self._driver.window_handles
+    for handle in handles[1:]:
+      self._driver.switch_to.window(handle)
+      self._driver.close()
+    self._driver.switch_to.window(handles[0])
+
+    # cookieとstorageは表示中のページのドメインに対して削除される
+    self._driver.delete_all_cookies()
+    try:
+      self._driver.execute_script(
+          "window.localStorage.clear(); window.sessionStorage.clear();")
+    except WebDriverException:
+      # file:// や about:blank ではstorageにアクセスできない
+      pass
+
+    self.get(url if url else self._url)
+
   def is_inpage(self) -> bool:
+    if self._driver is None:
+      return False
     try:
-      if hasattr(self._driver, 'find_element_by_tag_name'):
-        try:
-          html_tag = self._driver.find_element_by_tag_name('html')
-          return True
-        except NoSuchElementException as e:
-          pass
-    except:
-        raise
+      self._driver.find_element(By.TAG_NAME, 'html')
+      return True
+    except NoSuchElementException:
+      pass
     return False
 
 
@@ -115,9 +272,11 @@ class Chromebrowser(Webbrowser):
     # chrome_service = cs.Service(
     #     executable_path="/usr/lib/chromium-browser/chromedriver")
     chrome_service = cs.Service(executable_path=str(executable_path))
+    t = time.time()
     self._driver = webdriver.Chrome(
         service=chrome_service, 
         options=self._options)
+    page_load_stats.record_spawn(time.time() - t)
     self.get(self._url)
 
     return self
@@ -126,9 +285,14 @@ class Chromebrowser(Webbrowser):
 class Firefoxbrowser(Webbrowser):
   """docstring for Firefoxbrowser."""
 
-  def __init__(self, url=None, *, kiosk=True, safe_mode=False, profile: str | None = None, executable_path: str | None = None, log_path: str | None = None):
+  def __init__(self, url=None, *, kiosk=True, safe_mode=False, profile: str | None = None, executable_path: str | None = None, log_path: str | None = None, copy_profile=False):
       super().__init__(url, kiosk, safe_mode)
 
+      # copy_profile が True の場合は、プロファイルを一時ディレクトリへ複製して使う
+      # (同じプロファイルを複数のFirefoxで同時に使用できないため)
+      self._copy_profile = bool(copy_profile)
+      self._profile_copy = None
+
       if os.name == 'nt':
         if profile :
           path = Path(profile)
@@ -159,6 +323,15 @@ class Firefoxbrowser(Webbrowser):
         self._log_path = r'geckodriver\geckodriver.log'
       elif os.name == 'posix':
         self._profile = Path.home() / '.mozilla/firefox/7cam16m1.default-esr'
+        if profile :
+          path = Path(profile)
+          if not path.is_absolute() :
+            path = Firefoxbrowser.profile_root() / profile
+          if path.is_dir() :
+            self._profile = path
+          else :
+            logger.warning(f"profile {path} is not found. use {self._profile}")
+        logger.info(f"profile:{self._profile}")
         self._executable_path = '/usr/local/bin/geckodriver'
         self._log_path = '/tmp/geckodriver.log'
       else:
@@ -196,12 +369,22 @@ class Firefoxbrowser(Webbrowser):
         options.add_argument('--kiosk')
       if self._safe_mode:
         options.add_argument('-safe-mode')
-      if self._profile :
-        if isinstance(self._profile, PurePath) :
+      profile = self._profile
+      if self._copy_profile and profile :
+        if isinstance(profile, PurePath) :
+          self._profile_copy = tempfile.mkdtemp(prefix='firefox-profile-')
+          shutil.copytree(
+              profile, self._profile_copy, dirs_exist_ok=True,
+              ignore=shutil.ignore_patterns('lock', '.parentlock', 'parent.lock'))
+          profile = Path(self._profile_copy)
+        else :
+          logger.warning(f"profile {profile} is not a directory. can not copy it.")
+      if profile :
+        if isinstance(profile, PurePath) :
           options.add_argument('-profile')
         else :
           options.add_argument('-P')
-        options.add_argument(str(self._profile))
+        options.add_argument(str(profile))
 
       options.set_preference("browser.cache.disk.enable", False)
 
@@ -214,12 +397,22 @@ class Firefoxbrowser(Webbrowser):
 
       service = fs.Service(
           executable_path=str(self._executable_path), log_path=self._log_path)
+      t = time.time()
       self._driver = webdriver.Firefox(
           service=service, options=options)
-      # self.get(self._url)
+      page_load_stats.record_spawn(time.time() - t)
+      self.get(self._url)
 
       return self
 
+  def close(self):
+    try:
+      super().close()
+    finally:
+      if self._profile_copy:
+        shutil.rmtree(self._profile_copy, ignore_errors=True)
+        self._profile_copy = None
+
 
 class Edgebrowser(Webbrowser):
   """docstring for Edgebrowser."""
@@ -249,12 +442,313 @@ class Edgebrowser(Webbrowser):
       logger.info(options.arguments)
       driverpath = r'D:\Users\sizum\OneDrive\Developments\projects\OnlineMed\TCU\rpi\home\pi\Tcu\cube\edgedriver\x64\msedgedriver.exe'
       service = EdgeService(executable_path=driverpath)
+      t = time.time()
       self._driver = webdriver.Edge(service=service, options=options)
+      page_load_stats.record_spawn(time.time() - t)
       self.get(self._url)
 
       return self
 
 
+def _call_in_thread(name, function, *args) -> Future:
+  """ function(*args) を daemon スレッドで実行する。
+
+  ハングした WebDriver の呼び出しは戻らないことがあるため、Executor の
+  ワーカーを占有しないよう呼び出しごとにスレッドを起動する。
+  """
+  future = Future()
+
+  def run():
+    if not future.set_running_or_notify_cancel():
+      return
+    try:
+      future.set_result(function(*args))
+    except BaseException as e:
+      future.set_exception(e)
+
+  Thread(target=run, name=name, daemon=True).start()
+  return future
+
+
+class BrowserPool(object):
+  """ 起動済みのブラウザを待機させておくプール
+
+  ブラウザは BLANK_PAGE を表示した状態で待機し、acquire()で指定のURLへ移動する。
+  release()ではブラウザを終了せずに状態を初期化して待機状態へ戻す。
+  応答しなくなったブラウザは破棄し、バックグラウンドで代わりを起動する。
+
+  同じプロファイルを複数のFirefoxで同時に使用できないため、
+  size を2以上にする場合はブラウザごとにプロファイルの複製を使う。
+
+  health_interval 秒ごとにブラウザへ問い合わせを行い、probe_timeout 秒以内に
+  応答しない(ハングした)または終了しているブラウザを再起動する。
+  使用中のブラウザは異常として記録し、release()で操作せずに破棄する。
+  """
+
+  def __init__(self, size=1, *, kiosk=True, profile=None, health_interval: float = 30.0, probe_timeout: float = 10.0):
+    super().__init__()
+
+    self._size = size
+    self._kiosk = kiosk
+    self._profile = profile
+    self._url = BLANK_PAGE.as_uri()
+
+    self._condition = Condition()
+    self._idle = []
+    self._in_use = []
+    self._spawning = 0
+    # 終了処理中のブラウザの数 (終了するまで代わりを起動しない)
+    self._quitting = 0
+    self._closed = False
+
+    self._executor = ThreadPoolExecutor(
+        max_workers=max(1, size), thread_name_prefix="BrowserPool")
+
+    self._health_interval = health_interval
+    self._probe_timeout = probe_timeout
+    # ブラウザごとの最後の問い合わせ (Future) と、異常が見つかった使用中のブラウザ
+    self._probes = {}
+    self._unhealthy = set()
+    self._health_thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exception_type, exception_value, traceback):
+    self.close()
+
+  def start(self):
+    """ 不足している数のブラウザをバックグラウンドで起動する。
+    """
+    with self._condition:
+      shortage = self._size - (len(self._idle) + len(self._in_use) + self._spawning + self._quitting)
+      for _ in range(shortage):
+        self._spawn()
+
+      if self._health_interval and self._health_thread is None and not self._closed:
+        self._health_thread = _HealthProbe(self, self._health_interval)
+        self._health_thread.start()
+
+  def wait_ready(self, timeout: float | None = None) -> bool:
+    """ 待機中のブラウザが1つ以上になるのを待つ。
+    """
+    with self._condition:
+      return self._condition.wait_for(lambda: self._idle or self._in_use or self._closed, timeout) \
+          and not self._closed
+
+  def probe(self):
+    """ 全てのブラウザの状態を確認し、異常なブラウザを再起動する。
+    使用中のブラウザは診察中のため再起動せず、異常として記録して返却時に破棄する。
+    前回の問い合わせがまだ戻らないブラウザは、問い合わせを重ねずにハングとみなす。
+    """
+    with self._condition:
+      browsers = self._idle + self._in_use
+
+    for wb in browsers:
+      with self._condition:
+        future = self._probes.get(wb)
+        pending = future is not None and not future.done()
+        if not pending:
+          future = self._probes[wb] = _call_in_thread("BrowserPoolProbe", wb.is_alive)
+      if pending:
+        page_load_stats.record_health('hung')
+        logger.warning(f"browser pool probe: previous probe is still running. {wb}")
+      else:
+        page_load_stats.record_health('probe')
+        try:
+          if future.result(self._probe_timeout):
+            continue
+          page_load_stats.record_health('dead')
+          logger.warning(f"browser pool probe: browser is dead. {wb}")
+        except FutureTimeoutError:
+          page_load_stats.record_health('hung')
+          logger.warning(f"browser pool probe: browser does not respond. {wb}")
+
+      with self._condition:
+        idle = wb in self._idle
+        if not idle and wb in self._in_use:
+          self._unhealthy.add(wb)
+      if idle:
+        page_load_stats.record_health('restart')
+        self.discard(wb)
+
+  def _spawn(self):
+    # self._condition を取得した状態で呼び出すこと
+    if self._closed:
+      return
+    self._spawning += 1
+    self._executor.submit(self._spawn_task)
+
+  def _create(self) -> Webbrowser:
+    if os.name == 'nt' or os.name == 'posix':
+      wb = Firefoxbrowser(self._url, kiosk=self._kiosk, profile=self._profile, copy_profile=self._size > 1)
+    else:
+      wb = Chromebrowser(self._url, kiosk=self._kiosk, profile=self._profile)
+    wb.open()
+    return wb
+
+  def _spawn_task(self):
+    wb = None
+    try:
+      t = time.time()
+      wb = self._create()
+      logger.info(f"browser pool spawned at {time.time()-t:0.3f}")
+    except Exception:
+      logger.exception("browser pool spawn failed.")
+    finally:
+      with self._condition:
+        self._spawning -= 1
+        if wb is not None:
+          if self._closed:
+            self._quit(wb)
+          else:
+            self._idle.append(wb)
+        self._condition.notify_all()
+
+  def acquire(self, url=None, timeout: float | None = None, *, hidden=False) -> Webbrowser | None:
+    """ 待機中のブラウザを取り出して url へ移動する。
+    timeout以内に取得できなければNoneを返す。
+    hidden が True の場合はウィンドウを隠した状態で読み込む。(show()で表示する)
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      with self._condition:
+        while not self._idle:
+          if self._closed:
+            return None
+          if self._spawning == 0 and self._quitting == 0:
+            self._spawn()
+          remaining = None if deadline is None else deadline - time.time()
+          if remaining is not None and remaining <= 0.0:
+            return None
+          self._condition.wait(remaining)
+        wb = self._idle.pop()
+        self._in_use.append(wb)
+
+      if not wb.is_alive():
+        logger.info("browser pool discard dead browser.")
+        self.discard(wb)
+        continue
+
+      if url:
+        try:
+          if hidden:
+            wb.hide()
+          wb.get(url)
+        except WebDriverException:
+          logger.exception(f"browser pool navigation failed. {url}")
+          self.discard(wb)
+          continue
+      return wb
+
+  def release(self, wb: Webbrowser):
+    """ 状態を初期化してブラウザを待機状態へ戻す。
+    probe()で異常が見つかったブラウザは、操作せずに破棄する。
+    初期化が probe_timeout 秒以内に終わらない場合も破棄する。
+    """
+    with self._condition:
+      unhealthy = wb in self._unhealthy
+    if unhealthy:
+      logger.warning(f"browser pool discard unhealthy browser. {wb}")
+      page_load_stats.record_health('restart')
+      self.discard(wb)
+      return
+
+    future = _call_in_thread("BrowserPoolReset", self._reset, wb)
+    try:
+      future.result(self._probe_timeout)
+    except FutureTimeoutError:
+      logger.warning(f"browser pool reset does not respond. {wb}")
+      page_load_stats.record_health('hung')
+      self.discard(wb)
+      return
+    except Exception:
+      logger.exception("browser pool reset failed.")
+      self.discard(wb)
+      return
+
+    with self._condition:
+      if wb in self._in_use:
+        self._in_use.remove(wb)
+      if self._closed:
+        self._quit(wb)
+      else:
+        self._idle.append(wb)
+      self._condition.notify_all()
+
+  def _reset(self, wb: Webbrowser):
+    wb.reset(self._url)
+    wb.show()
+
+  def discard(self, wb: Webbrowser):
+    """ ブラウザを終了し、代わりのブラウザをバックグラウンドで起動する。
+    終了処理もハングする可能性があるため、別のスレッドで行う。
+    代わりのブラウザは、終了するか probe_timeout 秒を過ぎてから起動する。
+    (終了前に起動すると、同じプロファイルを使うFirefoxが起動できないため)
+    """
+    with self._condition:
+      if wb in self._in_use:
+        self._in_use.remove(wb)
+      if wb in self._idle:
+        self._idle.remove(wb)
+      self._unhealthy.discard(wb)
+      self._probes.pop(wb, None)
+      self._quitting += 1
+    _call_in_thread("BrowserPoolDiscard", self._quit_and_respawn, wb)
+
+  def _quit_and_respawn(self, wb: Webbrowser):
+    future = _call_in_thread("BrowserPoolQuit", self._quit, wb)
+    try:
+      future.result(self._probe_timeout)
+    except FutureTimeoutError:
+      logger.warning(f"browser pool close does not respond. {wb}")
+    finally:
+      with self._condition:
+        self._quitting -= 1
+    self.start()
+
+  def _quit(self, wb: Webbrowser):
+    try:
+      wb.close()
+    except Exception:
+      logger.exception("browser pool close failed.")
+
+  def close(self):
+    """ 全てのブラウザを終了する。
+    """
+    with self._condition:
+      self._closed = True
+      browsers = self._idle + self._in_use
+      self._idle = []
+      self._in_use = []
+      self._unhealthy.clear()
+      self._probes.clear()
+      self._condition.notify_all()
+    if self._health_thread is not None:
+      self._health_thread.stop()
+    for wb in browsers:
+      self._quit(wb)
+    self._executor.shutdown(wait=False)
+
+
+class _HealthProbe(utils.BaseThread):
+  """ BrowserPoolの状態を定期的に確認するスレッド """
+
+  def __init__(self, pool: BrowserPool, interval: float):
+    super().__init__(daemon=True)
+    self.name = "BrowserPoolHealth"
+    self._pool = pool
+    self._interval = interval
+
+  def run(self) -> None:
+    while self.should_keep_running(self._interval):
+      try:
+        self._pool.probe()
+      except Exception:
+        logger.exception("browser pool probe failed.")
+
+
 def open(url=None, *, kiosk=True, profile=None):
   try :
     wb = None
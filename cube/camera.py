@@ -4,12 +4,16 @@ import asyncio
 import imghdr
 import json
 import os
-import time
 from typing import Any
 from logging import getLogger
 
+from cube import clocks
+from cube import metrics
+
 logger = getLogger(__name__)
 
+CAPTURE_SECONDS = metrics.histogram('cube_camera_capture_seconds', 'camera shoot and image load time', ('result',))
+
 PICAMERA = 0
 USBCAMERA = 1
 
@@ -60,8 +64,11 @@ async def shoot_async(address, port, device
                     , resoW = __default_resoW
                     , resoH = __default_resoH
                     , timeout = __default_timeout
+                    , clock: clocks.Clock | None = None
                     ) :
 
+  clock = clock or clocks.get()
+  started = clock.monotonic()
   if path :
     pathlist = os.path.split(path)
     logger.debug(f"shoot_async {pathlist} = os.path.split({path}) ")
@@ -93,12 +100,12 @@ async def shoot_async(address, port, device
     message = json.dumps({"camera":camera})
     logger.info(f"camera Send {address}:{port} {message}")
 
-    conn_etime = time.time() + CONNECT_WAIT
+    conn_etime = clock.monotonic() + CONNECT_WAIT
     conn_sleeptime = 0
     conn_try = 0
     while True:
       try:
-        sttime = time.time()
+        sttime = clock.monotonic()
         # reader, writer = await asyncio.wait_for(
         #                   asyncio.open_connection(address, port)
         #                   , timeout=1.0)
@@ -109,10 +116,10 @@ async def shoot_async(address, port, device
           await asyncio.wait_for(reader.read(), timeout)
         else :
           await reader.read()
-        logger.info(f"image shoot time {time.time()-sttime:0.3f}.")
+        logger.info(f"image shoot time {clock.monotonic()-sttime:0.3f}.")
 
         logger.info(f"read timeout {timeout}.")
-        tm = time.time()
+        tm = clock.monotonic()
         if not timeout :
           tout = tm + 0.5
         else :
@@ -122,23 +129,25 @@ async def shoot_async(address, port, device
         while True :
           image = load_image(path)
           if image:
+            CAPTURE_SECONDS.labels('ok').observe(clock.monotonic() - started)
             return image
-          if time.time() < tout :
+          if clock.monotonic() < tout :
             break
-          await asyncio.sleep(0.1)
+          await clock.sleep_async(0.1)
       except (OSError, ConnectionRefusedError):
         conn_try += 1
         conn_sleeptime += RETRY_WAIT_UNIT * conn_try
-        if conn_etime <= time.time() + conn_sleeptime:
+        if conn_etime <= clock.monotonic() + conn_sleeptime:
           logger.exception("camera.shoot_async(). connect timeout.")
           break
-        asyncio.sleep(conn_sleeptime)
+        await clock.sleep_async(conn_sleeptime)
       except asyncio.TimeoutError:
         logger.exception(f"camera.shoot_async().timeout:{timeout}")
         break
   else :
     logger.info(f"free failed {path}")
 
+  CAPTURE_SECONDS.labels('failed').observe(clock.monotonic() - started)
   return b''
 
 def shoot(address
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 from logging import getLogger
-
-# import asyncio
+import re
 import subprocess
+import threading
 import time
 
+from cube import resilience
+
 CEC_LOG_ERROR   = 1
 CEC_LOG_WARNING = 2
 CEC_LOG_NOTICE  = 4
@@ -15,6 +18,14 @@ CEC_LOG_ALL     = 31
 
 logger = getLogger(__name__)
 
+# cec-client -s の1回の実行 (CECアダプタの初期化を含む) を待つ時間
+CEC_CLIENT_TIMEOUT = 15.0
+# 常駐させた cec-client へのコマンドの応答を待つ時間
+CEC_COMMAND_TIMEOUT = 5.0
+
+# cec-client の実行が続けて失敗した場合は、しばらく実行せずに失敗させる
+_CEC_CLIENT_BREAKER = resilience.breaker('cec-client', timeout=CEC_CLIENT_TIMEOUT)
+
 def _cec_client_sync(command, address=0, loglevel=CEC_LOG_ERROR) :
 
   stdin = f'{command} {address}'.encode('utf-8')
@@ -25,7 +36,13 @@ def _cec_client_sync(command, address=0, loglevel=CEC_LOG_ERROR) :
         , stdout=subprocess.PIPE
           ) as pcecclient :
 
-    communicate = pcecclient.communicate(stdin)[0].decode('utf-8')
+    try :
+      stdout = pcecclient.communicate(stdin, timeout=resilience.remaining(CEC_CLIENT_TIMEOUT))[0]
+    except subprocess.TimeoutExpired :
+      pcecclient.kill()
+      pcecclient.communicate()
+      raise resilience.DeadlineExceeded(f'cec-client {command} did not finish.') from None
+    communicate = stdout.decode('utf-8')
     logger.debug(f'---\n{communicate}')
     logger.debug('---')
     return communicate
@@ -46,11 +63,302 @@ def _cec_client_sync(command, address=0, loglevel=CEC_LOG_ERROR) :
 #   logger.debug('---')
 #   return communicate
 
+# CEC opcode
+_CEC_OPCODE_STANDBY = 0x36
+_CEC_OPCODE_IMAGE_VIEW_ON = 0x04
+_CEC_OPCODE_TEXT_VIEW_ON = 0x0d
+_CEC_OPCODE_REPORT_POWER_STATUS = 0x90
+
+# Report Power Status のオペランド
+_CEC_POWER_STATUS = {
+  0x00 : 'on',
+  0x01 : 'standby',
+  0x02 : 'in transition standby to on',
+  0x03 : 'in transition on to standby',
+}
+
+_TRAFFIC_PATTERN = re.compile(r'>>\s+([0-9a-fA-F]{2}(?::[0-9a-fA-F]{2})*)')
+
+
+class Session(object) :
+  """ 常駐させた cec-client に標準入出力でコマンドを送るセッション
+
+  cec-client の起動(CECアダプタの初期化)は1回のみ行い、出力は専用の
+  イベントループで非同期に解析する。CECのトラフィックからTVの電源状態を
+  キャッシュするため、power_status() は問い合わせずに応答できる。
+  """
+
+  @property
+  def power(self) -> str | None :
+    """ キャッシュしているTVの電源状態 ('on', 'standby', ...) """
+    return self._power
+
+  def __init__(self, *, loglevel=CEC_LOG_TRAFFIC, cache_ttl: float = 30.0) :
+    super().__init__()
+    self._loglevel = loglevel
+    self._cache_ttl = cache_ttl
+
+    self._power = None
+    self._power_time = 0.0
+
+    self._loop = None
+    self._thread = None
+    self._proc = None
+    self._reader_task = None
+    self._ready = threading.Event()
+    self._lock = threading.Lock()
+    self._waiters = []
+
+  def __enter__(self) :
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb) :
+    self.stop()
+
+  # ##########################################################################
+  # 起動, 停止
+  # ##########################################################################
+  def start(self, timeout: float | None = 30.0) -> bool :
+    """ cec-client を起動して、初期化が完了するまで待つ。 """
+    with self._lock :
+      if self._thread is None or not self._thread.is_alive() :
+        self._ready.clear()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run_loop, args=(self._loop,), name="cecclient", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._spawn(), self._loop)
+    return self._ready.wait(timeout)
+
+  def stop(self) :
+    with self._lock :
+      loop = self._loop
+      thread = self._thread
+      self._loop = None
+      self._thread = None
+    if loop is None :
+      return
+    future = asyncio.run_coroutine_threadsafe(self._terminate(), loop)
+    try :
+      future.result(5.0)
+    except Exception :
+      logger.exception('cec-client terminate failed.')
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5.0)
+
+  def is_alive(self) -> bool :
+    return self._proc is not None and self._proc.returncode is None
+
+  def _run_loop(self, loop) :
+    asyncio.set_event_loop(loop)
+    try :
+      loop.run_forever()
+    finally :
+      loop.close()
+
+  async def _spawn(self) :
+    try :
+      self._proc = await asyncio.create_subprocess_exec(
+          'cec-client', '-d', f'{self._loglevel}'
+          , stdin=asyncio.subprocess.PIPE
+          , stdout=asyncio.subprocess.PIPE
+          , stderr=asyncio.subprocess.DEVNULL)
+      self._reader_task = asyncio.ensure_future(self._read_output())
+      # 初期化完了を確認するため、電源状態を問い合わせる
+      await self._command('pow 0', 'power status:', 30.0)
+    except Exception :
+      logger.exception('cec-client spawn failed.')
+    finally :
+      self._ready.set()
+
+  async def _terminate(self) :
+    proc = self._proc
+    if proc is None or proc.returncode is not None :
+      return
+    try :
+      proc.stdin.write(b'q\n')
+      await proc.stdin.drain()
+      await asyncio.wait_for(proc.wait(), 3.0)
+    except (asyncio.TimeoutError, OSError) :
+      proc.kill()
+      await proc.wait()
+    if self._reader_task :
+      self._reader_task.cancel()
+
+  # ##########################################################################
+  # 出力の解析
+  # ##########################################################################
+  async def _read_output(self) :
+    while True :
+      line = await self._proc.stdout.readline()
+      if not line :
+        logger.warning('cec-client exited.')
+        self._set_power(None)
+        for prefix, future in self._waiters :
+          if not future.done() :
+            future.set_exception(ConnectionError('cec-client exited.'))
+        self._waiters = []
+        return
+      self._parse(line.decode('utf-8', errors='replace').strip())
+
+  def _parse(self, line: str) :
+    if not line :
+      return
+    logger.debug(line)
+
+    if line.startswith('power status:') :
+      self._set_power(line.split(':', 1)[1].strip())
+    else :
+      match = _TRAFFIC_PATTERN.search(line)
+      if match :
+        self._parse_traffic([int(b, 16) for b in match.group(1).split(':')])
+
+    for waiter in list(self._waiters) :
+      prefix, future = waiter
+      if line.startswith(prefix) :
+        self._waiters.remove(waiter)
+        if not future.done() :
+          future.set_result(line)
+
+  def _parse_traffic(self, frame: list) :
+    """ CECのフレームからTVの電源状態を更新する。 """
+    if len(frame) < 2 :
+      return
+    initiator = frame[0] >> 4
+    destination = frame[0] & 0x0f
+    opcode = frame[1]
+    if opcode == _CEC_OPCODE_REPORT_POWER_STATUS and initiator == 0 and 3 <= len(frame) :
+      self._set_power(_CEC_POWER_STATUS.get(frame[2]))
+    elif opcode == _CEC_OPCODE_STANDBY and destination in (0, 0x0f) :
+      self._set_power('standby')
+    elif opcode in (_CEC_OPCODE_IMAGE_VIEW_ON, _CEC_OPCODE_TEXT_VIEW_ON) and destination == 0 :
+      self._set_power('in transition standby to on')
+
+  def _set_power(self, power: str | None) :
+    if self._power != power :
+      logger.info(f'cec tv power status:{power}')
+    self._power = power
+    self._power_time = time.monotonic()
+
+  # ##########################################################################
+  # コマンド
+  # ##########################################################################
+  async def _command(self, command: str, expect: str | None = None, timeout: float | None = 5.0) -> str | None :
+    """ コマンドを送信する。expect を指定した場合は、その文字列で始まる行を待つ。 """
+    if not self.is_alive() :
+      raise ConnectionError('cec-client is not running.')
+    future = None
+    if expect :
+      future = asyncio.get_running_loop().create_future()
+      self._waiters.append((expect, future))
+    logger.debug(f'cec-client << {command}')
+    self._proc.stdin.write(f'{command}\n'.encode('utf-8'))
+    await self._proc.stdin.drain()
+    if future is None :
+      return None
+    try :
+      return await asyncio.wait_for(future, timeout)
+    finally :
+      if (expect, future) in self._waiters :
+        self._waiters.remove((expect, future))
+
+  async def power_status_async(self, address=0, timeout: float | None = 5.0, *, use_cache=True) -> bool :
+    if use_cache and self._power is not None :
+      if time.monotonic() - self._power_time < self._cache_ttl :
+        return self._power == 'on'
+    await self._command(f'pow {address}', 'power status:', timeout)
+    return self._power == 'on'
+
+  async def on_async(self, address=0, timeout: float | None = 5.0) -> bool :
+    await asyncio.wait_for(self._command(f'on {address}'), timeout)
+    # 電源状態が変わるため、次回は問い合わせる
+    self._power_time = 0.0
+    return True
+
+  async def standby_async(self, address=0, timeout: float | None = 5.0) -> bool :
+    await asyncio.wait_for(self._command(f'standby {address}'), timeout)
+    # 電源状態が変わるため、次回は問い合わせる
+    self._power_time = 0.0
+    return True
+
+  async def active_async(self, timeout: float | None = 5.0) -> bool :
+    await asyncio.wait_for(self._command('as'), timeout)
+    return True
+
+  def _run(self, coro, timeout: float | None) :
+    """ 別スレッドからセッションのイベントループでコルーチンを実行する。 """
+    if self._loop is None :
+      coro.close()
+      raise ConnectionError('cec-client session is not started.')
+    future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+    return future.result(None if timeout is None else timeout + 1.0)
+
+  def power_status(self, address=0, timeout: float | None = 5.0) -> bool :
+    return self._run(self.power_status_async(address, timeout), timeout)
+
+  def on(self, address=0, timeout: float | None = 5.0) -> bool :
+    return self._run(self.on_async(address, timeout), timeout)
+
+  def standby(self, address=0, timeout: float | None = 5.0) -> bool :
+    return self._run(self.standby_async(address, timeout), timeout)
+
+  def active(self, timeout: float | None = 5.0) -> bool :
+    return self._run(self.active_async(timeout), timeout)
+
+
+_g_session = None
+_g_session_lock = threading.Lock()
+_g_session_retry_time = 0.0
+
+# cec-client を起動できなかった場合に、再度起動を試みるまでの時間
+SESSION_RETRY_INTERVAL = 60.0
+
+
+def get_session() -> Session | None :
+  """ 常駐させた cec-client のセッションを取得する。起動できなければNone """
+  global _g_session
+  global _g_session_retry_time
+  with _g_session_lock :
+    if _g_session is None or not _g_session.is_alive() :
+      if _g_session is not None :
+        _g_session.stop()
+        _g_session = None
+      if time.monotonic() < _g_session_retry_time :
+        return None
+      session = Session()
+      try :
+        session.start()
+      except Exception :
+        logger.exception('cec-client session start failed.')
+      if not session.is_alive() :
+        session.stop()
+        _g_session_retry_time = time.monotonic() + SESSION_RETRY_INTERVAL
+        return None
+      _g_session = session
+    return _g_session
+
+
+def close_session() :
+  global _g_session
+  with _g_session_lock :
+    if _g_session is not None :
+      _g_session.stop()
+      _g_session = None
+
+
 def _cec_client(command, address=0, loglevel=CEC_LOG_ERROR) :
   # return await _cec_client_async(command, address, loglevel)
-  return _cec_client_sync(command, address, loglevel)
+  return _CEC_CLIENT_BREAKER.call(_cec_client_sync, command, address, loglevel)
 
 def power_status( address=0, loglevel=CEC_LOG_ERROR) :
+  session = get_session()
+  if session is not None :
+    try :
+      return session.power_status(address, timeout=resilience.remaining(CEC_COMMAND_TIMEOUT))
+    except Exception :
+      logger.exception('cec-client session power_status failed.')
+
   communicate = _cec_client('pow', address)
   for line in communicate.split('\n') :
     logger.debug(line)
@@ -62,6 +370,13 @@ def power_status( address=0, loglevel=CEC_LOG_ERROR) :
   return False
 
 def active( address=0, loglevel=CEC_LOG_ERROR) :
+  session = get_session()
+  if session is not None :
+    try :
+      return session.active(timeout=resilience.remaining(CEC_COMMAND_TIMEOUT))
+    except Exception :
+      logger.exception('cec-client session active failed.')
+
   communicate = _cec_client('as', address)
   # for line in communicate.split('\n') :
   #   logger.debug(line)
@@ -73,6 +388,13 @@ def active( address=0, loglevel=CEC_LOG_ERROR) :
   return True
 
 def on( address=0, loglevel=CEC_LOG_ERROR) :
+  session = get_session()
+  if session is not None :
+    try :
+      return session.on(address, timeout=resilience.remaining(CEC_COMMAND_TIMEOUT))
+    except Exception :
+      logger.exception('cec-client session on failed.')
+
   communicate = _cec_client('on', address)
   # for line in communicate.split('\n') :
   #   logger.debug(line)
@@ -84,6 +406,13 @@ def on( address=0, loglevel=CEC_LOG_ERROR) :
   return True
 
 def standby( address=0, loglevel=CEC_LOG_ERROR) :
+  session = get_session()
+  if session is not None :
+    try :
+      return session.standby(address, timeout=resilience.remaining(CEC_COMMAND_TIMEOUT))
+    except Exception :
+      logger.exception('cec-client session standby failed.')
+
   communicate = _cec_client('standby', address)
   # for line in communicate.split('\n') :
   #   logger.debug(line)
@@ -146,4 +475,7 @@ if __name__ == '__main__':
       except :
         logger.exception('')
 
-  main(args)
+  try :
+    main(args)
+  finally :
+    close_session()
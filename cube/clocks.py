@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 時刻・待機の抽象化 (テスト用の仮想時計)
+
+時刻の取得・sleep・Event の待機・タイマー・期限を Clock 経由で行うと、
+テストでは VirtualClock に差し替えて実時間を待たずに進められる。
+
+    clock = clocks.VirtualClock()
+    controller = door_control.Controller(180.0, clock=clock)
+    controller.start()
+    clock.idle(1)          # run() が clock.sleep() で止まるまで待つ
+    clock.advance(181.0)   # 180 秒のタイムアウトを瞬時に経過させる
+
+各コンポーネントは clock を省略すると clocks.get() (通常は SystemClock) を使う。
+install() で既定の時計を差し替えると、clock を渡していない箇所も仮想時計で動く。
+
+共有する状態を持つので、他のモジュールからは `from cube import clocks` で参照すること。
+"""
+import asyncio
+from contextlib import contextmanager
+import heapq
+import itertools
+from logging import getLogger
+import threading
+import time
+
+logger = getLogger(__name__)
+
+
+class Deadline(object) :
+  """ clock の時刻で seconds 秒後の期限 """
+
+  __slots__ = ('_clock', 'at')
+
+  def __init__(self, clock, seconds: float) :
+    self._clock = clock
+    self.at = clock.monotonic() + seconds
+
+  def remaining(self) -> float :
+    return max(0.0, self.at - self._clock.monotonic())
+
+  @property
+  def expired(self) -> bool :
+    return self.at <= self._clock.monotonic()
+
+
+class Clock(object) :
+  """ 時計のインタフェース """
+
+  def time(self) -> float :
+    """ UNIX 時刻 (秒) """
+    raise NotImplementedError
+
+  def monotonic(self) -> float :
+    """ 経過時間の計測に使う単調増加の時刻 (秒) """
+    raise NotImplementedError
+
+  def sleep(self, seconds: float) -> None :
+    raise NotImplementedError
+
+  async def sleep_async(self, seconds: float) -> None :
+    raise NotImplementedError
+
+  def wait(self, event: threading.Event, timeout: float | None = None) -> bool :
+    """ event.wait(timeout) と同じ (timeout はこの時計の秒数) """
+    raise NotImplementedError
+
+  def call_later(self, delay: float, function, *args) :
+    """ delay 秒後に function(*args) を呼び出す。cancel() で取り消せるオブジェクトを返す """
+    raise NotImplementedError
+
+  def deadline(self, seconds: float) -> Deadline :
+    return Deadline(self, seconds)
+
+
+class SystemClock(Clock) :
+  """ 実際の時計 """
+
+  def time(self) -> float :
+    return time.time()
+
+  def monotonic(self) -> float :
+    return time.monotonic()
+
+  def sleep(self, seconds: float) -> None :
+    time.sleep(seconds)
+
+  async def sleep_async(self, seconds: float) -> None :
+    await asyncio.sleep(seconds)
+
+  def wait(self, event: threading.Event, timeout: float | None = None) -> bool :
+    return event.wait(timeout)
+
+  def call_later(self, delay: float, function, *args) :
+    timer = threading.Timer(delay, function, args)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class _VirtualTimer(object) :
+  __slots__ = ('when', 'function', 'args', 'cancelled')
+
+  def __init__(self, when, function, args) :
+    self.when = when
+    self.function = function
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self) :
+    self.cancelled = True
+
+
+class VirtualClock(Clock) :
+  """ advance() でだけ進む時計 (テスト用)
+
+  sleep() / wait() / sleep_async() は、他のスレッドが advance() で時刻を
+  進めるまで待つ。call_later() のタイマーは advance() を呼び出したスレッドで
+  時刻順に実行する。
+
+  auto_advance=True の場合は、sleep() 等を呼び出すとその時刻まで即座に進める。
+  (待つスレッドが1つだけのテストで使う)
+  """
+
+  # Event の待機中に時刻・Event を確認する実時間の間隔 (秒)
+  POLL_INTERVAL = 0.001
+
+  def __init__(self, start: float = 0.0, *, wall: float = 1_700_000_000.0, auto_advance: bool = False) :
+    self._now = start
+    self._wall_offset = wall - start
+    self._auto_advance = auto_advance
+    self._cond = threading.Condition()
+    self._timers = []
+    self._sequence = itertools.count()
+    # 待機中の目標時刻 {id: 時刻} と、sleep_async の [(時刻, ループ, future)]
+    self._waiting = {}
+    self._async_waiting = []
+
+  def time(self) -> float :
+    with self._cond :
+      return self._now + self._wall_offset
+
+  def monotonic(self) -> float :
+    with self._cond :
+      return self._now
+
+  # ##########################################################################
+  # 待機
+  # ##########################################################################
+  def sleep(self, seconds: float) -> None :
+    with self._cond :
+      target = self._now + max(0.0, seconds)
+    if self._auto_advance :
+      self.advance_to(target)
+      return
+    key = object()
+    with self._cond :
+      self._waiting[key] = target
+      self._cond.notify_all()
+      try :
+        while self._now < target :
+          self._cond.wait()
+      finally :
+        self._waiting.pop(key, None)
+
+  async def sleep_async(self, seconds: float) -> None :
+    with self._cond :
+      target = self._now + max(0.0, seconds)
+    if self._auto_advance :
+      self.advance_to(target)
+      return
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with self._cond :
+      if target <= self._now :
+        return
+      self._async_waiting.append((target, loop, future))
+      self._cond.notify_all()
+    await future
+
+  def wait(self, event: threading.Event, timeout: float | None = None) -> bool :
+    if event.is_set() :
+      return True
+    if timeout is None :
+      # 時刻によらないので、実際に待つ
+      key = object()
+      with self._cond :
+        self._waiting[key] = None
+        self._cond.notify_all()
+      try :
+        return event.wait()
+      finally :
+        with self._cond :
+          del self._waiting[key]
+    with self._cond :
+      target = self._now + max(0.0, timeout)
+    if self._auto_advance :
+      self.advance_to(target)
+      return event.is_set()
+    key = object()
+    with self._cond :
+      self._waiting[key] = target
+      self._cond.notify_all()
+      try :
+        # Event.set() は通知されないため、短い間隔で確認する
+        while not event.is_set() and self._now < target :
+          self._cond.wait(self.POLL_INTERVAL)
+        return event.is_set()
+      finally :
+        self._waiting.pop(key, None)
+
+  # ##########################################################################
+  # タイマー
+  # ##########################################################################
+  def call_later(self, delay: float, function, *args) -> _VirtualTimer :
+    with self._cond :
+      timer = _VirtualTimer(self._now + max(0.0, delay), function, args)
+      heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+      self._cond.notify_all()
+    return timer
+
+  # ##########################################################################
+  # 時刻を進める
+  # ##########################################################################
+  def advance(self, seconds: float) -> None :
+    """ seconds 秒進める """
+    with self._cond :
+      target = self._now + seconds
+    self.advance_to(target)
+
+  def advance_to(self, target: float) -> None :
+    """ target まで進める。途中のタイマーは時刻順に、その時刻にして実行する """
+    while True :
+      with self._cond :
+        if self._timers and self._timers[0][0] <= target :
+          when, _, timer = heapq.heappop(self._timers)
+          self._set_now(when)
+        else :
+          self._set_now(target)
+          return
+      if not timer.cancelled :
+        try :
+          timer.function(*timer.args)
+        except Exception :
+          logger.exception('virtual timer failed.')
+
+  def _set_now(self, value) :
+    """ (self._cond を取得して呼び出すこと) """
+    if self._now < value :
+      self._now = value
+    # 起こすものは待機中から外す (idle() が起きる前のスレッドを数えないように)
+    for key, target in list(self._waiting.items()) :
+      if target is not None and target <= self._now :
+        del self._waiting[key]
+    remaining = []
+    for target, loop, future in self._async_waiting :
+      if target <= self._now :
+        loop.call_soon_threadsafe(_resolve, future)
+      else :
+        remaining.append((target, loop, future))
+    self._async_waiting = remaining
+    self._cond.notify_all()
+
+  def next_wakeup(self) -> float | None :
+    """ 待機中のスレッド・タイマーが次に進む時刻 (なければ None) """
+    with self._cond :
+      targets = [target for target in self._waiting.values() if target is not None]
+      targets += [target for target, _, _ in self._async_waiting]
+      targets += [when for when, _, timer in self._timers if not timer.cancelled]
+      return min(targets, default=None)
+
+  def step(self) -> float | None :
+    """ 次に待機が終わる時刻まで進める。進めた時刻を返す (待機がなければ None) """
+    target = self.next_wakeup()
+    if target is not None :
+      self.advance_to(target)
+    return target
+
+  @property
+  def waiting(self) -> int :
+    """ sleep() / wait() / sleep_async() で待機中の数 """
+    with self._cond :
+      return len(self._waiting) + len(self._async_waiting)
+
+  def idle(self, count: int = 1, timeout: float | None = 5.0) -> bool :
+    """ count 以上が待機するまで実時間で待つ (スレッドが次の sleep() に到達したことの同期に使う) """
+    with self._cond :
+      return self._cond.wait_for(lambda : count <= len(self._waiting) + len(self._async_waiting), timeout)
+
+  def run_for(self, seconds: float, *, settle: float = 0.0) -> None :
+    """ 待機の終わる時刻ごとに区切って seconds 秒進める
+
+    settle を指定すると、区切りごとに実時間で settle 秒待って、起きたスレッドが
+    次の待機に入るのを待つ。
+    """
+    with self._cond :
+      end = self._now + seconds
+    while True :
+      target = self.next_wakeup()
+      if target is None or end < target :
+        break
+      self.advance_to(target)
+      if settle :
+        time.sleep(settle)
+    self.advance_to(end)
+
+
+def _resolve(future) :
+  if not future.done() :
+    future.set_result(None)
+
+
+SYSTEM = SystemClock()
+
+_default = SYSTEM
+
+
+def get() -> Clock :
+  """ 既定の時計 """
+  return _default
+
+
+def install(clock: Clock | None) -> Clock :
+  """ 既定の時計を差し替える (None の場合は SystemClock に戻す)。元の時計を返す """
+  global _default
+  previous, _default = _default, clock or SYSTEM
+  return previous
+
+
+@contextmanager
+def using(clock: Clock) :
+  """ 囲んだ範囲だけ既定の時計を差し替える """
+  previous = install(clock)
+  try :
+    yield clock
+  finally :
+    install(previous)
@@ -47,6 +47,9 @@ MODEL = application.configs.get('TCU', 'MODEL', fallback=None)
 # ##############################################################################
 UNLOCK_TIMEOUT = application.configs.getfloat(
     'TCU', 'UNLOCK_TIMEOUT', fallback=180.0)
+# 終了時に全てのサブシステムの停止を待つ時間
+SHUTDOWN_DEADLINE = application.configs.getfloat(
+    'TCU', 'SHUTDOWN_DEADLINE', fallback=10.0)
 
 # ##############################################################################
 # Distance sensor
@@ -158,6 +161,68 @@ ONLINEMED_SERVER_PORT = application.configs.getint(
 ONLINEMED_CUBE_ROOT_TOPIC = application.configs.get(
     'TCU', 'MQTT_TOPICS', fallback='minnzennkai/cube')
 
+# ##############################################################################
+# metrics
+# ##############################################################################
+# 計測値を http://METRICS_HOST:METRICS_PORT/metrics で出力する (既定の 0 の場合は出力しない)
+METRICS_HOST = application.configs.get('TCU', 'METRICS_HOST', fallback='127.0.0.1')
+METRICS_PORT = application.configs.getint('TCU', 'METRICS_PORT', fallback=0)
+# 計測値を MQTT (<MQTT_TOPICS>/status/<デバイスID>) へ送信する間隔 (0 の場合は送信しない)
+METRICS_MQTT_INTERVAL = application.configs.getfloat(
+    'TCU', 'METRICS_MQTT_INTERVAL', fallback=0.0)
+
+# ##############################################################################
+# tracing
+# ##############################################################################
+# 診察ごとのトレースの出力先 (空の場合はログファイルと同じディレクトリの trace.jsonl)
+TRACE_FILE = application.configs.get('TCU', 'TRACE_FILE', fallback='')
+# 出力形式 jsonl / otlp (none の場合は出力しない)
+TRACE_FORMAT = application.configs.get('TCU', 'TRACE_FORMAT', fallback='jsonl')
+
+# ##############################################################################
+# diagnostics
+# ##############################################################################
+# スタックの出力・プロファイルの要求を 127.0.0.1:DIAG_PORT で受け付ける (既定の 0 の場合は受け付けない)
+DIAG_PORT = application.configs.getint('TCU', 'DIAG_PORT', fallback=0)
+# プロファイルの時間と採取の間隔 (秒)
+DIAG_PROFILE_SECONDS = application.configs.getfloat('TCU', 'DIAG_PROFILE_SECONDS', fallback=30.0)
+DIAG_PROFILE_INTERVAL = application.configs.getfloat('TCU', 'DIAG_PROFILE_INTERVAL', fallback=0.01)
+
+# ##############################################################################
+# leak monitor
+# ##############################################################################
+# メモリ・スレッド等を採取する間隔 (秒)。0 の場合は監視しない
+LEAK_INTERVAL = application.configs.getfloat('TCU', 'LEAK_INTERVAL', fallback=600.0)
+# tracemalloc で記録するスタックの深さ (既定の 0 の場合は tracemalloc を使わない)
+LEAK_TRACEMALLOC_FRAMES = application.configs.getint('TCU', 'LEAK_TRACEMALLOC_FRAMES', fallback=0)
+# 最初の採取からの増加の閾値
+LEAK_MEMORY_GROWTH_MB = application.configs.getfloat('TCU', 'LEAK_MEMORY_GROWTH_MB', fallback=64.0)
+LEAK_THREAD_GROWTH = application.configs.getint('TCU', 'LEAK_THREAD_GROWTH', fallback=16)
+LEAK_CHILD_GROWTH = application.configs.getint('TCU', 'LEAK_CHILD_GROWTH', fallback=4)
+LEAK_FD_GROWTH = application.configs.getint('TCU', 'LEAK_FD_GROWTH', fallback=64)
+LEAK_OBJECT_GROWTH = application.configs.getint('TCU', 'LEAK_OBJECT_GROWTH', fallback=4)
+
+# ##############################################################################
+# peripheral calls
+# ##############################################################################
+# tcud への要求1回の応答を待つ時間 (秒)
+TCUD_TIMEOUT = application.configs.getfloat('TCU', 'TCUD_TIMEOUT', fallback=2.0)
+# リレーへの要求1回の応答を待つ時間 (秒)
+RELAY_TIMEOUT = application.configs.getfloat('TCU', 'RELAY_TIMEOUT', fallback=5.0)
+# 接続先ごとに続けて失敗したら呼び出しを止める回数と、止めてから再度試すまでの時間 (秒)
+BREAKER_FAILURE_THRESHOLD = application.configs.getint('TCU', 'BREAKER_FAILURE_THRESHOLD', fallback=3)
+BREAKER_RESET_TIMEOUT = application.configs.getfloat('TCU', 'BREAKER_RESET_TIMEOUT', fallback=30.0)
+# 処理全体の期限 (秒)。処理中の周辺機器の呼び出しは期限を超えて待たない
+CUBE_OPEN_DEADLINE = application.configs.getfloat('TCU', 'CUBE_OPEN_DEADLINE', fallback=300.0)
+CONSULTATION_START_DEADLINE = application.configs.getfloat('TCU', 'CONSULTATION_START_DEADLINE', fallback=90.0)
+FINISH_DEADLINE = application.configs.getfloat('TCU', 'FINISH_DEADLINE', fallback=60.0)
+
+# ##############################################################################
+# startup
+# ##############################################################################
+# 起動中にタッチ・診察の要求を受けた場合に、必要なサブシステムの準備を待つ時間 (秒)
+CAPABILITY_WAIT_TIMEOUT = application.configs.getfloat('TCU', 'CAPABILITY_WAIT_TIMEOUT', fallback=10.0)
+
 # ##############################################################################
 # online medical
 # ##############################################################################
@@ -166,6 +231,16 @@ ONLINEMED_PATIENT_URL = application.configs.get(
     'TCU', 'ONLINEMED_PATIENT_URL', fallback=f'patient.{SERVER_HOST_NAME}')
 ONLINEMED_PATIENT_KIOSK = application.configs.getboolean(
     'TCU', 'ONLINEMED_PATIENT_KIOSK', fallback=True)
+# 待機させておくブラウザの数 (0の場合は診察の度にブラウザを起動する)
+ONLINEMED_PATIENT_BROWSER_POOL = application.configs.getint(
+    'TCU', 'ONLINEMED_PATIENT_BROWSER_POOL', fallback=1 if MODEL != MODEL_PORTABLE else 0)
+
+# カードのタッチから cube_open までの間に、テレビ・ブラウザ・リレーの準備を先行して行う
+WARMUP = application.configs.getboolean(
+    'TCU', 'WARMUP', fallback=True if MODEL != MODEL_PORTABLE else False)
+# この時間内に cube_open を受信しなければ、先行して行った準備を元に戻す
+WARMUP_TIMEOUT = application.configs.getfloat(
+    'TCU', 'WARMUP_TIMEOUT', fallback=20.0)
 
 # ##############################################################################
 # tv control
@@ -198,6 +273,17 @@ TV_TURNOFF_RETRY = application.configs.getint(
 FELICA_SWITCH_INTERVAL = application.configs.getfloat(
     'TCU', 'FELICA_SWITCH_INTERVAL', fallback=30.0)
 
+# ##############################################################################
+# FeliCa registry
+# ##############################################################################
+FELICA_LIST_FILE = application.configs.get(
+    'TCU', 'FELICA_LIST_FILE', fallback='felica.csv')
+FELICA_LIST_WATCH = application.configs.getboolean(
+    'TCU', 'FELICA_LIST_WATCH', fallback=False)
+# 同じカードのタッチを無視する時間(秒)
+FELICA_TAP_WINDOW = application.configs.getfloat(
+    'TCU', 'FELICA_TAP_WINDOW', fallback=3.0)
+
 # ##############################################################################
 # Portable
 # ##############################################################################
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 停止 (フリーズ) した時の調査用の診断機能
+
+dump_stacks()
+  全てのスレッドのスタックを出力する。各スレッドのフレームの self が持つロックの
+  状態 (RLock は所有スレッド) を調べ、他のスレッドが持っているロックを待っている
+  可能性があればスレッドごとに示す。
+
+Profiler
+  指定した秒数の間、全てのスレッドのスタックを一定間隔で採取し、
+  collapsed stack 形式 (flamegraph.pl, speedscope 等で読める) のファイルに出力する。
+  採取している間だけスレッドが1つ動くので、通常時の負荷はない。
+
+呼び出し方
+  シグナル  SIGUSR1 (Windows は Ctrl+Break の SIGBREAK) でスタック、SIGUSR2 でプロファイル
+  ソケット  127.0.0.1:<DIAG_PORT> に 'stacks' / 'profile [秒]' の1行を送る
+            python -m cube.diagnostics stacks
+  トレイ    Diagnostics メニュー
+
+出力先は configure() で指定したディレクトリ (ログファイルと同じ場所)。
+
+共有する状態を持つので、他のモジュールからは `from cube import diagnostics` で参照すること。
+"""
+from collections import Counter
+from logging import getLogger
+import os
+import re
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+logger = getLogger(__name__)
+
+# プロファイルの既定の時間と採取の間隔 (秒)
+PROFILE_SECONDS = 30.0
+PROFILE_INTERVAL = 0.01
+# ソケットから指定できるプロファイルの最大時間 (秒)
+PROFILE_SECONDS_MAX = 600.0
+
+_LOCK_TYPE = type(threading.Lock())
+_RLOCK_TYPES = tuple({type(threading.RLock()), threading._PyRLock})
+_OWNER_RE = re.compile(r'owner=(\d+)')
+
+_output_dir = None
+_profile_lock = threading.Lock()
+
+
+def configure(output_dir=None) -> None :
+  """ 出力先のディレクトリを設定する (None はカレントディレクトリ) """
+  global _output_dir
+  _output_dir = output_dir
+
+
+def _output_path(prefix, suffix) -> str :
+  directory = _output_dir or os.getcwd()
+  return os.path.join(directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+
+
+# ##############################################################################
+# スタック
+# ##############################################################################
+def _lock_owner(lock) -> int | None :
+  """ RLock を所有しているスレッドの ident (所有されていなければ None) """
+  owner = getattr(lock, '_owner', None)
+  if owner is None :
+    # C 実装の RLock は所有者を repr でのみ公開している
+    match = _OWNER_RE.search(repr(lock))
+    owner = int(match.group(1)) if match else None
+  return owner or None
+
+
+def _lock_state(lock, names) -> tuple | None :
+  """ (ロックの種類, 状態の説明, 所有スレッドの ident)。ロックでなければ None """
+  if isinstance(lock, threading.Condition) :
+    lock = lock._lock
+  elif isinstance(lock, threading.Event) :
+    return ('Event', 'set' if lock.is_set() else 'not set', None)
+  elif isinstance(lock, threading.Semaphore) :
+    return (type(lock).__name__, f'value={lock._value}', None)
+
+  if isinstance(lock, _RLOCK_TYPES) :
+    owner = _lock_owner(lock)
+    if owner is None :
+      return ('RLock', 'unlocked', None)
+    return ('RLock', f"held by {names.get(owner, owner)!r}", owner)
+  if isinstance(lock, _LOCK_TYPE) :
+    return ('Lock', 'locked' if lock.locked() else 'unlocked', None)
+  return None
+
+
+def _frame_locks(frame) :
+  """ フレームの self (とローカル変数) が参照しているロック [(名前, ロック)] """
+  try :
+    local_items = list(frame.f_locals.items())
+  except Exception :
+    return
+  for name, value in local_items :
+    if name == 'self' :
+      attributes = getattr(value, '__dict__', None)
+      if isinstance(attributes, dict) :
+        owner = type(value).__name__
+        for attribute, lock in list(attributes.items()) :
+          yield f'{owner}.{attribute}', lock
+    else :
+      yield f'{frame.f_code.co_name}:{name}', value
+
+
+def _waiting_on(frame) -> str | None :
+  """ 最も内側のフレームが threading の待ちであれば、その説明 """
+  code = frame.f_code
+  if os.path.basename(code.co_filename) != 'threading.py' :
+    return None
+  owner = frame.f_locals.get('self')
+  return f'{type(owner).__name__}.{code.co_name}()' if owner is not None else f'{code.co_name}()'
+
+
+def dump_stacks() -> str :
+  """ 全てのスレッドのスタックとロックの状態 """
+  threads = {thread.ident : thread for thread in threading.enumerate()}
+  names = {ident : thread.name for ident, thread in threads.items()}
+  frames = sys._current_frames()
+  current = threading.get_ident()
+
+  lines = [f"thread dump {time.strftime('%Y-%m-%d %H:%M:%S')} pid:{os.getpid()} threads:{len(frames)}"]
+  # {id(ロック): (名前, 種類, 状態, 所有者)}
+  locks = {}
+  for ident, frame in frames.items() :
+    if ident == current :
+      continue
+    thread = threads.get(ident)
+    name = thread.name if thread is not None else f'<unknown {ident}>'
+    daemon = ' daemon' if thread is not None and thread.daemon else ''
+    lines.append('')
+    lines.append(f'Thread {name!r} (ident {ident}{daemon})')
+
+    # 他のスレッドが所有しているロックを参照しているフレームがあれば、待っている可能性がある
+    blocked_by = {}
+    f = frame
+    while f is not None :
+      # threading の内部 (Thread._started 等) は除く
+      if os.path.basename(f.f_code.co_filename) == 'threading.py' :
+        f = f.f_back
+        continue
+      for lock_name, lock in _frame_locks(f) :
+        state = _lock_state(lock, names)
+        if state is None :
+          continue
+        locks.setdefault(id(lock), (lock_name,) + state)
+        owner = state[2]
+        if owner is not None and owner != ident :
+          blocked_by.setdefault(lock_name, state[1])
+      f = f.f_back
+
+    waiting = _waiting_on(frame)
+    if waiting :
+      lines.append(f'  waiting: {waiting}')
+    for lock_name, state in blocked_by.items() :
+      lines.append(f'  possibly blocked on: {lock_name} {state}')
+    for line in traceback.format_stack(frame) :
+      lines.append('  ' + line.rstrip().replace('\n', '\n  '))
+
+  if locks :
+    lines.append('')
+    lines.append('Locks referenced by the frames')
+    for lock_name, kind, state, _ in sorted(locks.values()) :
+      lines.append(f'  {lock_name} {kind} {state}')
+  return '\n'.join(lines) + '\n'
+
+
+def write_stacks() -> str :
+  """ スタックをファイルとログに出力し、ファイルのパスを返す """
+  text = dump_stacks()
+  path = _output_path('stacks', '.txt')
+  with open(path, 'w', encoding='utf-8') as f :
+    f.write(text)
+  logger.warning(f'thread dump {path}\n{text}')
+  return path
+
+
+# ##############################################################################
+# プロファイル
+# ##############################################################################
+class Profiler(threading.Thread) :
+  """ スタックを interval 秒ごとに seconds 秒間採取する """
+
+  def __init__(self, seconds: float = PROFILE_SECONDS, interval: float = PROFILE_INTERVAL, path=None,
+               *, on_finished=None) :
+    super().__init__(name='diagnostics-profiler', daemon=True)
+    self.seconds = seconds
+    self.interval = interval
+    self.path = path or _output_path('profile', '.collapsed')
+    self.samples = 0
+    # 採取にかかった時間の合計 (秒)
+    self.overhead = 0.0
+    self.stacks = Counter()
+    self._labels = {}
+    self._stopped = threading.Event()
+    self._on_finished = on_finished
+
+  def stop(self) :
+    self._stopped.set()
+
+  def _label(self, code) -> str :
+    label = self._labels.get(code)
+    if label is None :
+      module = os.path.splitext(os.path.basename(code.co_filename))[0]
+      label = self._labels[code] = f'{module}:{code.co_name}'
+    return label
+
+  def sample(self) -> None :
+    t = time.perf_counter()
+    own = threading.get_ident()
+    names = {thread.ident : thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items() :
+      if ident == own :
+        continue
+      stack = []
+      while frame is not None :
+        stack.append(self._label(frame.f_code))
+        frame = frame.f_back
+      stack.append(names.get(ident, str(ident)).replace(';', '_').replace(' ', '_'))
+      self.stacks[';'.join(reversed(stack))] += 1
+    self.samples += 1
+    self.overhead += time.perf_counter() - t
+
+  def run(self) :
+    try :
+      deadline = time.monotonic() + self.seconds
+      while time.monotonic() < deadline and not self._stopped.is_set() :
+        self.sample()
+        self._stopped.wait(self.interval)
+      self.write()
+    finally :
+      if self._on_finished is not None :
+        self._on_finished()
+
+  def write(self) -> None :
+    with open(self.path, 'w', encoding='utf-8') as f :
+      for stack, count in self.stacks.most_common() :
+        f.write(f'{stack} {count}\n')
+    logger.warning(
+        f'profile {self.path} samples:{self.samples} stacks:{len(self.stacks)} '
+        f'overhead:{self.overhead:0.3f}s ({self.overhead / max(self.seconds, 1e-9) * 100:0.2f}%)')
+
+
+def profile(seconds: float = PROFILE_SECONDS, interval: float = PROFILE_INTERVAL, *, wait=True) -> Profiler | None :
+  """ プロファイルを採取する。既に採取中の場合は None """
+  if not _profile_lock.acquire(blocking=False) :
+    logger.info('profile is already running.')
+    return None
+
+  profiler = Profiler(seconds, interval, on_finished=_profile_lock.release)
+  logger.info(f'profile start {seconds}s interval {interval}s')
+  profiler.start()
+  if wait :
+    profiler.join()
+  return profiler
+
+
+# ##############################################################################
+# 呼び出し方
+# ##############################################################################
+def _in_thread(function, *args) :
+  threading.Thread(target=function, args=args, name='diagnostics', daemon=True).start()
+
+
+def install_signal_handlers(profile_seconds: float = PROFILE_SECONDS) -> list :
+  """ シグナルで呼び出せるようにする (メインスレッドから呼び出すこと)。設定したシグナルを返す """
+  def _on_stacks(signum, frame) :
+    _in_thread(write_stacks)
+
+  def _on_profile(signum, frame) :
+    _in_thread(profile, profile_seconds)
+
+  installed = []
+  for name, handler in (('SIGUSR1', _on_stacks), ('SIGBREAK', _on_stacks), ('SIGUSR2', _on_profile)) :
+    signum = getattr(signal, name, None)
+    if signum is None :
+      continue
+    try :
+      signal.signal(signum, handler)
+      installed.append(name)
+    except (OSError, ValueError) :
+      logger.exception(f'diagnostics signal {name} is not available.')
+  return installed
+
+
+class _Handler(socketserver.StreamRequestHandler) :
+
+  def handle(self) :
+    line = self.rfile.readline(256).decode('utf-8', 'replace').strip()
+    command, _, argument = line.partition(' ')
+    logger.info(f'diagnostics request {line!r} from {self.client_address}')
+    try :
+      if command == 'stacks' :
+        path = write_stacks()
+        with open(path, encoding='utf-8') as f :
+          reply = f.read()
+      elif command == 'profile' :
+        seconds = min(float(argument), PROFILE_SECONDS_MAX) if argument else self.server.profile_seconds
+        profiler = profile(seconds, self.server.profile_interval)
+        if profiler is None :
+          reply = 'profile is already running.\n'
+        else :
+          with open(profiler.path, encoding='utf-8') as f :
+            reply = f'# {profiler.path} samples:{profiler.samples}\n' + f.read()
+      else :
+        reply = 'commands: stacks | profile [seconds]\n'
+    except Exception as e :
+      logger.exception(f'diagnostics request {line!r} failed.')
+      reply = f'error: {e!r}\n'
+    self.wfile.write(reply.encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingTCPServer) :
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+_server = None
+
+
+def serve(host='127.0.0.1', port=9465, *, profile_seconds: float = PROFILE_SECONDS,
+          profile_interval: float = PROFILE_INTERVAL) :
+  """ ローカルのソケットで要求を受け付けるスレッドを開始する """
+  global _server
+  if _server is not None :
+    return _server
+  server = _Server((host, port), _Handler)
+  server.profile_seconds = profile_seconds
+  server.profile_interval = profile_interval
+  threading.Thread(target=server.serve_forever, name='diagnostics-server', daemon=True).start()
+  _server = server
+  logger.info(f'diagnostics serving on {host}:{port}')
+  return server
+
+
+def shutdown() :
+  global _server
+  server, _server = _server, None
+  if server is not None :
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__' :
+  import argparse
+  import socket
+
+  argp = argparse.ArgumentParser(description='request a thread dump or a profile from the running cube.')
+  argp.add_argument('command', choices=('stacks', 'profile'))
+  argp.add_argument('seconds', nargs='?', type=float, help='profile seconds')
+  argp.add_argument('--host', default='127.0.0.1')
+  argp.add_argument('--port', type=int, default=9465)
+  args = argp.parse_args()
+
+  request = args.command if args.seconds is None else f'{args.command} {args.seconds}'
+  timeout = (args.seconds or PROFILE_SECONDS) + 30.0
+  with socket.create_connection((args.host, args.port), timeout=timeout) as sock :
+    sock.sendall(request.encode('utf-8') + b'\n')
+    sock.shutdown(socket.SHUT_WR)
+    while True :
+      data = sock.recv(65536)
+      if not data :
+        break
+      sys.stdout.write(data.decode('utf-8', 'replace'))
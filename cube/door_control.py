@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
 from logging import getLogger
-import time
 from threading import RLock, Event
 
 from tcu.relay.constant import *
 from tcu.relay import client
 from tcu.relay import Switches
 
-from configs import TCUPI_RELAY_HOST, TCUPI_RELAY_PORT, LOCK_PULSE_TIME, LOCK_PULSE_DELAY, DISTANCE_INTERVAL, DOOR_TIME_TO_LOCK_FROM_CLOSING
+from configs import TCUPI_RELAY_HOST, TCUPI_RELAY_PORT, LOCK_PULSE_TIME, LOCK_PULSE_DELAY, DISTANCE_INTERVAL, DOOR_TIME_TO_LOCK_FROM_CLOSING, RELAY_TIMEOUT
+from cube import clocks
 from cube import cube_thread
+from cube import metrics
+from cube import resilience
+from cube import tracing
 
 logger = getLogger(__name__)
 
+RELAY_SECONDS = metrics.histogram('cube_door_relay_seconds', 'door lock relay request time', ('operation',))
+DOOR_EVENTS = metrics.counter('cube_door_events', 'door events', ('event',))
+DOOR_OPEN_SECONDS = metrics.histogram('cube_door_open_seconds', 'time from the unlock to the door open')
+
+# リレーの要求はタイムアウトを指定できないため、専用のスレッドで実行して期限までだけ待つ
+RELAY = resilience.breaker('relay', timeout=RELAY_TIMEOUT, isolate=True)
+
 
 class DoorControlException(Exception):
   pass
@@ -21,6 +31,11 @@ class TimeoutException(DoorControlException):
   pass
 
 
+class RelayException(DoorControlException):
+  """ リレーが応答しない、または続けて失敗しているため呼び出さなかった """
+  pass
+
+
 class OpenTimeoutException(TimeoutException):
   pass
 
@@ -34,9 +49,9 @@ class Controller(cube_thread):
   _instance = None
 
   @classmethod
-  def getInstance(cls, timeout=180.0):
+  def getInstance(cls, timeout=180.0, *, clock: clocks.Clock | None = None):
     if cls._instance is None:
-      cls._instance = cls(timeout)
+      cls._instance = cls(timeout, clock=clock)
     return cls._instance
 
   @property
@@ -48,7 +63,7 @@ class Controller(cube_thread):
     with self._resource_rlock:
       return self._electronic_lock_status
 
-  def __init__(self, timeout=180.0):
+  def __init__(self, timeout=180.0, *, clock: clocks.Clock | None = None):
 
     if Controller._instance is not None:
       raise Exception(f"This class '{__class__}' is a singleton!")
@@ -58,6 +73,7 @@ class Controller(cube_thread):
 
     self._is_timeout = False
     self._timeout = timeout
+    self._clock = clock or clocks.get()
 
     self.on_timeover = None
 
@@ -81,13 +97,19 @@ class Controller(cube_thread):
     except :
       logger.exception("Controller.resource release has occuered exception.")
 
+  def _relay(self, function):
+    try :
+      return RELAY.call(function, (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT), LOCK_PULSE_TIME, LOCK_PULSE_DELAY)
+    except resilience.ResilienceError as e :
+      raise RelayException(f"{function.__name__} failed. {e}") from e
+
   def _engage_lock(self):
     """電子錠を施錠する
     """
     with self._resource_rlock:
       logger.debug(f"Controller._engage_lock()")
-      resp_msg = client.door_lock(
-          (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT), LOCK_PULSE_TIME, LOCK_PULSE_DELAY)
+      with RELAY_SECONDS.labels('lock').time(), tracing.span('door.relay', operation='lock') :
+        resp_msg = self._relay(client.door_lock)
       logger.debug(f"door_lock rest resp:{resp_msg}")
       self._electronic_lock_status = False
 
@@ -96,8 +118,8 @@ class Controller(cube_thread):
     """
     with self._resource_rlock:
       logger.debug(f"Controller._disengage_lock()")
-      resp_msg = client.door_unlock(
-          (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT), LOCK_PULSE_TIME, LOCK_PULSE_DELAY)
+      with RELAY_SECONDS.labels('unlock').time(), tracing.span('door.relay', operation='unlock') :
+        resp_msg = self._relay(client.door_unlock)
       logger.debug(f"door_unlock resp:{resp_msg}")
       self._electronic_lock_status = True
 
@@ -107,10 +129,10 @@ class Controller(cube_thread):
     if not self._do:
       try:
         # Door unlock
-        stime = time.time()
+        stime = self._clock.monotonic()
         logger.info(f"unlock door.(by door_control thread)")
         self._disengage_lock()
-        logger.info(f"door was unlocked at {time.time()-stime:0.3f}")
+        logger.info(f"door was unlocked at {self._clock.monotonic()-stime:0.3f}")
         self.lock_door_on_close()
       except:
         raise
@@ -141,7 +163,7 @@ class Controller(cube_thread):
     self.on_open_event.is_set()
 
   def wait_for_open(self, timeout: float | None = None):
-    if self.on_open_event.wait(timeout) :
+    if self._clock.wait(self.on_open_event, timeout) :
       if self.is_timeout():
         raise OpenTimeoutException(
             f"The open process did not finish within the given time.")
@@ -153,7 +175,7 @@ class Controller(cube_thread):
     self.on_close_event.is_set()
 
   def wait_for_close(self, timeout: float | None = None)->bool:
-    if self.on_close_event.wait(timeout) :
+    if self._clock.wait(self.on_close_event, timeout) :
       if self.is_timeout() :
         raise LockTimeoutException(
             f"The close process did not finish within the given time.")
@@ -180,33 +202,36 @@ class Controller(cube_thread):
 
     try:
       logger.debug(f'door control run {self}')
-      stime = time.time()
+      stime = self._clock.monotonic()
 
       while self._do:
         # interval is 100 milliseconds
-        time.sleep(DISTANCE_INTERVAL)
-        tm = time.time()
+        self._clock.sleep(DISTANCE_INTERVAL)
+        tm = self._clock.monotonic()
 
         if not is_opend:
           if is_open():
             is_opend = True
             self._call_event_on_open()
+            DOOR_EVENTS.labels('open').inc()
+            DOOR_OPEN_SECONDS.observe(tm - stime)
             logger.debug(f"door is opened {tm-stime:0.3f}")
           else:
             if self._timeout < tm - stime:
               logger.info(f"door unlock time is over :{tm-stime:0.3f}")
               self._engage_lock()
-              logger.info(f"door was unlocked at {time.time()-stime:0.3f}")
+              logger.info(f"door was unlocked at {self._clock.monotonic()-stime:0.3f}")
               if is_open():
                   logger.info(f"door unlock time is over :{tm-stime:0.3f}")
                   self._disengage_lock()
-                  logger.info(f"door was unlocked at {time.time()-stime:0.3f}")
+                  logger.info(f"door was unlocked at {self._clock.monotonic()-stime:0.3f}")
               else:
                 self._is_timeout = True
+                DOOR_EVENTS.labels('open_timeout').inc()
                 self._call_event_on_open()
                 self._call_event_on_close()
                 logger.info(
-                    f"door call event on_close {time.time()-stime:0.3f}")
+                    f"door call event on_close {self._clock.monotonic()-stime:0.3f}")
                 break
         else:
           if is_open():
@@ -216,7 +241,7 @@ class Controller(cube_thread):
               # Door unlock
               logger.info(f"unlock door at {tm-stime:0.3f}")
               self._disengage_lock()
-              logger.info(f"door was unlocked at {time.time()-stime:0.3f}")
+              logger.info(f"door was unlocked at {self._clock.monotonic()-stime:0.3f}")
               is_lock = False
           else:
             # door is closeed
@@ -225,16 +250,17 @@ class Controller(cube_thread):
                 logger.info(f"lock door at {tm-stime:0.3f}")
                 self._engage_lock()
                 is_lock = True
-                logger.info(f"door was locked at {time.time()-stime:0.3f}")
+                logger.info(f"door was locked at {self._clock.monotonic()-stime:0.3f}")
                 if is_open():
                   logger.info(f"door unlock time is over :{tm-stime:0.3f}")
                   self._disengage_lock()
-                  logger.info(f"door was unlocked at {time.time()-stime:0.3f}")
+                  logger.info(f"door was unlocked at {self._clock.monotonic()-stime:0.3f}")
                   is_lock = False
                 else:
+                  DOOR_EVENTS.labels('close').inc()
                   self._call_event_on_close()
                   logger.info(
-                      f"door call event on_close {time.time()-stime:0.3f}")
+                      f"door call event on_close {self._clock.monotonic()-stime:0.3f}")
                   break
             else:
               time_door_close = tm
@@ -253,12 +279,12 @@ class Controller(cube_thread):
         self._call_event_on_open()
         self._call_event_on_close()
 
-    logger.info(f"_door_control run fin. {time.time()-stime:0.3f}")
+    logger.info(f"_door_control run fin. {self._clock.monotonic()-stime:0.3f}")
   # : def run(self)
 
 
-def create_controller(timeout: float | None = None) -> Controller:
-  return Controller.getInstance(timeout)
+def create_controller(timeout: float | None = None, *, clock: clocks.Clock | None = None) -> Controller:
+  return Controller.getInstance(timeout, clock=clock)
 
 
 def get_controller() -> Controller:
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" プロセス内のイベントバス
+
+コンポーネント間の通知を、1つだけ設定できるコールバック属性の代わりに
+型 (Event のサブクラス) ごとの購読で行う。
+
+    class PatientEntered(events.Event) :
+      __slots__ = ('sensor',)
+
+      def __init__(self, sensor) :
+        self.sensor = sensor
+
+    subscription = events.subscribe(PatientEntered, on_patient_entered, name='cube.enter')
+    events.publish(PatientEntered(sensor))
+    subscription.unsubscribe()
+
+- 購読は型の isinstance で判定するので、基底クラスで購読すると派生クラスの
+  イベントも受け取る。(1つの購読に届くイベントは発行した順に処理する)
+- publish() は購読ごとのキューに入れるだけで、処理を待たない。
+  ハンドラは購読ごとの専用スレッド、executor、または asyncio のイベントループで
+  呼び出す。(コルーチン関数のハンドラはイベントループで実行する)
+- キューが max_pending に達した場合は overflow に従って、発行側を待たせる (BLOCK)、
+  古いものを捨てる (DROP_OLDEST)、新しいものを捨てる (DROP_NEWEST)。
+- 発行時の contextvars (トレース・期限) を引き継いでハンドラを呼び出す。
+- 発行から処理開始までの時間と、ハンドラの処理時間を購読ごとに記録する。
+
+共有する状態を持つので、他のモジュールからは `from cube import events` で参照すること。
+"""
+import asyncio
+from collections import deque
+import contextvars
+from logging import getLogger
+import threading
+import time
+
+from cube import metrics
+
+logger = getLogger(__name__)
+
+# キューが一杯の場合の動作
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+# 購読ごとの既定のキューの長さ
+MAX_PENDING = 64
+# BLOCK で発行側を待たせる最大の時間 (秒)。過ぎたら新しいものを捨てる
+BLOCK_TIMEOUT = 1.0
+
+PUBLISHED = metrics.counter('cube_events_published', 'events published', ('event',))
+DROPPED = metrics.counter('cube_events_dropped', 'events dropped by a full subscriber queue', ('event', 'subscriber'))
+FAILED = metrics.counter('cube_events_failed', 'event handlers raised an exception', ('event', 'subscriber'))
+LATENCY_SECONDS = metrics.histogram(
+    'cube_event_latency_seconds', 'time from publish to the handler start', ('event', 'subscriber'))
+HANDLER_SECONDS = metrics.histogram(
+    'cube_event_handler_seconds', 'event handler time', ('event', 'subscriber'))
+
+
+class Event(object) :
+  """ イベントの基底クラス (属性は __slots__ に列挙する) """
+  __slots__ = ()
+
+  def __repr__(self) :
+    names = [name for cls in reversed(type(self).__mro__) for name in getattr(cls, '__slots__', ())]
+    return f'{type(self).__name__}({", ".join(f"{name}={getattr(self, name)!r}" for name in names)})'
+
+
+class Subscription(object) :
+  """ 1つの購読 (キューと配送先) """
+
+  def __init__(self, bus, event_type, handler, *, name=None, executor=None, loop=None,
+               max_pending: int = MAX_PENDING, overflow: str = BLOCK, block_timeout: float = BLOCK_TIMEOUT) :
+    if overflow not in (BLOCK, DROP_OLDEST, DROP_NEWEST) :
+      raise ValueError(f'unknown overflow {overflow}')
+    self._is_coroutine = asyncio.iscoroutinefunction(handler)
+    if self._is_coroutine and loop is None :
+      raise ValueError(f'coroutine handler {handler} requires loop.')
+
+    self.bus = bus
+    self.event_type = event_type
+    self.handler = handler
+    self.name = name or getattr(handler, '__qualname__', repr(handler))
+    self._executor = executor
+    self._loop = loop
+    self._max_pending = max_pending
+    self._overflow = overflow
+    self._block_timeout = block_timeout
+
+    self._cond = threading.Condition()
+    self._pending = deque()
+    self._scheduled = False
+    self._closed = False
+    self._worker = None
+
+    self.delivered = 0
+    self.dropped = 0
+    self.failed = 0
+
+  @property
+  def pending(self) -> int :
+    with self._cond :
+      return len(self._pending)
+
+  def unsubscribe(self) :
+    self.bus.unsubscribe(self)
+
+  # ##########################################################################
+  # キュー
+  # ##########################################################################
+  def _put(self, event, published, context) -> bool :
+    item = (event, published, context)
+    with self._cond :
+      if self._closed :
+        return False
+      if self._max_pending <= len(self._pending) :
+        if self._overflow == BLOCK and threading.current_thread() is not self._worker :
+          # 処理が追いつくまで発行側を待たせる (自分の配送スレッドからの発行は待たない)
+          self._cond.wait_for(lambda : len(self._pending) < self._max_pending or self._closed,
+                              self._block_timeout)
+        if self._closed :
+          return False
+        if self._max_pending <= len(self._pending) :
+          if self._overflow == DROP_OLDEST :
+            dropped, _, _ = self._pending.popleft()
+          else :
+            dropped, item = event, None
+          self.dropped += 1
+          DROPPED.labels(type(dropped).__name__, self.name).inc()
+          logger.warning(f'event {type(dropped).__name__} dropped. subscriber {self.name} is behind.')
+          if item is None :
+            return False
+      self._pending.append(item)
+      if self._scheduled :
+        return True
+      self._scheduled = True
+      self._cond.notify_all()
+    self._schedule()
+    return True
+
+  def _schedule(self) :
+    if self._loop is not None :
+      self._loop.call_soon_threadsafe(self._start_on_loop)
+    elif self._executor is not None :
+      self._executor.submit(self._drain)
+    else :
+      with self._cond :
+        if self._worker is None :
+          self._worker = threading.Thread(target=self._run, name=f'events-{self.name}', daemon=True)
+          self._worker.start()
+
+  def _take(self) :
+    """ 次のイベント。なければ配送を終える (None) """
+    with self._cond :
+      if not self._pending or self._closed :
+        self._scheduled = False
+        return None
+      item = self._pending.popleft()
+      self._cond.notify_all()
+      return item
+
+  # ##########################################################################
+  # 配送
+  # ##########################################################################
+  def _run(self) :
+    """ 専用スレッド """
+    while True :
+      with self._cond :
+        self._cond.wait_for(lambda : self._pending or self._closed)
+        if self._closed :
+          return
+      self._drain()
+
+  def _drain(self) :
+    while True :
+      item = self._take()
+      if item is None :
+        return
+      self._deliver(*item)
+
+  def _deliver(self, event, published, context) :
+    event_name = type(event).__name__
+    started = time.monotonic()
+    LATENCY_SECONDS.labels(event_name, self.name).observe(started - published)
+    try :
+      context.run(self.handler, event)
+    except Exception :
+      self.failed += 1
+      FAILED.labels(event_name, self.name).inc()
+      logger.exception(f'event handler {self.name} failed. {event}')
+    finally :
+      self.delivered += 1
+      HANDLER_SECONDS.labels(event_name, self.name).observe(time.monotonic() - started)
+
+  def _start_on_loop(self) :
+    if self._is_coroutine :
+      self._loop.create_task(self._drain_async())
+    else :
+      self._drain()
+
+  async def _drain_async(self) :
+    while True :
+      item = self._take()
+      if item is None :
+        return
+      event, published, context = item
+      event_name = type(event).__name__
+      started = time.monotonic()
+      LATENCY_SECONDS.labels(event_name, self.name).observe(started - published)
+      try :
+        # 発行時の contextvars を引き継いだタスクで実行する
+        await context.run(asyncio.ensure_future, self.handler(event))
+      except Exception :
+        self.failed += 1
+        FAILED.labels(event_name, self.name).inc()
+        logger.exception(f'event handler {self.name} failed. {event}')
+      finally :
+        self.delivered += 1
+        HANDLER_SECONDS.labels(event_name, self.name).observe(time.monotonic() - started)
+
+  def _close(self) :
+    with self._cond :
+      self._closed = True
+      self._pending.clear()
+      self._cond.notify_all()
+
+  def stats(self) -> dict :
+    return {
+        'pending': self.pending,
+        'delivered': self.delivered,
+        'dropped': self.dropped,
+        'failed': self.failed,
+    }
+
+
+class EventBus(object) :
+  """ イベントバス """
+
+  def __init__(self) :
+    self._lock = threading.Lock()
+    self._subscriptions = ()
+
+  def subscribe(self, event_type, handler, *, name=None, executor=None, loop=None,
+                max_pending: int = MAX_PENDING, overflow: str = BLOCK,
+                block_timeout: float = BLOCK_TIMEOUT) -> Subscription :
+    """ event_type (とその派生クラス) のイベントを handler(event) で受け取る
+
+    executor を指定するとその Executor で、loop を指定するとそのイベントループで
+    呼び出す。どちらも指定しない場合は購読ごとの専用スレッドで呼び出す。
+    """
+    subscription = Subscription(self, event_type, handler, name=name, executor=executor, loop=loop,
+                                max_pending=max_pending, overflow=overflow, block_timeout=block_timeout)
+    with self._lock :
+      # 発行中に変更されてもよいよう、置き換える
+      self._subscriptions = self._subscriptions + (subscription,)
+    return subscription
+
+  def unsubscribe(self, subscription: Subscription) :
+    with self._lock :
+      self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+    subscription._close()
+
+  def publish(self, event: Event) -> int :
+    """ event を購読しているキューに入れる。入れた数を返す """
+    PUBLISHED.labels(type(event).__name__).inc()
+    published = time.monotonic()
+    context = contextvars.copy_context()
+    queued = 0
+    for subscription in self._subscriptions :
+      if isinstance(event, subscription.event_type) :
+        # 同じ Context を複数のスレッドで同時に実行できないため、購読ごとに複製する
+        if subscription._put(event, published, context.copy()) :
+          queued += 1
+    return queued
+
+  def clear(self) :
+    """ 全ての購読を解除する """
+    with self._lock :
+      subscriptions, self._subscriptions = self._subscriptions, ()
+    for subscription in subscriptions :
+      subscription._close()
+
+  def stats(self) -> dict :
+    """ {購読の名前: {pending, delivered, dropped, failed}} """
+    return {subscription.name : subscription.stats() for subscription in self._subscriptions}
+
+
+BUS = EventBus()
+
+subscribe = BUS.subscribe
+unsubscribe = BUS.unsubscribe
+publish = BUS.publish
+stats = BUS.stats
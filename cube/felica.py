@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from collections import deque
 import errno
+import logging
 from logging import getLogger
 import os
+import queue
 import sys
 import time
-from threading import Event
+from threading import Event, Lock
 import usb1
+try :
+  import pyudev
+except ImportError :
+  pyudev = None
 
 import binascii
 import nfc
@@ -17,7 +24,90 @@ import utils
 
 logger = getLogger(__name__)
 
+# USB機器の接続を検出する (Linux)
+_SYSFS_USB_DEVICES = '/sys/bus/usb/devices'
+
+# 再接続を試みる間隔 (秒)
+RETRY_INTERVAL_MIN = 0.1
+RETRY_INTERVAL_MAX = 5.0
+# sysfs を確認する間隔 (秒)
+SYSFS_POLL_INTERVAL = 0.05
+
+
+def _usb_devices() -> frozenset | None :
+  """ sysfs から接続中のUSB機器の一覧を取得する。sysfs が無い場合は None """
+  try :
+    return frozenset(os.listdir(_SYSFS_USB_DEVICES))
+  except OSError :
+    return None
+
+
+class _DeviceMonitor :
+  """ USB機器の接続を待つ。
+
+  pyudev が使える場合は udev のイベントを、使えない場合は sysfs を監視する。
+  どちらも無い環境 (Windows) では指定時間待つだけになる。
+  """
+  def __init__(self) :
+    self._monitor = None
+    self._devices = None
+    if pyudev is not None :
+      try :
+        self._monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        self._monitor.filter_by('usb')
+        self._monitor.start()
+      except Exception :
+        logger.exception('udev monitor start failed. fallback to sysfs.')
+        self._monitor = None
+
+  @property
+  def method(self) -> str :
+    if self._monitor is not None :
+      return 'udev'
+    if self._devices is not None or _usb_devices() is not None :
+      return 'sysfs'
+    return 'sleep'
+
+  def mark(self) :
+    """ 現在の状態を覚える。wait() はこれ以降の接続を待つ """
+    if self._monitor is not None :
+      # 古いイベントを読み捨てる
+      while self._monitor.poll(timeout=0) is not None :
+        pass
+    else :
+      self._devices = _usb_devices()
+
+  def wait(self, timeout: float, stopped_event: Event) -> bool :
+    """ timeout 秒以内にUSB機器が接続された場合は True """
+    deadline = time.monotonic() + timeout
+    while not stopped_event.is_set() :
+      remaining = deadline - time.monotonic()
+      if remaining <= 0.0 :
+        return False
+      if self._monitor is not None :
+        device = self._monitor.poll(timeout=min(remaining, 0.5))
+        if device is not None and device.action == 'add' :
+          return True
+      elif self._devices is not None :
+        if stopped_event.wait(min(remaining, SYSFS_POLL_INTERVAL)) :
+          return False
+        devices = _usb_devices()
+        if devices is not None and devices - self._devices :
+          self._devices = devices
+          return True
+        self._devices = devices
+      else :
+        stopped_event.wait(remaining)
+    return False
+
+
 class Reader(utils.BaseThread):
+  """ FeliCaリーダー
+
+  リーダーが抜かれたりUSBハブがリセットされた場合は、USB機器の接続を監視して
+  再接続する。接続されない場合も RETRY_INTERVAL_MIN から RETRY_INTERVAL_MAX まで
+  間隔を倍にしながら開き直しを試みる。
+  """
   def __init__(self, on_connected = None, *, daemon: bool | None = None) -> None:
     logger.info(f'Reader.__init__(daemon:{daemon})')
     super().__init__(daemon=daemon)
@@ -29,9 +119,20 @@ class Reader(utils.BaseThread):
 
     self.exception = None
 
+    self.connects = 0
+    self.failures = 0
+    self.ready_time = None
+    self.lost_time = None
+    self.last_recovery = None
+
     if on_connected :
       self.on_connected = on_connected
 
+  @property
+  def reconnects(self) -> int :
+    """ 最初の接続以降に再接続した回数 """
+    return max(0, self.connects - 1)
+
   def has_exception(self) -> bool :
     return True if self.exception is not None else False
 
@@ -41,6 +142,24 @@ class Reader(utils.BaseThread):
   def wait(self, timeout : float | None = None):
     return self._ready_event.wait(timeout)
 
+  def stats(self) -> dict :
+    return {
+        'ready': self.is_ready(),
+        'connects': self.connects,
+        'reconnects': self.reconnects,
+        'failures': self.failures,
+        'last_recovery': self.last_recovery,
+        'exception': repr(self.exception) if self.exception else None,
+    }
+
+  def _on_error(self, e: Exception, message: str) :
+    self.exception = e
+    self.failures += 1
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.exception(message)
+    else:
+      logger.error(message)
+
   def run(self) -> None:
     logger.debug(f'Reader.run()')
     try:
@@ -50,11 +169,24 @@ class Reader(utils.BaseThread):
       if self.on_connected:
         rdwr_option['on-connect'] = self.on_connected
 
+      monitor = _DeviceMonitor()
+      logger.info(f'Reader device monitor: {monitor.method}')
+      interval = RETRY_INTERVAL_MIN
+
       # タッチ時のハンドラを設定して待機する
       while self.should_keep_running():
+          monitor.mark()
           try:
             with nfc.ContactlessFrontend('usb') as clf:
               logger.info(f'NFC ContactlessFrontend {rdwr_option}')
+              self.connects += 1
+              self.ready_time = time.monotonic()
+              if self.lost_time is not None :
+                self.last_recovery = self.ready_time - self.lost_time
+                logger.info(
+                    f'NFC reader recovered in {self.last_recovery:.2f}s. (reconnects {self.reconnects})')
+                self.lost_time = None
+              interval = RETRY_INTERVAL_MIN
               self.exception = None
               self._ready_event.set()
 
@@ -67,45 +199,148 @@ class Reader(utils.BaseThread):
                   logger.debug(f'NFC connected')
                 else :
                   break
+            continue
           except usb1.USBErrorAccess as e:
-            if logger.level > logging.DEBUG:
-              logger.error(f'USB Error: Access')
-            else :
-              logger.exception(f'USB Error: Access')
-            self.exception = e
-            time.sleep(1.0)
+            self._on_error(e, f'USB Error: Access')
           except usb1.USBErrorNotSupported as e:
-            if logger.level > logging.DEBUG:
-              logger.error(f'USB Error: Not Supported Device.')
-            else:
-              logger.exception(f'USB Error: Not Supported Device.')
-            self.exception = e
-            time.sleep(1.0)
+            self._on_error(e, f'USB Error: Not Supported Device.')
           except IOError as e:
             if e.errno == errno.ENODEV:  # No such device
-              self.exception = e
-              if logger.level > logging.DEBUG:
-                logger.error(f'IO Error: No such device')
-              else:
-                logger.exception(f'IO Error: No such device')
-              time.sleep(1.0)
+              self._on_error(e, f'IO Error: No such device')
             else:
               raise e
           finally :
+            if self._ready_event.is_set() :
+              self.lost_time = time.monotonic()
             self._ready_event.clear()
+
+          # リーダーが接続されるか、待ち時間が過ぎたら開き直す
+          if self.lost_time is None :
+            self.lost_time = time.monotonic()
+          if monitor.wait(interval, self.stopped_event) :
+            logger.info(f'USB device arrived. reopen NFC reader.')
+            interval = RETRY_INTERVAL_MIN
+          else :
+            interval = min(interval * 2, RETRY_INTERVAL_MAX)
     finally:
       if self.should_keep_running() :
         self.stop()
       logger.debug(f'Reader.fin()')
 
 
+class Tap :
+  """ カードのタッチ1回分 """
+  __slots__ = ('idm', 'tapped_time')
+
+  def __init__(self, idm: str, tapped_time: float) :
+    self.idm = idm
+    self.tapped_time = tapped_time
+
+  def __repr__(self) :
+    return f'Tap(idm={self.idm!r}, tapped_time={self.tapped_time!r})'
+
+
+class TapQueue(utils.BaseThread):
+  """ リーダーのスレッドからタッチを受け取り、別スレッドで handler(tap) を呼び出す。
+
+  window 秒以内の同じ idm のタッチは、最後に検出した時刻から数えて破棄する。
+  (2度タッチやカードをかざしたままの再接続で認証を繰り返さない)
+  リーダーのスレッドは put() だけを行いすぐにポーリングへ戻る。
+  """
+  def __init__(self, handler, window: float = 3.0, maxsize: int = 16, *, daemon: bool | None = None) -> None:
+    super().__init__(daemon=daemon)
+    self._handler = handler
+    self._window = window
+    self._queue = queue.Queue(maxsize)
+    self._lock = Lock()
+    self._seen = {}
+    self._pending = {}
+
+    self.received = 0
+    self.suppressed = 0
+    self.overflowed = 0
+    self.latencies = deque(maxlen=100)
+
+  def put(self, idm: str, tapped_time: float | None = None) -> bool :
+    """ タッチを受け付けた場合は True、重複などで破棄した場合は False """
+    now = time.monotonic() if tapped_time is None else tapped_time
+    with self._lock :
+      self.received += 1
+      last = self._seen.get(idm)
+      self._seen[idm] = now
+      if last is not None and now - last < self._window :
+        self.suppressed += 1
+        logger.debug(f'Tap suppressed idm:{idm} {now - last:.3f}s after last tap.')
+        return False
+      # 期限切れの記録を捨てる
+      for key in [key for key, t in self._seen.items() if now - t >= self._window and key != idm] :
+        del self._seen[key]
+    try :
+      self._queue.put_nowait(Tap(idm, now))
+    except queue.Full :
+      self.overflowed += 1
+      logger.warning(f'Tap queue is full. idm:{idm} was dropped.')
+      return False
+    return True
+
+  def forget(self, idm: str | None = None) :
+    """ 重複判定の記録を消す。idm が None の場合は全て """
+    with self._lock :
+      if idm is None :
+        self._seen.clear()
+      else :
+        self._seen.pop(idm, None)
+
+  def record_published(self, idm: str, published_time: float | None = None) -> float | None :
+    """ タッチから entry 送信までの時間を記録して返す """
+    published_time = time.monotonic() if published_time is None else published_time
+    with self._lock :
+      tapped_time = self._pending.pop(idm, None)
+    if tapped_time is None :
+      return None
+    latency = published_time - tapped_time
+    self.latencies.append(latency)
+    logger.info(f'Tap to entry publish latency idm:{idm} {latency * 1000:.1f}ms.')
+    return latency
+
+  def stats(self) -> dict :
+    latencies = sorted(self.latencies)
+    result = {
+        'received': self.received,
+        'suppressed': self.suppressed,
+        'overflowed': self.overflowed,
+        'queued': self._queue.qsize(),
+        'latency_count': len(latencies),
+    }
+    if latencies :
+      result['latency_last'] = self.latencies[-1]
+      result['latency_median'] = latencies[len(latencies) // 2]
+      result['latency_max'] = latencies[-1]
+    return result
+
+  def run(self) -> None:
+    logger.debug(f'TapQueue.run()')
+    while self.should_keep_running() :
+      try :
+        tap = self._queue.get(timeout=0.5)
+      except queue.Empty :
+        continue
+      with self._lock :
+        # entry を送信しなかったタッチの記録を捨てる
+        for key in [key for key, t in self._pending.items() if tap.tapped_time - t > 60.0] :
+          del self._pending[key]
+        self._pending[tap.idm] = tap.tapped_time
+      try :
+        self._handler(tap)
+      except Exception :
+        logger.exception(f'TapQueue handler error. {tap}')
+    logger.debug(f'TapQueue.fin()')
+
+
 if __name__ == '__main__':
 
   import argparse
-  import logging
-  import os
   import signal
-  import sys
   import application
 
   def termed(signum, frame):
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 登録済みFeliCaカードの一覧
+
+felica.csv を一度だけ読み込んで idm をキーにした dict に保持する。
+ファイルの mtime/inode/サイズ が変わった場合 (またはファイル監視で変更を
+検出した場合) にだけ読み直す。
+
+CSVの形式
+  1行目に見出し行 (idm, mode, expiry, room) がある場合は、見出しの列を読む。
+  (idm 以外の列は省略可。列の順番は問わない)
+  * mode   : 診療モード。省略時は 'continueus'
+  * expiry : 有効期限。ISO形式の日付または日時。省略時は無期限
+  * room   : 使用できるブースのデバイスID。省略時は全てのブース
+
+  見出し行が無い場合は従来の形式として1列目の idm だけを読み、2列目以降
+  (備考など) は無視する。
+
+多数のブースで共有する大きな一覧は、save_snapshot() で作成したバイナリ形式の
+ファイルをそのまま指定できる。(先頭のマジックナンバーで判別する)
+"""
+import csv
+from datetime import datetime
+from logging import getLogger
+import os
+import struct
+from threading import Lock
+import time
+
+from . import lazy
+
+# ファイル監視を使用する場合のみ読み込む
+fwatchdog = lazy.load(f'{__package__}.fwatchdog', 'portable')
+
+logger = getLogger(__name__)
+
+DEFAULT_MODE = 'continueus'
+
+SNAPSHOT_MAGIC = b'FLCR'
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('!4sHI')   # magic, version, count
+_SNAPSHOT_RECORD = struct.Struct('!8sqBB')  # idm, expiry, len(mode), len(room)
+
+
+class Card :
+  """ 登録済みカード1枚分の情報 """
+  __slots__ = ('idm', 'mode', 'expiry', 'room')
+
+  def __init__(self, idm: str, mode: str | None = DEFAULT_MODE,
+               expiry: float | None = None, room: str | None = None) :
+    self.idm = idm
+    self.mode = mode
+    self.expiry = expiry
+    self.room = room
+
+  def is_valid(self, now: float | None = None, room: str | None = None) -> bool :
+    """ 有効期限内で、room で使用できるカードか """
+    if self.expiry is not None :
+      if (time.time() if now is None else now) >= self.expiry :
+        return False
+    if self.room and room is not None and self.room != room :
+      return False
+    return True
+
+  def __eq__(self, other) :
+    if not isinstance(other, Card) :
+      return NotImplemented
+    return (self.idm, self.mode, self.expiry, self.room) \
+        == (other.idm, other.mode, other.expiry, other.room)
+
+  def __repr__(self) :
+    return f'Card(idm={self.idm!r}, mode={self.mode!r}, expiry={self.expiry!r}, room={self.room!r})'
+
+
+def normalize_idm(idm) -> str :
+  """ idm を区切り文字なしの大文字16進数の文字列にする """
+  if isinstance(idm, (bytes, bytearray)) :
+    return bytes(idm).hex().upper()
+  return str(idm).strip().replace(':', '').replace('-', '').upper()
+
+
+def _parse_expiry(value: str) -> float | None :
+  value = value.strip()
+  if not value :
+    return None
+  expiry = datetime.fromisoformat(value)
+  if len(value) <= 10 :
+    # 日付だけの場合はその日の終わりまで有効
+    return expiry.timestamp() + 24 * 60 * 60
+  return expiry.timestamp()
+
+
+HEADER_COLUMNS = ('idm', 'mode', 'expiry', 'room')
+
+
+def load_csv(path) -> dict :
+  cards = {}
+  # 見出し行で指定された列の位置。None の場合は従来の形式 (idm のみ)
+  columns = None
+  with open(path, newline='', encoding='utf-8-sig') as csvfile :
+    for line, row in enumerate(csv.reader(csvfile, dialect='excel'), 1) :
+      if not row or not row[0].strip() or row[0].lstrip().startswith('#') :
+        continue
+      if not cards and columns is None and row[0].strip().lower() == 'idm' :
+        columns = {name.strip().lower() : i for i, name in enumerate(row)
+                   if name.strip().lower() in HEADER_COLUMNS}
+        continue
+
+      idm = normalize_idm(row[0])
+      if columns is None :
+        cards[idm] = Card(idm)
+        continue
+
+      def column(name) -> str :
+        i = columns.get(name)
+        return row[i].strip() if i is not None and i < len(row) else ''
+
+      try :
+        cards[idm] = Card(idm, column('mode') or DEFAULT_MODE,
+                          _parse_expiry(column('expiry')), column('room') or None)
+      except ValueError :
+        logger.warning(f'{path}:{line} invalid row {row}. use idm only.')
+        cards[idm] = Card(idm)
+  return cards
+
+
+def load_snapshot(path) -> dict :
+  with open(path, 'rb') as f :
+    data = f.read()
+
+  magic, version, count = _SNAPSHOT_HEADER.unpack_from(data, 0)
+  if magic != SNAPSHOT_MAGIC :
+    raise ValueError(f'{path} is not a FeliCa snapshot.')
+  if version != SNAPSHOT_VERSION :
+    raise ValueError(f'{path} unsupported snapshot version {version}.')
+
+  cards = {}
+  offset = _SNAPSHOT_HEADER.size
+  view = memoryview(data)
+  for _ in range(count) :
+    idm, expiry, mode_len, room_len = _SNAPSHOT_RECORD.unpack_from(data, offset)
+    offset += _SNAPSHOT_RECORD.size
+    mode = str(view[offset:offset + mode_len], 'utf-8') or None
+    offset += mode_len
+    room = str(view[offset:offset + room_len], 'utf-8') or None
+    offset += room_len
+    idm = idm.hex().upper()
+    cards[idm] = Card(idm, mode, expiry if expiry else None, room)
+  return cards
+
+
+def save_snapshot(cards, path) :
+  """ cards (dict または Card のリスト) をバイナリ形式で保存する。
+
+  読み込み中のブースが中途半端なファイルを読まないよう、一時ファイルに
+  書いてから置き換える。
+  """
+  if isinstance(cards, dict) :
+    cards = cards.values()
+  cards = list(cards)
+
+  chunks = [_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(cards))]
+  for card in cards :
+    mode = (card.mode or '').encode('utf-8')
+    room = (card.room or '').encode('utf-8')
+    expiry = int(card.expiry) if card.expiry else 0
+    idm = bytes.fromhex(card.idm)
+    if len(idm) != 8 or len(mode) > 255 or len(room) > 255 :
+      raise ValueError(f'{card} can not be saved in a snapshot.')
+    chunks.append(_SNAPSHOT_RECORD.pack(idm, expiry, len(mode), len(room)))
+    chunks.append(mode)
+    chunks.append(room)
+
+  tmp = f'{path}.tmp'
+  with open(tmp, 'wb') as f :
+    f.write(b''.join(chunks))
+  os.replace(tmp, path)
+
+
+def load(path) -> dict :
+  """ CSVまたはバイナリ形式のファイルを読み込む """
+  with open(path, 'rb') as f :
+    magic = f.read(len(SNAPSHOT_MAGIC))
+  if magic == SNAPSHOT_MAGIC :
+    return load_snapshot(path)
+  return load_csv(path)
+
+
+def _create_watcher(registry, path) :
+  """ 変更を検出したら registry を読み直す fwatchdog.Observer """
+  class _Watcher(fwatchdog.Observer) :
+    def on_any_event(self, event) :
+      registry.reload()
+      self.clear()
+
+  return _Watcher(os.path.abspath(path), daemon=True)
+
+
+class Registry :
+  """ 登録済みFeliCaカードの一覧
+
+  lookup() はファイルの状態 (mtime/inode/サイズ) を確認し、変わっていなければ
+  読み込み済みの dict を引くだけなので、タッチのたびにファイルを読み直さない。
+  読み込みに失敗した場合は直前の一覧を使い続ける。
+  """
+  def __init__(self, path, *, check_interval: float = 1.0) :
+    self._path = path
+    self._check_interval = check_interval
+    self._lock = Lock()
+    self._cards = {}
+    self._signature = None
+    self._checked = 0.0
+    self._watcher = None
+    self.loaded_time = None
+
+  @property
+  def path(self) :
+    return self._path
+
+  def __len__(self) :
+    self._refresh()
+    return len(self._cards)
+
+  def __contains__(self, idm) :
+    return self.lookup(idm) is not None
+
+  def _stat(self) :
+    try :
+      st = os.stat(self._path)
+    except FileNotFoundError :
+      return None
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+  def _refresh(self) :
+    now = time.monotonic()
+    if self._watcher is None or not self._watcher.is_alive() :
+      if self._signature is not None and now - self._checked < self._check_interval :
+        return
+    elif self._checked :
+      # ファイル監視中は変更の通知があったときだけ読み直す
+      return
+    self.reload(now)
+
+  def reload(self, now: float | None = None) -> bool :
+    """ ファイルが変わっていれば読み直す。読み直した場合は True を返す """
+    with self._lock :
+      self._checked = time.monotonic() if now is None else now
+      signature = self._stat()
+      if signature == self._signature :
+        return False
+
+      if signature is None :
+        if self._cards :
+          logger.info(f'{self._path} was removed.')
+        self._cards = {}
+      else :
+        try :
+          started = time.perf_counter()
+          self._cards = load(self._path)
+          logger.info(
+              f'{self._path} loaded {len(self._cards)} cards '
+              f'in {(time.perf_counter() - started) * 1000:.1f}ms.')
+        except Exception :
+          # 書き込み途中などで読めなかった場合は、次の確認で読み直す
+          logger.exception(f'{self._path} load failed.')
+          return False
+      self._signature = signature
+      self.loaded_time = time.time()
+      return True
+
+  def invalidate(self) :
+    """ 次の lookup() でファイルを確認させる """
+    self._checked = 0.0
+
+  def lookup(self, idm, *, room: str | None = None, now: float | None = None) -> Card | None :
+    """ 有効な登録カードを返す。登録されていない、または期限切れの場合は None """
+    self._refresh()
+    card = self._cards.get(normalize_idm(idm))
+    if card is None or not card.is_valid(now, room) :
+      return None
+    return card
+
+  def mode_of(self, idm, *, room: str | None = None, default=None) :
+    """ 登録カードの診療モードを返す """
+    card = self.lookup(idm, room=room)
+    return card.mode if card else default
+
+  def watch(self) -> bool :
+    """ ファイル監視で変更を検出する。監視を開始できなかった場合は False """
+    if self._watcher is not None :
+      return True
+    directory = os.path.dirname(os.path.abspath(self._path))
+    if not os.path.isdir(directory) :
+      return False
+    try :
+      self._watcher = _create_watcher(self, self._path)
+      self._watcher.start()
+    except Exception :
+      logger.exception(f'{self._path} watch failed. fallback to polling.')
+      self._watcher = None
+      return False
+    self.reload()
+    return True
+
+  def close(self) :
+    if self._watcher is not None :
+      self._watcher.stop()
+      self._watcher.join(timeout=5.0)
+      self._watcher = None
+
+
+if __name__ == '__main__' :
+  import argparse
+  import logging
+
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s : %(message)s')
+
+  argp = argparse.ArgumentParser(description='FeliCa registry tools.')
+  argp.add_argument('source', help='felica.csv or snapshot file')
+  argp.add_argument('-o', '--output', help='write binary snapshot')
+  argp.add_argument('-l', '--lookup', nargs='*', default=[], help='idm to lookup')
+  args = argp.parse_args()
+
+  cards = load(args.source)
+  print(f'{len(cards)} cards')
+  if args.output :
+    save_snapshot(cards, args.output)
+    print(f'saved {args.output}')
+  registry = Registry(args.source)
+  for idm in args.lookup :
+    print(idm, registry.lookup(idm))
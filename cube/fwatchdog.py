@@ -12,6 +12,8 @@ from threading import Thread
 from threading import Event, Lock
 import time
 
+from cube import events
+
 logger = getLogger(__name__)
 logger.setLevel(DEBUG)
 
@@ -37,10 +39,20 @@ def is_moved(event: FileSystemEvent):
   return (event.event_type == EVENT_TYPE_MOVED)
 
 
+class FileChanged(events.Event) :
+  """ 監視しているファイルが変化した (event は watchdog の FileSystemEvent) """
+  __slots__ = ('observer', 'event')
+
+  def __init__(self, observer, event: FileSystemEvent) :
+    self.observer = observer
+    self.event = event
+
+
 class Observer(Thread):
 
-  def __init__(self, filepath, recursive: bool = False, fixed_interval: float = 0.1, *, daemon=None):
+  def __init__(self, filepath, recursive: bool = False, fixed_interval: float = 0.1, *, daemon=None, bus=None):
     super().__init__(daemon=daemon)
+    self._bus = bus or events.BUS
     if os.path.isdir(filepath):
       dirname = filepath
       filename = '*'
@@ -192,6 +204,8 @@ class Observer(Thread):
       self.on_moved_event.set()
       self.on_moved(self._file_system_event)
 
+    self._bus.publish(FileChanged(self, event))
+
   def _file_event_set(self, event:FileSystemEvent) :
     if not isinstance(event, FileSystemEvent) :
       raise ValueError(f'event is not FileSystemEvent. event was {event}')
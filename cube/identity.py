@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 機器の識別情報 (デバイスID, MACアドレス, IPアドレス)
+
+起動時に一度だけネットワークインターフェースを調べて保持する。
+ネットワークの変更 (Linux は netlink の通知、それ以外は定期的な確認) を
+検出した場合にだけ調べ直す。
+
+共有する状態を持つので、他のモジュールからは `from cube import identity` で参照すること。
+"""
+from logging import getLogger
+import os
+import select
+import socket
+from threading import Lock
+import time
+
+import utils
+
+logger = getLogger(__name__)
+
+# 優先して使用するインターフェース
+PREFERRED_INTERFACE = 'eth0'
+# netlink が使えない場合にネットワークの変更を確認する間隔 (秒)
+REFRESH_INTERVAL = 60.0
+# netlink の通知が続く間は、落ち着くまで待ってから調べ直す (秒)
+SETTLE_TIME = 0.5
+
+# linux/rtnetlink.h
+_RTMGRP_LINK = 0x1
+_RTMGRP_IPV4_IFADDR = 0x10
+
+
+class Identity(object) :
+  """ 機器の識別情報 """
+  __slots__ = ('device_id', 'mac', 'ip_addr', 'interface', 'addresses')
+
+  def __init__(self, device_id, mac=None, ip_addr=None, interface=None, addresses=None) :
+    self.device_id = device_id
+    self.mac = mac
+    self.ip_addr = ip_addr
+    self.interface = interface
+    # {インターフェース名: IPv4アドレス}
+    self.addresses = addresses or {}
+
+  def __eq__(self, other) :
+    if not isinstance(other, Identity) :
+      return NotImplemented
+    return (self.device_id, self.mac, self.ip_addr, self.interface, self.addresses) \
+        == (other.device_id, other.mac, other.ip_addr, other.interface, other.addresses)
+
+  def __repr__(self) :
+    return f'Identity(device_id={self.device_id!r}, ip_addr={self.ip_addr!r}, interface={self.interface!r})'
+
+
+def _scan() -> Identity :
+  """ ネットワークインターフェースを調べる。
+
+  eth0 にIPv4アドレスがあれば eth0 を、無ければIPv4アドレスを持つ最初の
+  インターフェースを使用し、その MACアドレスをデバイスIDとする。
+  """
+  if os.name != 'posix' :
+    return Identity('deviceid')
+
+  import netifaces
+  selected = None
+  addresses = {}
+  for interface in netifaces.interfaces() :
+    ifaddress = netifaces.ifaddresses(interface)
+    ipv4 = ifaddress.get(netifaces.AF_INET)
+    if ipv4 is None :
+      continue
+    addresses[interface] = ipv4[0]['addr']
+    if selected is None or interface == PREFERRED_INTERFACE :
+      selected = (interface, ifaddress)
+
+  if selected is None :
+    logger.warning('No network interface has an IPv4 address.')
+    return Identity(None, addresses=addresses)
+
+  interface, ifaddress = selected
+  link = ifaddress.get(netifaces.AF_LINK)
+  mac = link[0]['addr'] if link else None
+  return Identity(mac, mac, addresses[interface], interface, addresses)
+
+
+_lock = Lock()
+_identity = None
+_daemon_device_id = None
+_listeners = []
+_monitor = None
+
+refresh_count = 0
+
+
+def refresh() -> bool :
+  """ インターフェースを調べ直す。変わっていた場合は True """
+  global _identity, _daemon_device_id, refresh_count
+  identity = _scan()
+  with _lock :
+    refresh_count += 1
+    previous = _identity
+    _identity = identity
+    if previous is not None and previous.mac != identity.mac :
+      # MACアドレスが変わった場合は tcud のデバイスIDも問い合わせ直す
+      _daemon_device_id = None
+    listeners = list(_listeners)
+  if previous == identity :
+    return False
+
+  logger.info(f'identity {identity}')
+  if previous is not None :
+    for listener in listeners :
+      try :
+        listener(identity)
+      except Exception :
+        logger.exception(f'identity listener error.')
+  return True
+
+
+def get() -> Identity :
+  """ 機器の識別情報。初回だけインターフェースを調べる """
+  identity = _identity
+  if identity is None :
+    refresh()
+    identity = _identity
+  return identity
+
+
+def interface_address(ifname) -> str | None :
+  """ インターフェースのIPv4アドレス """
+  return get().addresses.get(ifname)
+
+
+def add_listener(listener) :
+  """ 識別情報が変わったときに listener(identity) を呼び出す """
+  with _lock :
+    _listeners.append(listener)
+
+
+def remove_listener(listener) :
+  with _lock :
+    if listener in _listeners :
+      _listeners.remove(listener)
+
+
+def daemon_device_id(request) -> str | None :
+  """ tcud が管理するデバイスID。問い合わせは成功するまでの初回のみ行う
+
+  request(command) は tcud へ要求を送り (result, value) を返す関数。
+  呼び出し側のサーキットブレーカー・期限を通して問い合わせるために渡す。
+  """
+  global _daemon_device_id
+  device_id = _daemon_device_id
+  if device_id is not None :
+    return device_id
+
+  import tcu.constant
+  result, device_id = request("deviceid")
+  if result != tcu.constant.CODE_SUCCESS :
+    return None
+  _daemon_device_id = device_id
+  logger.info(f'daemon device id {device_id}')
+  return device_id
+
+
+class _Monitor(utils.BaseThread) :
+  """ ネットワークの変更を監視して識別情報を調べ直す """
+
+  def __init__(self, interval: float) :
+    super().__init__(daemon=True)
+    self.name = 'identity'
+    self._interval = interval
+
+  def _open_netlink(self) :
+    if not hasattr(socket, 'AF_NETLINK') :
+      return None
+    try :
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+      sock.bind((0, _RTMGRP_LINK | _RTMGRP_IPV4_IFADDR))
+      sock.setblocking(False)
+      return sock
+    except OSError :
+      logger.exception('netlink is not available. fallback to polling.')
+      return None
+
+  def run(self) -> None :
+    sock = self._open_netlink()
+    logger.info(f'identity monitor: {"netlink" if sock else "polling"}')
+    try :
+      checked = time.monotonic()
+      while self.should_keep_running() :
+        if sock is None :
+          if self.should_keep_running(self._interval) :
+            refresh()
+          continue
+
+        readable, _, _ = select.select([sock], [], [], 1.0)
+        if not readable :
+          # 通知を取りこぼした場合に備えて、定期的にも確認する
+          if self._interval <= time.monotonic() - checked :
+            refresh()
+            checked = time.monotonic()
+          continue
+        # 通知が続く間は読み捨てて、落ち着いてから調べ直す
+        while readable and self.should_keep_running() :
+          try :
+            sock.recv(65536)
+          except BlockingIOError :
+            pass
+          readable, _, _ = select.select([sock], [], [], SETTLE_TIME)
+        refresh()
+        checked = time.monotonic()
+    finally :
+      if sock :
+        sock.close()
+
+
+def start_monitor(interval: float = REFRESH_INTERVAL) :
+  """ ネットワークの変更の監視を開始する """
+  global _monitor
+  with _lock :
+    if _monitor is not None and _monitor.is_alive() :
+      return
+    _monitor = _Monitor(interval)
+    _monitor.start()
+
+
+def stop_monitor() :
+  global _monitor
+  with _lock :
+    monitor = _monitor
+    _monitor = None
+  if monitor is not None :
+    monitor.stop()
+    monitor.join(timeout=5.0)
+
+
+if __name__ == '__main__' :
+  import logging
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s : %(message)s')
+
+  t = time.perf_counter()
+  print(get(), f'{(time.perf_counter() - t) * 1000:.2f}ms')
+  t = time.perf_counter()
+  print(get(), f'{(time.perf_counter() - t) * 1000:.4f}ms (cached)')
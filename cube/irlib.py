@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NumPy版 IRコードの記録後処理とIRコードライブラリの取り込み
+
+irrp.py の compare(), tidy_mark_space() と同じ処理をNumPyの配列演算で行う。
+パルス幅は mark(偶数番目), space(奇数番目) ごとに許容誤差(tolerance %)の範囲で
+まとめ、加重平均した値に置き換える。
+
+normalise() は irrp.normalise() と結果が異なることがある。irrp.normalise() は
+コード中に現れた順に、先頭のパルス幅との比でまとめるが、こちらは tidy() と同じく
+短いパルス幅から順にまとめる。(E.g. space 640 560 500 は irrp では
+640,560 と 500 に、こちらでは 500,560 と 640 に分かれる)
+
+他のサイトで記録したIRコードライブラリ(irwave形式のJSON)を取り込み、
+許容誤差の範囲で同じコードを重複として除外することもできる。
+
+  python irlib.py --import site_a/irwave site_b/irwave -o irwave
+  python irlib.py --benchmark
+"""
+import json
+from logging import getLogger
+import time
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+TOLERANCE = 15
+
+
+def _toler(tolerance) :
+  return (100 - tolerance) / 100.0, (100 + tolerance) / 100.0
+
+
+def cluster(widths, weights=None, tolerance=TOLERANCE) :
+  """ パルス幅を許容誤差の範囲でまとめ、各パルス幅を加重平均値に置き換えた配列を返す。
+
+  短いパルス幅から順に、まとまりの先頭の値 v に対して v * (100 + tolerance)% 未満の
+  パルス幅を同じまとまりとする。(irrp.tidy_mark_space() と同じ規則)
+
+  E.g. 500x20 550x30 600x30  1000x10 1100x10  1700x5 1750x5
+       -> 556(x80) 1050(x20) 1725(x10)
+  """
+  widths = np.asarray(widths)
+  if widths.size == 0 :
+    return np.empty(0, dtype=np.int64)
+
+  unique, inverse, counts = np.unique(widths, return_inverse=True, return_counts=True)
+  if weights is not None :
+    counts = np.bincount(inverse, weights=weights, minlength=unique.size)
+
+  averages = np.rint(_average_clusters(unique, counts, tolerance)).astype(np.int64)
+  return averages[inverse.reshape(-1)]
+
+
+def _flatten(records) :
+  """ 記録をひとつの配列にまとめ、各要素が mark か space かの配列と共に返す。 """
+  names = list(records)
+  lengths = np.fromiter((len(records[name]) for name in names), dtype=np.int64, count=len(names))
+  if lengths.sum() == 0 :
+    return names, lengths, np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+  flat = np.concatenate([np.asarray(records[name], dtype=np.int64) for name in names if len(records[name])])
+  offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+  is_space = ((np.arange(flat.size) - offsets) & 1).astype(bool)
+  return names, lengths, flat, is_space
+
+
+def tidy(records, tolerance=TOLERANCE) :
+  """ 全ての記録の mark と space をそれぞれまとめる。(irrp.tidy() と同じ)
+  records は書き換えられる。
+  """
+  names, lengths, flat, is_space = _flatten(records)
+  if flat.size == 0 :
+    return records
+
+  flat[~is_space] = cluster(flat[~is_space], tolerance=tolerance)
+  flat[is_space] = cluster(flat[is_space], tolerance=tolerance)
+
+  for name, values in zip(names, np.split(flat, np.cumsum(lengths)[:-1])) :
+    records[name] = values.tolist()
+  return records
+
+
+def normalise(code, tolerance=TOLERANCE) :
+  """ 1つのコードの mark と space をそれぞれまとめて平均値に置き換える。
+  code は書き換えられる。
+
+  まとめ方は cluster() と同じ (短いパルス幅から順)。irrp.normalise() の
+  出現順のまとめ方とは異なる。
+  """
+  values = np.asarray(code, dtype=np.float64)
+  if values.size == 0 :
+    return code
+  result = np.empty_like(values)
+  for base in (0, 1) :
+    part = values[base::2]
+    unique, inverse, counts = np.unique(part, return_inverse=True, return_counts=True)
+    averaged = _average_clusters(unique, counts, tolerance)
+    result[base::2] = averaged[inverse.reshape(-1)]
+  code[:] = np.round(result, 2).tolist()
+  return code
+
+
+def normalise_batch(records, tolerance=TOLERANCE) :
+  """ 全てのコードをまとめて normalise() する。records は書き換えられる。
+
+  コードごと、mark/spaceごとのグループを1つの配列に並べ、全グループの
+  まとまりの境界を同時に二分探索で求める。(繰り返しはまとまりの数だけ)
+  """
+  names, lengths, flat, is_space = _flatten(records)
+  if flat.size == 0 :
+    return records
+
+  record_index = np.repeat(np.arange(len(names)), lengths)
+  group = record_index * 2 + is_space
+  values = flat.astype(np.float64)
+
+  # グループ, パルス幅 の順に並べる
+  scale = (values.max() + 1.0) * 2.0
+  keys, inverse, counts = np.unique(group * scale + values, return_inverse=True, return_counts=True)
+  unique_group = np.floor(keys / scale)
+  unique_value = keys - unique_group * scale
+
+  group_start = np.flatnonzero(np.r_[True, unique_group[1:] != unique_group[:-1]])
+  group_end = np.r_[group_start[1:], keys.size]
+
+  _, toler_max = _toler(tolerance)
+  starts = [group_start]
+  current = group_start
+  end = group_end
+  while current.size :
+    limit = unique_group[current] * scale + unique_value[current] * toler_max
+    following = np.maximum(current + 1, np.searchsorted(keys, limit, side='left'))
+    active = following < end
+    current = following[active]
+    end = end[active]
+    starts.append(current)
+  starts = np.sort(np.concatenate(starts))
+
+  averages = np.add.reduceat(unique_value * counts, starts) / np.add.reduceat(counts, starts)
+  labels = np.repeat(np.arange(starts.size), np.diff(np.append(starts, keys.size)))
+  result = np.round(averages[labels][inverse.reshape(-1)], 2)
+
+  for name, values in zip(names, np.split(result, np.cumsum(lengths)[:-1])) :
+    records[name][:] = values.tolist()
+  return records
+
+
+def _average_clusters(unique, counts, tolerance) :
+  """ 昇順のパルス幅 unique をまとめ、各要素をまとまりの加重平均値に置き換える。 """
+  _, toler_max = _toler(tolerance)
+
+  # まとまりの境界は先頭の値で決まるため、二分探索で次の先頭を求める
+  starts = []
+  start = 0
+  while start < unique.size :
+    starts.append(start)
+    start = max(start + 1, int(np.searchsorted(unique, unique[start] * toler_max, side='left')))
+  starts = np.asarray(starts)
+
+  averages = np.add.reduceat(unique * counts, starts) / np.add.reduceat(counts, starts)
+  labels = np.repeat(np.arange(starts.size), np.diff(np.append(starts, unique.size)))
+  return averages[labels]
+
+
+def compare(p1, p2, tolerance=TOLERANCE) :
+  """ 2回の記録が各パルスとも許容誤差の範囲で一致すれば、平均したコードを返す。
+  一致しなければNoneを返す。
+  """
+  a1 = np.asarray(p1, dtype=np.float64)
+  a2 = np.asarray(p2, dtype=np.float64)
+  if a1.shape != a2.shape :
+    return None
+
+  toler_min, toler_max = _toler(tolerance)
+  with np.errstate(divide='ignore', invalid='ignore') :
+    ratio = a1 / a2
+  if not np.all((toler_min <= ratio) & (ratio <= toler_max)) :
+    return None
+
+  return np.rint((a1 + a2) / 2.0).astype(np.int64).tolist()
+
+
+def match(codes, code, tolerance=TOLERANCE) :
+  """ codes (n x L の配列) のうち、code と許容誤差の範囲で一致する行のインデックス """
+  codes = np.asarray(codes, dtype=np.float64)
+  if codes.size == 0 :
+    return np.empty(0, dtype=np.int64)
+  toler_min, toler_max = _toler(tolerance)
+  with np.errstate(divide='ignore', invalid='ignore') :
+    ratio = codes / np.asarray(code, dtype=np.float64)
+  return np.flatnonzero(np.all((toler_min <= ratio) & (ratio <= toler_max), axis=1))
+
+
+def dedupe(records, tolerance=TOLERANCE) :
+  """ 許容誤差の範囲で同じコードを除外する。先に現れた名前を残す。
+
+  同じ長さのコードどうしでのみ比較し、長さごとに配列演算でまとめて判定する。
+  戻り値は (残したコード, {除外した名前: 残した名前})
+  """
+  kept = {}
+  duplicates = {}
+  groups = {}
+  for name, code in records.items() :
+    groups.setdefault(len(code), []).append(name)
+
+  for length, names in groups.items() :
+    matrix = np.asarray([records[name] for name in names], dtype=np.float64)
+    kept_rows = []
+    for i, name in enumerate(names) :
+      found = match(matrix[kept_rows], matrix[i], tolerance) if kept_rows else []
+      if len(found) :
+        duplicates[name] = names[kept_rows[found[0]]]
+      else :
+        kept_rows.append(i)
+        kept[name] = records[name]
+
+  return kept, duplicates
+
+
+def import_libraries(libraries, tolerance=TOLERANCE, *, normalise_all=True) :
+  """ 複数のIRコードライブラリを1つにまとめる。
+
+  libraries は {サイト名: irwave形式のdict} または irwave ファイルのパスのリスト。
+  名前が同じで内容が異なるコードは "名前@サイト名" として取り込む。
+  normalise_all が True の場合は、まとめた後に全体を normalise_batch() と tidy() する。
+  """
+  if not isinstance(libraries, dict) :
+    loaded = {}
+    for path in libraries :
+      with open(path, 'r') as f :
+        loaded[str(path)] = json.load(f)
+    libraries = loaded
+
+  merged = {}
+  for site, records in libraries.items() :
+    for name, code in records.items() :
+      if name in merged and compare(merged[name], code, tolerance) is None :
+        name = f"{name}@{site}"
+      merged.setdefault(name, list(code))
+
+  merged, duplicates = dedupe(merged, tolerance)
+  if duplicates :
+    logger.info(f"irlib import: {len(duplicates)} duplicated codes were removed.")
+
+  if normalise_all :
+    normalise_batch(merged, tolerance)
+    tidy(merged, tolerance)
+  return merged, duplicates
+
+
+def save(records, path) :
+  """ irrp.py と同じ形式で保存する。 """
+  with open(path, 'w') as f :
+    f.write(json.dumps(records, sort_keys=True).replace("],", "],\n")+"\n")
+
+
+# ##############################################################################
+# benchmark
+# ##############################################################################
+def _generate(num_records, length, seed=0) :
+  """ NEC形式に似たランダムなIRコードを生成する。 """
+  rng = np.random.default_rng(seed)
+  records = {}
+  for n in range(num_records) :
+    marks = rng.choice([9000, 560], size=(length + 1) // 2, p=[0.05, 0.95])
+    spaces = rng.choice([4500, 560, 1690], size=length // 2, p=[0.05, 0.5, 0.45])
+    code = np.empty(length, dtype=np.int64)
+    code[0::2] = marks
+    code[1::2] = spaces
+    jitter = rng.uniform(0.95, 1.05, size=length)
+    records[f"key{n}"] = np.rint(code * jitter).astype(np.int64).tolist()
+  return records
+
+
+def benchmark(num_records=200, length=67, repeat=3) :
+  """ irrp.py の処理と所要時間を比較する。 """
+  import copy
+  import irrp
+
+  records = _generate(num_records, length)
+
+  def _time(func) :
+    best = None
+    for _ in range(repeat) :
+      data = copy.deepcopy(records)
+      t = time.perf_counter()
+      func(data)
+      elapsed = time.perf_counter() - t
+      best = elapsed if best is None else min(best, elapsed)
+    return best
+
+  def _normalise_all(func) :
+    def _run(data) :
+      for code in data.values() :
+        func(code)
+    return _run
+
+  def _compare_all(func) :
+    def _run(data) :
+      codes = list(data.values())
+      for p1, p2 in zip(codes, codes[1:] + codes[:1]) :
+        func(list(p1), p2)
+    return _run
+
+  results = {
+    'normalise' : (_time(_normalise_all(irrp.normalise)), _time(_normalise_all(normalise))),
+    'normalise (batch)' : (_time(_normalise_all(irrp.normalise)), _time(normalise_batch)),
+    'compare' : (_time(_compare_all(irrp.compare)), _time(_compare_all(compare))),
+    'tidy' : (_time(irrp.tidy), _time(tidy)),
+  }
+
+  expected = copy.deepcopy(records)
+  irrp.tidy(expected)
+  actual = tidy(copy.deepcopy(records))
+  same = expected == actual
+
+  batch = normalise_batch(copy.deepcopy(records))
+  single = {name : normalise(list(code)) for name, code in records.items()}
+  same_batch = batch == single
+
+  print(f"records {num_records} length {length} (best of {repeat})")
+  for name, (python, numpy) in results.items() :
+    print(f"  {name:<18} python {python*1000:9.3f} ms  numpy {numpy*1000:9.3f} ms  x{python/numpy:0.1f}")
+  print(f"  tidy results are identical : {same}")
+  print(f"  normalise batch results are identical : {same_batch}")
+  return results
+
+
+if __name__ == '__main__':
+
+  import argparse
+  import logging
+
+  logging.basicConfig(level=logging.INFO, format=None)
+
+  argp = argparse.ArgumentParser()
+  argg = argp.add_mutually_exclusive_group(required=True)
+  argg.add_argument("--benchmark", help="compare with irrp.py", action="store_true")
+  argg.add_argument("--import", dest="libraries", nargs='+', help="irwave files to import")
+
+  argp.add_argument("-o", "--output", type=str, default=None)
+  argp.add_argument("--records", type=int, default=200)
+  argp.add_argument("--length", type=int, default=67)
+  argp.add_argument("--tolerance", type=int, default=TOLERANCE)
+
+  args = argp.parse_args()
+
+  if args.benchmark :
+    benchmark(args.records, args.length)
+  else :
+    merged, duplicates = import_libraries(args.libraries, args.tolerance)
+    for name, kept in duplicates.items() :
+      print(f"{name} -> {kept}")
+    print(f"{len(merged)} codes")
+    if args.output :
+      save(merged, args.output)
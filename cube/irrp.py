@@ -61,6 +61,7 @@ import json
 import os
 import argparse
 
+from concurrent.futures import ThreadPoolExecutor
 import threading
 
 import pigpio # http://abyz.co.uk/rpi/pigpio/python.html
@@ -417,7 +418,13 @@ def recording(id) :
         pi.set_glitch_filter(GPIO_IR_RECV, 0) # Cancel glitch filter.
         pi.set_watchdog(GPIO_IR_RECV, 0) # Cancel watchdog.
 
-        tidy(records)
+        try:
+            # 記録時だけ numpy を読み込む (numpy が無い環境では irrp.py だけで処理する)
+            import irlib
+        except ImportError:
+            tidy(records)
+        else:
+            irlib.tidy(records, TOLERANCE)
 
         backup(FILE)
 
@@ -428,96 +435,203 @@ def recording(id) :
     finally :
         pi.stop() # Disconnect from Pi.
 
+class Transmitter(object):
+    """
+    IR transmitter service.
+
+    The code library is loaded once and reloaded when the file's
+    mtime changes.  One pigpio connection is kept open and the
+    compiled wave ids of each code are cached across calls, so a
+    transmit only costs the transmit time.
+
+    transmit() is non-blocking and returns a future which completes
+    when the codes have been sent.
+    """
+
+    def __init__(self, filename=None, gpio=GPIO_IR_WAVE, port=GPIO_IR_PORT):
+        self._filename = filename
+        self._gpio = gpio
+        self._port = port
+
+        self._records = {}
+        self._mtime = None
+
+        self._pi = None
+        self._chains = {}     # code id -> wave chain
+        self._marks_wid = {}  # mark length -> wave id
+        self._spaces_wid = {} # space length -> wave id
+
+        self._emit_time = 0.0
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="irrp")
+
+    def _load(self):
+        """
+        (Re)load the code library if the file has changed.
+        """
+        filename = self._filename if self._filename else FILE
+        mtime = os.stat(filename).st_mtime_ns
+        if mtime != self._mtime:
+            with open(filename, "r") as f:
+                records = json.load(f)
+            self._records = records
+            self._mtime = mtime
+            self._clear_waves()
+            if VERBOSE:
+                print("Loaded {} codes from {}".format(len(records), filename))
+
+    def _connect(self):
+        if self._pi is not None and self._pi.connected:
+            return self._pi
+
+        self._pi = pigpio.pi() # Connect to Pi.
+
+        if not self._pi.connected:
+            self._pi = None
+            raise ConnectionError("Can't connect to pigpio daemon")
+
+        self._pi.set_mode(self._gpio, pigpio.OUTPUT) # IR TX connected to this GPIO.
+
+        self._pi.set_mode(self._port, pigpio.OUTPUT) # IR TX connected to this GPIO.
+
+        # Forget the wave ids of a previous connection.  They may already
+        # belong to another client if the daemon has been restarted.
+        self._chains = {}
+        self._marks_wid = {}
+        self._spaces_wid = {}
+
+        return self._pi
+
+    def _clear_waves(self):
+        """
+        Delete the waves created by this transmitter.  wave_clear() is
+        not used because it would also delete other pigpio clients' waves.
+        """
+        if self._pi is not None and self._pi.connected:
+            for wid in set(self._marks_wid.values()) | set(self._spaces_wid.values()):
+                try:
+                    self._pi.wave_delete(wid)
+                except pigpio.error:
+                    pass
+            self._pi.wave_add_new() # Discard pulses of a half compiled code.
+        self._chains = {}
+        self._marks_wid = {}
+        self._spaces_wid = {}
+
+    def _compile(self, code):
+        """
+        Create (or reuse) the waves making up the code.
+        """
+        pi = self._pi
+
+        wave = [0]*len(code)
+
+        for i in range(0, len(code)):
+            ci = code[i]
+            if i & 1: # Space
+                if ci not in self._spaces_wid:
+                    pi.wave_add_generic([pigpio.pulse(0, 0, ci)])
+                    self._spaces_wid[ci] = pi.wave_create()
+                wave[i] = self._spaces_wid[ci]
+            else: # Mark
+                if ci not in self._marks_wid:
+                    wf = carrier(self._gpio, FREQ, ci)
+                    pi.wave_add_generic(wf)
+                    self._marks_wid[ci] = pi.wave_create()
+                wave[i] = self._marks_wid[ci]
+
+        return wave
+
+    def _chain(self, arg):
+        chain = self._chains.get(arg)
+        if chain is None:
+            code = self._records[arg]
+            try:
+                chain = self._compile(code)
+            except pigpio.error:
+                # Out of wave resources, start again from scratch.
+                self._clear_waves()
+                chain = self._compile(code)
+            self._chains[arg] = chain
+        return chain
+
+    def _transmit(self, id):
+        with self._lock:
+            self._load()
+            pi = self._connect()
+
+            pi.write(self._port, pigpio.HIGH)
+            try:
+                for arg in id:
+                    if arg not in self._records:
+                        print("Id {} not found".format(arg))
+                        continue
+
+                    chain = self._chain(arg)
+
+                    delay = self._emit_time - time.time()
+                    if delay > 0.0:
+                        time.sleep(delay)
+
+                    pi.wave_chain(chain)
+
+                    if VERBOSE:
+                        print("key " + arg)
+
+                    # Sleep for the length of the code, then wait for the tail.
+                    time.sleep(sum(self._records[arg]) / 1000000.0)
+                    while pi.wave_tx_busy():
+                        time.sleep(0.002)
+
+                    self._emit_time = time.time() + GAP_S
+            finally:
+                pi.write(self._port, pigpio.LOW)
+
+    def transmit(self, id):
+        """
+        Transmit the codes in the background and return a future.
+        """
+        return self._executor.submit(self._transmit, list(id))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            if self._pi is not None:
+                try:
+                    if self._pi.connected:
+                        self._clear_waves()
+                        self._pi.write(self._port, pigpio.LOW)
+                finally:
+                    self._pi.stop() # Disconnect from Pi.
+                    self._pi = None
+
+_transmitter = None
+_transmitter_lock = threading.Lock()
+
+def get_transmitter():
+    global _transmitter
+    with _transmitter_lock:
+        if _transmitter is None:
+            _transmitter = Transmitter()
+        return _transmitter
+
+def close():
+    global _transmitter
+    with _transmitter_lock:
+        if _transmitter is not None:
+            _transmitter.close()
+            _transmitter = None
+
 def playback(id) :
 
     try:
-        f = open(FILE, "r")
-    except:
+        get_transmitter().transmit(id).result()
+    except FileNotFoundError:
         print("Can't open: {}".format(FILE))
-        exit(0)
-
-    records = json.load(f)
-
-    f.close()
-
-    try :
-        pi = pigpio.pi() # Connect to Pi.
-
-        if not pi.connected:
-           exit(0)
-
-        pi.set_mode(GPIO_IR_WAVE, pigpio.OUTPUT) # IR TX connected to this GPIO.
-
-        pi.set_mode(GPIO_IR_PORT, pigpio.OUTPUT) # IR TX connected to this GPIO.
-
-        pi.write(GPIO_IR_PORT, pigpio.HIGH)
-
-        pi.wave_add_new()
-
-        emit_time = time.time()
-
-        if VERBOSE:
-            print("Playing")
-
-        for arg in id:
-            if arg in records:
-
-                code = records[arg]
-
-                # Create wave
-
-                marks_wid = {}
-                spaces_wid = {}
-
-                wave = [0]*len(code)
-
-                for i in range(0, len(code)):
-                    ci = code[i]
-                    if i & 1: # Space
-                        if ci not in spaces_wid:
-                            pi.wave_add_generic([pigpio.pulse(0, 0, ci)])
-                            spaces_wid[ci] = pi.wave_create()
-                        wave[i] = spaces_wid[ci]
-                    else: # Mark
-                        if ci not in marks_wid:
-                            wf = carrier(GPIO_IR_WAVE, FREQ, ci)
-                            pi.wave_add_generic(wf)
-                            marks_wid[ci] = pi.wave_create()
-                        wave[i] = marks_wid[ci]
-
-                delay = emit_time - time.time()
-
-                # for w in wave :
-                #     print(w)
-
-                if delay > 0.0:
-                    time.sleep(delay)
-
-                pi.wave_chain(wave)
-
-                if VERBOSE:
-                    print("key " + arg)
-
-                while pi.wave_tx_busy():
-                    time.sleep(0.002)
-
-                emit_time = time.time() + GAP_S
-
-                for i in marks_wid:
-                    pi.wave_delete(marks_wid[i])
-
-                marks_wid = {}
-
-                for i in spaces_wid:
-                    pi.wave_delete(spaces_wid[i])
-
-                spaces_wid = {}
-            else:
-                print("Id {} not found".format(arg))
-    finally :
-        pi.write(GPIO_IR_PORT, pigpio.LOW)
-
-        pi.stop() # Disconnect from Pi.
+    except ConnectionError:
+        print("Can't connect to pigpio daemon")
 
 def on_blue() :
     print('on blue')
@@ -673,7 +787,10 @@ if __name__ == '__main__':
 
     elif args.play : # Playback.
 
-        playback(args.id)
+        try:
+            playback(args.id)
+        finally:
+            close()
 
     else :
 
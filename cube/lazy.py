@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 周辺機器のモジュールの遅延読み込みと、読み込み時間の記録
+
+機種 (MODEL) や設定によっては使わないモジュール (selenium, watchdog, pigpio,
+tkinter 等) を、最初に使うときに読み込む。
+
+  browser = lazy.load('cube.browser', 'browser')
+  browser.BrowserPool(...)   # ここで cube.browser を読み込む
+
+読み込みにかかった時間はサブシステムごとに記録し、report() で取得できる。
+起動時に必ず読み込むモジュールは timed() で囲むと同じように記録できる。
+
+共有する状態を持つので、他のモジュールからは `from cube import lazy` で参照すること。
+
+python -m cube.lazy で、起動時の読み込み時間を -X importtime で計測する。
+"""
+from contextlib import contextmanager
+import importlib
+from logging import getLogger
+import sys
+from threading import RLock
+import time
+import types
+
+logger = getLogger(__name__)
+
+_lock = RLock()
+# {サブシステム: {'seconds': 合計時間, 'modules': {モジュール名: 時間}, 'lazy': bool}}
+_records = {}
+_loaded_at = {}
+
+
+def _record(subsystem, name, seconds, lazy) :
+  with _lock :
+    record = _records.setdefault(subsystem, {'seconds': 0.0, 'modules': {}, 'lazy': lazy})
+    record['seconds'] += seconds
+    record['modules'][name] = record['modules'].get(name, 0.0) + seconds
+    record['lazy'] = record['lazy'] and lazy
+    _loaded_at[name] = time.monotonic()
+
+
+@contextmanager
+def timed(subsystem, name=None) :
+  """ 囲んだ範囲の import にかかった時間を記録する """
+  t = time.perf_counter()
+  try :
+    yield
+  finally :
+    _record(subsystem, name or subsystem, time.perf_counter() - t, False)
+
+
+class LazyModule(types.ModuleType) :
+  """ 属性に最初にアクセスしたときにモジュールを読み込む """
+
+  def __init__(self, name, subsystem) :
+    super().__init__(name)
+    self.__dict__['_lazy_subsystem'] = subsystem
+    self.__dict__['_lazy_module'] = None
+
+  def _lazy_load(self) :
+    module = self.__dict__['_lazy_module']
+    if module is None :
+      with _lock :
+        module = self.__dict__['_lazy_module']
+        if module is None :
+          name = self.__name__
+          already = name in sys.modules
+          t = time.perf_counter()
+          module = importlib.import_module(name)
+          if not already :
+            seconds = time.perf_counter() - t
+            _record(self.__dict__['_lazy_subsystem'], name, seconds, True)
+            logger.info(f'lazy import {name} {seconds * 1000:.1f}ms')
+          self.__dict__['_lazy_module'] = module
+    return module
+
+  def __getattr__(self, attr) :
+    return getattr(self._lazy_load(), attr)
+
+  def __setattr__(self, attr, value) :
+    setattr(self._lazy_load(), attr, value)
+
+  def __dir__(self) :
+    return dir(self._lazy_load())
+
+  def __repr__(self) :
+    state = 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded'
+    return f'<lazy module {self.__name__!r} ({state})>'
+
+
+def load(name, subsystem=None) -> types.ModuleType :
+  """ name のモジュールを遅延読み込みする。読み込み済みであればそのまま返す """
+  module = sys.modules.get(name)
+  if module is not None :
+    return module
+  return LazyModule(name, subsystem or name.split('.')[0])
+
+
+def is_loaded(module) -> bool :
+  if isinstance(module, LazyModule) :
+    return module.__dict__['_lazy_module'] is not None
+  return True
+
+
+def report() -> dict :
+  """ サブシステムごとの読み込み時間 """
+  with _lock :
+    return {
+        subsystem : {
+            'seconds': record['seconds'],
+            'lazy': record['lazy'],
+            'modules': dict(record['modules']),
+        }
+        for subsystem, record in _records.items()
+    }
+
+
+def format_report() -> str :
+  lines = ['import time report (subsystem / ms / modules)']
+  for subsystem, record in sorted(report().items(), key=lambda item: -item[1]['seconds']) :
+    kind = 'lazy' if record['lazy'] else 'eager'
+    lines.append(
+        f"  {subsystem:<12} {record['seconds'] * 1000:8.1f}ms {kind:<5} {', '.join(record['modules'])}")
+  return '\n'.join(lines)
+
+
+# ##############################################################################
+# 起動時間の計測 (python -X importtime)
+# ##############################################################################
+
+# トップレベルのパッケージとサブシステムの対応
+SUBSYSTEMS = {
+    'selenium': 'browser', 'urllib3': 'browser', 'trio': 'browser', 'websocket': 'browser',
+    'nfc': 'felica', 'usb1': 'felica', 'pyudev': 'felica',
+    'paho': 'mqtt',
+    'pystray': 'tray', 'PIL': 'tray', 'Xlib': 'tray', 'gi': 'tray',
+    'tkinter': 'dialog', '_tkinter': 'dialog',
+    'watchdog': 'portable',
+    'yaml': 'logging', 'logging': 'logging',
+    'tcu': 'tcu',
+    'pigpio': 'ir', 'numpy': 'ir',
+    'netifaces': 'identity',
+    'dotenv': 'config',
+}
+
+
+def subsystem_of(module_name) -> str :
+  top = module_name.split('.')[0]
+  if top == 'cube' and '.' in module_name :
+    return f"cube.{module_name.split('.')[1]}"
+  return SUBSYSTEMS.get(top, 'stdlib' if top in sys.stdlib_module_names else 'other')
+
+
+def parse_importtime(text) -> dict :
+  """ -X importtime の出力を、サブシステムごとの自己時間 (秒) に集計する """
+  totals = {}
+  for line in text.splitlines() :
+    if not line.startswith('import time:') :
+      continue
+    fields = line[len('import time:'):].split('|')
+    if len(fields) != 3 :
+      continue
+    try :
+      self_us = int(fields[0])
+    except ValueError :
+      # ヘッダ行
+      continue
+    subsystem = subsystem_of(fields[2].strip())
+    totals[subsystem] = totals.get(subsystem, 0.0) + self_us / 1e6
+  return totals
+
+
+def benchmark(target='cube.medcube', repeat=5, env=None) -> dict :
+  """ 別プロセスで target を import し、時間を計測する """
+  import os
+  import statistics
+  import subprocess
+
+  walls = []
+  totals = {}
+  for _ in range(repeat) :
+    t = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {target}'],
+        capture_output=True, text=True, env=env or os.environ.copy())
+    walls.append(time.perf_counter() - t)
+    if proc.returncode != 0 :
+      raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'import failed')
+    for subsystem, seconds in parse_importtime(proc.stderr).items() :
+      totals.setdefault(subsystem, []).append(seconds)
+
+  return {
+      'target': target,
+      'repeat': repeat,
+      'wall_min': min(walls),
+      'wall_median': statistics.median(walls),
+      'subsystems': {subsystem: statistics.median(values) for subsystem, values in totals.items()},
+  }
+
+
+if __name__ == '__main__' :
+  import argparse
+  import json
+  import platform
+
+  argp = argparse.ArgumentParser(description='measure cube import (cold start) time.')
+  argp.add_argument('target', nargs='?', default='cube.medcube', help='module to import')
+  argp.add_argument('-n', '--repeat', type=int, default=5)
+  argp.add_argument('--record', help='append the result to this JSON lines file')
+  args = argp.parse_args()
+
+  result = benchmark(args.target, args.repeat)
+  print(f"{result['target']} wall min {result['wall_min'] * 1000:.1f}ms "
+        f"median {result['wall_median'] * 1000:.1f}ms (n={result['repeat']})")
+  for subsystem, seconds in sorted(result['subsystems'].items(), key=lambda item: -item[1]) :
+    print(f"  {subsystem:<20} {seconds * 1000:8.1f}ms")
+
+  if args.record :
+    result['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    result['host'] = platform.node()
+    result['python'] = platform.python_version()
+    with open(args.record, 'a') as f :
+      f.write(json.dumps(result) + '\n')
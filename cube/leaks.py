@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 長期間の動作でのメモリ・スレッド等のリークの監視
+
+次の値を定期的に、および診察の完了ごとに採取して、起動直後の基準と前回からの
+増加を比べる。増加が閾値を超えたら警告をログに出力し、on_alert を呼び出す。
+
+  - tracemalloc で確保しているメモリと、確保したファイル・行ごとの上位
+  - 名前ごとの生きているスレッドの数 (Thread-12 等の番号はまとめる)
+  - 子プロセス (孫以下も含む) の名前ごとの数 (geckodriver, firefox 等)
+  - 開いているファイルディスクリプタ (Windows はハンドル) の数
+  - track() で登録したオブジェクトのうち生きている数 (Session, Client 等)
+
+子プロセスとハンドルの数は psutil があれば使い、なければ Linux の /proc から読む。
+
+共有する状態を持つので、他のモジュールからは `from cube import leaks` で参照すること。
+"""
+from collections import Counter
+from logging import getLogger
+import os
+import re
+import threading
+import time
+import tracemalloc
+import weakref
+
+from . import utils
+
+logger = getLogger(__name__)
+
+# 定期的に採取する間隔 (秒)
+INTERVAL = 600.0
+# tracemalloc で記録するスタックの深さ (0 の場合は tracemalloc を使わない)
+TRACEMALLOC_FRAMES = 1
+# 出力する確保元の数
+TOP_ALLOCATORS = 10
+
+# 基準からの増加の閾値
+THRESHOLDS = {
+    'memory_bytes': 64 * 1024 * 1024,
+    'threads': 16,
+    'children': 4,
+    'fds': 64,
+    'objects': 4,
+}
+
+_THREAD_NUMBER_RE = re.compile(r'\d+')
+
+# {型の名前: {id(オブジェクト): 弱参照}} (__eq__ を定義してハッシュできない型もあるため WeakSet は使わない)
+_tracked = {}
+_tracked_lock = threading.Lock()
+
+
+def track(obj) -> None :
+  """ obj が解放されずに残っていないか数える対象にする """
+  name = type(obj).__qualname__
+  key = id(obj)
+
+  def _released(ref) :
+    with _tracked_lock :
+      objects = _tracked.get(name)
+      if objects is not None and objects.get(key) is ref :
+        del objects[key]
+
+  with _tracked_lock :
+    _tracked.setdefault(name, {})[key] = weakref.ref(obj, _released)
+
+
+def tracked_counts() -> dict :
+  with _tracked_lock :
+    return {name : len(objects) for name, objects in _tracked.items()}
+
+
+def thread_counts() -> Counter :
+  """ 名前 (番号は N にまとめる) ごとの生きているスレッドの数 (採取しているスレッドは除く) """
+  current = threading.current_thread()
+  return Counter(_THREAD_NUMBER_RE.sub('N', thread.name) for thread in threading.enumerate() if thread is not current)
+
+
+def _psutil() :
+  try :
+    import psutil
+    return psutil
+  except ImportError :
+    return None
+
+
+def child_processes() -> Counter | None :
+  """ 名前ごとの子孫プロセスの数 (取得できない場合は None) """
+  psutil = _psutil()
+  if psutil is not None :
+    names = Counter()
+    for child in psutil.Process().children(recursive=True) :
+      try :
+        names[child.name()] += 1
+      except psutil.Error :
+        pass
+    return names
+
+  if not os.path.isdir('/proc') :
+    return None
+  parents = {}
+  for entry in os.listdir('/proc') :
+    if not entry.isdigit() :
+      continue
+    try :
+      with open(f'/proc/{entry}/stat') as f :
+        stat = f.read()
+    except OSError :
+      continue
+    # comm は括弧で囲まれ、空白を含むことがある
+    comm = stat[stat.find('(') + 1:stat.rfind(')')]
+    ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+    parents[int(entry)] = (ppid, comm)
+
+  names = Counter()
+  descendants = {os.getpid()}
+  added = True
+  while added :
+    added = False
+    for pid, (ppid, comm) in parents.items() :
+      if ppid in descendants and pid not in descendants :
+        descendants.add(pid)
+        names[comm] += 1
+        added = True
+  return names
+
+
+def open_fds() -> int | None :
+  """ 開いているファイルディスクリプタ (Windows はハンドル) の数 """
+  psutil = _psutil()
+  if psutil is not None :
+    process = psutil.Process()
+    return process.num_handles() if os.name == 'nt' else process.num_fds()
+  try :
+    return len(os.listdir('/proc/self/fd'))
+  except OSError :
+    return None
+
+
+class Sample(object) :
+  """ ある時点の採取値 """
+
+  def __init__(self, label) :
+    self.label = label
+    self.time = time.time()
+    self.threads = thread_counts()
+    self.children = child_processes()
+    self.fds = open_fds()
+    self.objects = tracked_counts()
+    self.memory_bytes = None
+    self.snapshot = None
+    if tracemalloc.is_tracing() :
+      self.memory_bytes = tracemalloc.get_traced_memory()[0]
+      self.snapshot = tracemalloc.take_snapshot().filter_traces((
+          tracemalloc.Filter(False, tracemalloc.__file__),
+          tracemalloc.Filter(False, __file__),
+          tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+      ))
+
+  def to_dict(self) -> dict :
+    return {
+        'label': self.label,
+        'time': self.time,
+        'memory_bytes': self.memory_bytes,
+        'threads': sum(self.threads.values()),
+        'children': None if self.children is None else sum(self.children.values()),
+        'fds': self.fds,
+        'objects': dict(self.objects),
+    }
+
+
+def _growth(counts, base) -> dict :
+  """ {名前: 増加数} (増えたものだけ) """
+  return {name : count - base.get(name, 0) for name, count in counts.items() if base.get(name, 0) < count}
+
+
+def diff(sample: Sample, base: Sample, top: int = TOP_ALLOCATORS) -> dict :
+  """ base からの増加 """
+  result = {
+      'threads': sum(sample.threads.values()) - sum(base.threads.values()),
+      'threads_by_name': _growth(sample.threads, base.threads),
+      'objects_by_type': _growth(sample.objects, base.objects),
+  }
+  result['objects'] = max(result['objects_by_type'].values(), default=0)
+  if sample.children is not None and base.children is not None :
+    result['children'] = sum(sample.children.values()) - sum(base.children.values())
+    result['children_by_name'] = _growth(sample.children, base.children)
+  if sample.fds is not None and base.fds is not None :
+    result['fds'] = sample.fds - base.fds
+  if sample.memory_bytes is not None and base.memory_bytes is not None :
+    result['memory_bytes'] = sample.memory_bytes - base.memory_bytes
+  if top and sample.snapshot is not None and base.snapshot is not None :
+    result['allocators'] = [
+        (str(stat.traceback[0]), stat.size_diff, stat.count_diff)
+        for stat in sample.snapshot.compare_to(base.snapshot, 'lineno')[:top] if 0 < stat.size_diff
+    ]
+  return result
+
+
+class Monitor(utils.BaseThread) :
+  """ 定期的に採取して、基準からの増加を確認するスレッド
+
+  mark() で診察の完了等の区切りでも採取する。最初の採取 (set_baseline() を
+  呼び出していない場合) を基準にする。
+  """
+
+  def __init__(self, interval: float = INTERVAL, thresholds: dict | None = None, *, on_alert=None) :
+    super().__init__(daemon=True)
+    self.name = 'LeakMonitor'
+    self._interval = interval
+    self.thresholds = dict(THRESHOLDS, **(thresholds or {}))
+    self.on_alert = on_alert
+    self._lock = threading.Lock()
+    self.baseline = None
+    self.last = None
+    self.samples = 0
+    self.alerts = 0
+    self._alerted = set()
+
+  def set_baseline(self, label='baseline') -> Sample :
+    """ 増加を比べる基準を採取し直す (起動が完了した時点等) """
+    sample = Sample(label)
+    with self._lock :
+      self.baseline = self.last = sample
+      self._alerted.clear()
+    logger.info(f'leak baseline {sample.to_dict()}')
+    return sample
+
+  def mark(self, label) -> dict | None :
+    """ 採取して前回と基準からの増加を記録する。基準からの増加を返す """
+    sample = Sample(label)
+    with self._lock :
+      if self.baseline is None :
+        self.baseline = self.last = sample
+        logger.info(f'leak baseline {sample.to_dict()}')
+        return None
+      previous, self.last = self.last, sample
+      self.samples += 1
+      baseline = self.baseline
+
+    since_previous = diff(sample, previous, top=3)
+    growth = diff(sample, baseline)
+    logger.info(
+        f'leak sample {label} threads:{sum(sample.threads.values())} fds:{sample.fds} '
+        f'memory:{sample.memory_bytes} objects:{sample.objects} '
+        f'since {previous.label}:{ {k: v for k, v in since_previous.items() if v} }')
+    self._check(label, growth)
+    return growth
+
+  def _check(self, label, growth) -> None :
+    exceeded = {key : growth[key] for key, limit in self.thresholds.items()
+                if growth.get(key) is not None and limit <= growth[key]}
+    if not exceeded :
+      return
+    # 同じ項目の警告は、基準を採取し直すまで1回だけ出力する
+    with self._lock :
+      new = set(exceeded) - self._alerted
+      self._alerted.update(exceeded)
+    if not new :
+      return
+    self.alerts += 1
+    logger.error(f'leak suspected at {label} since {self.baseline.label}. exceeded:{exceeded} growth:{growth}')
+    if self.on_alert :
+      try :
+        self.on_alert(label, exceeded, growth)
+      except Exception :
+        logger.exception('leak on_alert failed.')
+
+  def run(self) -> None :
+    while self.should_keep_running(self._interval) :
+      try :
+        self.mark('periodic')
+      except Exception :
+        logger.exception('leak sample failed.')
+
+  def stats(self) -> dict :
+    with self._lock :
+      last, baseline = self.last, self.baseline
+    if last is None :
+      return {'samples': self.samples, 'alerts': self.alerts}
+    result = {'samples': self.samples, 'alerts': self.alerts, **last.to_dict()}
+    result.pop('label')
+    result.pop('time')
+    if baseline is not None and baseline is not last :
+      growth = diff(last, baseline, top=0)
+      result['growth'] = {key : growth[key] for key in THRESHOLDS if key in growth}
+    return result
+
+
+def start_tracemalloc(frames: int = TRACEMALLOC_FRAMES) -> bool :
+  """ tracemalloc を開始する (frames が 0 の場合は開始しない) """
+  if frames <= 0 or tracemalloc.is_tracing() :
+    return tracemalloc.is_tracing()
+  tracemalloc.start(frames)
+  return True
@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" キューを使ったログ出力
+
+ログを出力したスレッドではキューに積むだけにして、ファイルやコンソールへの
+書き込みは1つのスレッドでまとめて行う。app.log.yaml で次のように指定する。
+
+  handlers:
+    queue:
+      class: cube.logs.QueueHandler
+      handlers: [console, file]
+
+  loggers:
+    root:
+      handlers: [queue]
+
+キューが一杯の場合、WARNING 未満のログは待たずに破棄して件数を数える。
+メッセージの整形 (msg % args) は、args が変更されない値だけであれば書き込む
+スレッドで行う。
+
+頻繁に出力するループ向けに、ロガーごとに出力数を制限する RateLimitFilter がある。
+
+診察 (セッション) ごとのログの位置の索引
+  begin_session() / update_session() で現在のセッション (idm, 予約ID, 段階) を
+  設定すると、以降のログにセッションを付け加える。IndexedFileHandler は、
+  セッションごとのログのバイト位置をログファイルの横の索引 (<ログファイル>.idx)
+  に記録し、extract() は索引を使ってローテートされたファイルも含めて
+  そのセッションのログだけを読み出す。
+
+ローテートしたログの圧縮
+  CompressedRotatingFileHandler は、ローテートしたファイルを別スレッドで gzip 圧縮し、
+  backupCount に加えて全てのファイルの合計サイズ (max_total_bytes) を制限する。
+  segments() / open_segment() は圧縮したファイルも透過的に読み出す。
+"""
+import collections
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import weakref
+
+# キューに積めるログの数
+QUEUE_SIZE = 10000
+# キューが一杯の場合に WARNING 以上のログを待つ時間 (秒)
+BLOCK_TIMEOUT = 1.0
+
+# 書き込むスレッドで整形しても結果が変わらない引数の型
+_IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+_handlers = weakref.WeakSet()
+_filters = weakref.WeakSet()
+
+
+class _Listener(logging.handlers.QueueListener) :
+  """ 書き込むスレッド。書き込んだ数を数える """
+
+  def __init__(self, owner, handlers) :
+    super().__init__(owner.queue, *handlers, respect_handler_level=True)
+    self._owner = owner
+
+  def start(self) :
+    self._thread = threading.Thread(target=self._monitor, name='log-writer', daemon=True)
+    self._thread.start()
+
+  def handle(self, record) :
+    super().handle(record)
+    self._owner.written += 1
+
+
+class QueueHandler(logging.Handler) :
+  """ ログをキューに積み、handlers への書き込みは別のスレッドで行う
+
+  handlers にはハンドラ、または dictConfig で設定したハンドラの名前を指定する。
+  名前は最初にログを受け取ったときに解決する。
+
+  Python 3.12 以降の dictConfig は logging.handlers.QueueHandler の派生クラスの
+  queue, handlers, listener を独自に扱うため、その派生クラスにはせずキューを持つ。
+  """
+
+  def __init__(self, handlers=(), maxsize: int = QUEUE_SIZE, block_timeout: float = BLOCK_TIMEOUT) :
+    super().__init__()
+    self.queue = queue.Queue(maxsize)
+    self._targets = list(handlers)
+    self._block_timeout = block_timeout
+    self._listener = None
+    self._start_lock = threading.Lock()
+
+    self.enqueued = 0
+    self.written = 0
+    self.dropped = 0
+    self.max_queued = 0
+    _handlers.add(self)
+
+  def _resolve(self) -> list :
+    targets = []
+    for target in self._targets :
+      if isinstance(target, str) :
+        # dictConfig で名前を付けたハンドラ (logging.getHandlerByName は 3.12 以降)
+        handler = logging._handlers.get(target)
+        if handler is None :
+          raise ValueError(f'log handler {target} is not configured.')
+        target = handler
+      targets.append(target)
+    return targets
+
+  @property
+  def targets(self) -> list :
+    """ 書き込み先のハンドラ """
+    return self._resolve()
+
+  def start(self) :
+    """ 書き込むスレッドを開始する。最初にログを受け取ったときにも開始する """
+    with self._start_lock :
+      if self._listener is None :
+        self._listener = _Listener(self, self._resolve())
+        self._listener.start()
+
+  def prepare(self, record) :
+    # 例外のトレースバックは出力した時点のものを文字列にしておく
+    if record.exc_info and not record.exc_text :
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+    record.exc_info = None
+
+    args = record.args
+    if args :
+      values = args.values() if isinstance(args, dict) else args
+      if not all(isinstance(value, _IMMUTABLE_TYPES) for value in values) :
+        # 変更されうる値は書き込むまでに変わらないよう、ここで整形する
+        record.msg = record.getMessage()
+        record.args = None
+    return record
+
+  def enqueue(self, record) :
+    try :
+      self.queue.put_nowait(record)
+    except queue.Full :
+      if record.levelno < logging.WARNING :
+        self.dropped += 1
+        return
+      try :
+        self.queue.put(record, timeout=self._block_timeout)
+      except queue.Full :
+        self.dropped += 1
+        return
+    self.enqueued += 1
+    queued = self.queue.qsize()
+    if self.max_queued < queued :
+      self.max_queued = queued
+
+  def emit(self, record) :
+    if self._listener is None :
+      self.start()
+    try :
+      self.enqueue(self.prepare(record))
+    except Exception :
+      self.handleError(record)
+
+  def flush(self) :
+    """ キューに積まれたログを書き込むまで待つ (最大 block_timeout 秒) """
+    if self._listener is None :
+      return
+    deadline = time.monotonic() + self._block_timeout
+    while self.queue.unfinished_tasks and time.monotonic() < deadline :
+      time.sleep(0.01)
+
+  def close(self) :
+    with self._start_lock :
+      listener, self._listener = self._listener, None
+    if listener is not None :
+      # キューに残っているログを書き込んでから終了する
+      listener.stop()
+    super().close()
+
+  def stats(self) -> dict :
+    return {
+        'enqueued': self.enqueued,
+        'written': self.written,
+        'dropped': self.dropped,
+        'queued': self.queue.qsize(),
+        'max_queued': self.max_queued,
+    }
+
+
+class RateLimitFilter(logging.Filter) :
+  """ ロガーごとに1秒あたりの出力数を制限する
+
+  rate は1秒あたりの数、burst はまとめて出力できる数。
+  names を指定した場合は、そのロガー (と子のロガー) だけを制限する。
+  level 以上のログは制限しない。制限したログの数は、次に出力したログに付け加える。
+
+    filters:
+      rate_limit:
+        (): cube.logs.RateLimitFilter
+        rate: 2.0
+        burst: 10
+        names: [cube.medcube]
+        level: INFO
+  """
+
+  def __init__(self, rate: float = 10.0, burst: int = 20, names=None, level=logging.WARNING) :
+    super().__init__()
+    self._level = logging._checkLevel(level)
+    self._rate = rate
+    self._burst = burst
+    self._names = tuple(names) if names else None
+    self._lock = threading.Lock()
+    # {ロガー名: [トークン, 更新した時刻, 制限した数]}
+    self._buckets = {}
+    self.suppressed = 0
+    _filters.add(self)
+
+  def _is_target(self, name) -> bool :
+    if self._names is None :
+      return True
+    return any(name == n or name.startswith(n + '.') for n in self._names)
+
+  def filter(self, record) -> bool :
+    if self._level <= record.levelno or not self._is_target(record.name) :
+      return True
+
+    now = time.monotonic()
+    with self._lock :
+      bucket = self._buckets.get(record.name)
+      if bucket is None :
+        bucket = self._buckets[record.name] = [float(self._burst), now, 0]
+      bucket[0] = min(float(self._burst), bucket[0] + (now - bucket[1]) * self._rate)
+      bucket[1] = now
+      if bucket[0] < 1.0 :
+        bucket[2] += 1
+        self.suppressed += 1
+        return False
+      bucket[0] -= 1.0
+      suppressed, bucket[2] = bucket[2], 0
+
+    if suppressed :
+      record.msg = f'{record.msg} (rate limited: {suppressed} suppressed)'
+    return True
+
+
+def iter_handlers(logger: logging.Logger | None = None) :
+  """ logger のハンドラ。QueueHandler はその書き込み先のハンドラを返す """
+  logger = logger or logging.getLogger()
+  for handler in logger.handlers :
+    if isinstance(handler, QueueHandler) :
+      yield from handler.targets
+    else :
+      yield handler
+
+
+def stats() -> dict :
+  """ ログの件数
+
+  queues: QueueHandler ごとの {enqueued, written, dropped, queued, max_queued}
+  rate_limited: RateLimitFilter で制限した数の合計
+  """
+  return {
+      'queues': {(handler.name or f'queue{i}') : handler.stats() for i, handler in enumerate(list(_handlers))},
+      'rate_limited': sum(f.suppressed for f in list(_filters)),
+  }
+
+
+# ##############################################################################
+# セッションごとのログの索引
+# ##############################################################################
+INDEX_SUFFIX = '.idx'
+
+# seq はセッションの通し番号。予約IDが分かる前 (認証中) のログも同じセッションとして抽出する
+Session = collections.namedtuple('Session', ('seq', 'reservation_id', 'idm', 'phase'))
+
+_session = None
+_session_seq = 0
+_session_lock = threading.Lock()
+_record_factory = None
+
+
+def begin_session(idm=None, reservation_id=None, phase=None) -> Session :
+  """ セッションを開始する。以降のログにセッションを付け加える """
+  global _session, _session_seq
+  with _session_lock :
+    _session_seq += 1
+    _session = Session(f'{os.getpid()}-{_session_seq}', reservation_id, idm, phase)
+    return _session
+
+
+def update_session(**changes) -> Session :
+  """ 現在のセッションの予約ID・段階等を変更する。セッションが無ければ開始する """
+  global _session, _session_seq
+  with _session_lock :
+    if _session is None :
+      _session_seq += 1
+      _session = Session(f'{os.getpid()}-{_session_seq}', None, None, None)
+    _session = _session._replace(**changes)
+    return _session
+
+
+def end_session() -> None :
+  global _session
+  with _session_lock :
+    _session = None
+
+
+def current_session() -> Session | None :
+  return _session
+
+
+def _install_record_factory() :
+  """ ログを出力した時点のセッションを LogRecord.session に設定する """
+  global _record_factory
+  if _record_factory is not None :
+    return
+  factory = logging.getLogRecordFactory()
+
+  def _factory(*args, **kwargs) :
+    record = factory(*args, **kwargs)
+    record.session = _session
+    return record
+
+  _record_factory = _factory
+  logging.setLogRecordFactory(_factory)
+
+
+# ##############################################################################
+# ローテートしたログの圧縮
+# ##############################################################################
+COMPRESSED_SUFFIX = '.gz'
+_TEMP_SUFFIX = '.tmp'
+
+
+def _logical(segment) -> str :
+  """ 圧縮前のファイル名 """
+  return segment[:-len(COMPRESSED_SUFFIX)] if segment.endswith(COMPRESSED_SUFFIX) else segment
+
+
+def index_path(segment) -> str :
+  return _logical(segment) + INDEX_SUFFIX
+
+
+def log_file() -> str | None :
+  """ ルートロガーが書き込んでいるログファイル """
+  for handler in iter_handlers() :
+    if isinstance(handler, logging.FileHandler) :
+      return handler.baseFilename
+  return None
+
+
+def segments(path=None) -> list :
+  """ ログファイルとローテートしたファイル (古い順)。圧縮したファイルも含む """
+  path = path or log_file()
+  if not path :
+    return []
+  found = {}
+  for segment in glob.glob(glob.escape(path) + '.*') :
+    if segment.endswith(INDEX_SUFFIX) or segment.endswith(_TEMP_SUFFIX) :
+      continue
+    logical = _logical(segment)
+    # 圧縮が終わるまでは元のファイルを使う
+    if logical not in found or not segment.endswith(COMPRESSED_SUFFIX) :
+      found[logical] = segment
+  rotated = [found[logical] for logical in sorted(found)]
+  return rotated + ([path] if os.path.exists(path) else [])
+
+
+def open_segment(segment) :
+  """ ファイルをバイナリで開く。圧縮したファイルは展開しながら読み出す """
+  if segment.endswith(COMPRESSED_SUFFIX) :
+    return gzip.open(segment, 'rb')
+  return open(segment, 'rb')
+
+
+def read_all(path=None, chunk_size: int = 1 << 20) :
+  """ ローテートしたファイルも含めて、古い順にログを読み出す """
+  for segment in segments(path) :
+    with open_segment(segment) as f :
+      while chunk := f.read(chunk_size) :
+        yield chunk
+
+
+class CompressedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler) :
+  """ ローテートしたファイルを別スレッドで圧縮する TimedRotatingFileHandler
+
+  max_total_bytes は現在のファイルと索引を含めた合計サイズの上限 (0 は制限しない)。
+  超えた場合は古いファイルから削除する。backupCount も従来どおり有効。
+  圧縮と削除は書き込むスレッドを止めないよう、別のスレッドで行う。
+  """
+
+  def __init__(self, filename, *args, compress: bool = True, compresslevel: int = 6,
+               max_total_bytes: int = 0, **kwargs) :
+    super().__init__(filename, *args, **kwargs)
+    self.compress = compress
+    self.compresslevel = compresslevel
+    self.max_total_bytes = max_total_bytes
+    self._maintain_lock = threading.Lock()
+    self._maintain_requested = False
+    self._maintainer = None
+    # 前回の終了までに圧縮できなかったファイルを圧縮する
+    self._schedule()
+
+  def rotate(self, source, dest) :
+    super().rotate(source, dest)
+    if source == self.baseFilename :
+      self._rotated(source, dest)
+    self._schedule()
+
+  def _rotated(self, source, dest) :
+    """ ローテートした直後 (圧縮する前) に呼び出す """
+    pass
+
+  def getFilesToDelete(self) :
+    # 削除は圧縮と同じスレッドで行う
+    return []
+
+  def _schedule(self) :
+    with self._maintain_lock :
+      self._maintain_requested = True
+      if self._maintainer is not None :
+        return
+      self._maintainer = threading.Thread(target=self._maintain, name='log-compress', daemon=True)
+      self._maintainer.start()
+
+  def _maintain(self) :
+    while True :
+      with self._maintain_lock :
+        if not self._maintain_requested :
+          self._maintainer = None
+          return
+        self._maintain_requested = False
+      try :
+        rotated = [segment for segment in segments(self.baseFilename) if segment != self.baseFilename]
+        if self.compress :
+          for segment in rotated :
+            if not segment.endswith(COMPRESSED_SUFFIX) :
+              self._compress(segment)
+        self._delete_old()
+      except Exception :
+        # ログの出力中なので、logging のハンドラと同じく標準エラーへ出力する
+        if logging.raiseExceptions :
+          import traceback
+          traceback.print_exc(file=sys.stderr)
+
+  def _compress(self, segment) :
+    compressed = segment + COMPRESSED_SUFFIX
+    if os.path.exists(compressed) :
+      # 同じ名前の圧縮ファイルがある場合は上書きしない
+      return
+    temp = compressed + _TEMP_SUFFIX
+    with open(segment, 'rb') as src, gzip.open(temp, 'wb', compresslevel=self.compresslevel) as dst :
+      shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(temp, compressed)
+    os.remove(segment)
+
+  def _delete_segment(self, segment) :
+    for path in (segment, _logical(segment), _logical(segment) + COMPRESSED_SUFFIX, index_path(segment)) :
+      try :
+        os.remove(path)
+      except FileNotFoundError :
+        pass
+
+  def _delete_old(self) :
+    files = segments(self.baseFilename)
+    for temp in glob.glob(glob.escape(self.baseFilename) + '.*' + _TEMP_SUFFIX) :
+      # 前回、圧縮の途中で終了したファイル
+      os.remove(temp)
+    rotated = [segment for segment in files if segment != self.baseFilename]
+
+    if 0 < self.backupCount and self.backupCount < len(rotated) :
+      for segment in rotated[:len(rotated) - self.backupCount] :
+        self._delete_segment(segment)
+      rotated = rotated[len(rotated) - self.backupCount:]
+
+    if 0 < self.max_total_bytes :
+      def _size(segment) :
+        size = 0
+        for path in (segment, index_path(segment)) :
+          try :
+            size += os.path.getsize(path)
+          except OSError :
+            pass
+        return size
+
+      total = sum(_size(segment) for segment in rotated) + _size(self.baseFilename)
+      for segment in rotated :
+        if total <= self.max_total_bytes :
+          break
+        total -= _size(segment)
+        self._delete_segment(segment)
+
+
+class IndexedFileHandler(CompressedRotatingFileHandler) :
+  """ セッションのログのバイト位置を索引に記録する TimedRotatingFileHandler
+
+  同じセッションのログが続く間は1つの範囲にまとめ、セッションか段階が
+  変わったとき、ローテート時、終了時に索引へ1行 (JSON) 追記する。
+  索引はローテートしたファイルと一緒に名前を変え、一緒に削除する。
+  """
+
+  def __init__(self, filename, *args, **kwargs) :
+    # [セッション, 開始位置, 終了位置, 最初のログの時刻]
+    self._range = None
+    super().__init__(filename, *args, **kwargs)
+    _install_record_factory()
+
+  def emit(self, record) :
+    session = getattr(record, 'session', None)
+    if session is None :
+      super().emit(record)
+      return
+    try :
+      if self.shouldRollover(record) :
+        self.doRollover()
+      if self.stream is None :
+        self.stream = self._open()
+      start = self.stream.tell()
+      logging.FileHandler.emit(self, record)
+      self._extend(session, start, self.stream.tell(), record.created)
+    except Exception :
+      self.handleError(record)
+
+  def _extend(self, session, start, end, created) :
+    current = self._range
+    if current is not None and current[0] == session and current[2] == start :
+      current[2] = end
+      return
+    self._write_range()
+    self._range = [session, start, end, created]
+
+  def _write_range(self) :
+    current, self._range = self._range, None
+    if current is None :
+      return
+    session, start, end, created = current
+    entry = {'o': start, 'n': end - start, 't': round(created, 3), 's': session.seq,
+             'r': session.reservation_id, 'i': session.idm, 'p': session.phase}
+    try :
+      with open(index_path(self.baseFilename), 'a', encoding='utf-8') as f :
+        f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    except OSError :
+      # 索引が書けなくてもログの出力は続ける
+      pass
+
+  def rotate(self, source, dest) :
+    self._write_range()
+    super().rotate(source, dest)
+
+  def _rotated(self, source, dest) :
+    if os.path.exists(index_path(source)) :
+      os.replace(index_path(source), index_path(dest))
+
+  def close(self) :
+    self.acquire()
+    try :
+      self._write_range()
+    finally :
+      self.release()
+    super().close()
+
+
+def _read_index(segment) :
+  try :
+    with open(index_path(segment), encoding='utf-8') as f :
+      for line in f :
+        try :
+          yield json.loads(line)
+        except ValueError :
+          # 書き込み途中で終了した行
+          continue
+  except FileNotFoundError :
+    return
+
+
+def _matches(entry, reservation_id, idm) -> bool :
+  if reservation_id is not None and str(entry.get('r')) != str(reservation_id) :
+    return False
+  if idm is not None and str(entry.get('i')).lower() != str(idm).lower() :
+    return False
+  return True
+
+
+def find_sessions(path=None) -> list :
+  """ 索引に記録されたセッションの一覧 (古い順)
+
+  [{'seq', 'reservation_id', 'idm', 'first', 'last', 'bytes', 'phases'}]
+  """
+  sessions = {}
+  for segment in segments(path) :
+    for entry in _read_index(segment) :
+      seq = entry.get('s')
+      session = sessions.get(seq)
+      if session is None :
+        session = sessions[seq] = {'seq': seq, 'reservation_id': None, 'idm': None, 'first': entry['t'],
+                                   'last': entry['t'], 'bytes': 0, 'phases': []}
+      for key, field in (('r', 'reservation_id'), ('i', 'idm')) :
+        if entry.get(key) is not None :
+          session[field] = entry[key]
+      session['last'] = entry['t']
+      session['bytes'] += entry['n']
+      if entry.get('p') not in session['phases'] :
+        session['phases'].append(entry.get('p'))
+  return sorted(sessions.values(), key=lambda session: session['first'])
+
+
+def extract(path=None, *, reservation_id=None, idm=None, phase=None) -> bytes :
+  """ 索引を使い、条件に一致するセッションのログだけを読み出す
+
+  予約ID (または IDm) が一致したセッションは、予約IDが分かる前のログも含めて読み出す。
+  """
+  paths = segments(path)
+  indexes = {segment : list(_read_index(segment)) for segment in paths}
+  seqs = {entry.get('s') for entries in indexes.values() for entry in entries
+          if _matches(entry, reservation_id, idm)}
+
+  chunks = []
+  for segment in paths :
+    entries = [entry for entry in indexes[segment]
+               if entry.get('s') in seqs and (phase is None or entry.get('p') == phase)]
+    if not entries :
+      continue
+    with open_segment(segment) as f :
+      for entry in entries :
+        f.seek(entry['o'])
+        chunks.append(f.read(entry['n']))
+  return b''.join(chunks)
+
+
+if __name__ == '__main__' :
+  import argparse
+
+  argp = argparse.ArgumentParser(description='extract one session from the cube log.')
+  argp.add_argument('path', help='log file (e.g. /tmp/tcu/log/cube.log)')
+  argp.add_argument('-r', '--reservation-id')
+  argp.add_argument('-i', '--idm')
+  argp.add_argument('-p', '--phase')
+  argp.add_argument('-l', '--list', action='store_true', help='list indexed sessions')
+  args = argp.parse_args()
+
+  if args.list :
+    for session in find_sessions(args.path) :
+      print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session['first']))} "
+            f"reservation_id:{session['reservation_id']} idm:{session['idm']} "
+            f"{session['bytes']}B {','.join(str(p) for p in session['phases'])}")
+  else :
+    sys.stdout.buffer.write(extract(args.path, reservation_id=args.reservation_id, idm=args.idm, phase=args.phase))
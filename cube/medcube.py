@@ -2,17 +2,14 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import binascii
-import csv
 from collections import deque
 import configparser
 import concurrent.futures
 import json
 from logging import getLogger
-import nfc
-import nfc.tag.tt3
 import os
 import socket
-from threading import Thread, Lock, RLock, Event, current_thread
+from threading import Thread, Timer, Lock, RLock, Event, current_thread
 import time
 
 import tcu
@@ -22,14 +19,33 @@ from tcu.relay import Switch, Switches
 from tcu.relay.constant import *
 
 from . import camera
+from . import clocks
+from . import diagnostics
 from . import door_control
-from . import felica
-from . import fwatchdog
+from . import events
+from . import felica_registry
+from . import identity
+from . import lazy
+from . import leaks
+from . import logs
+from . import metrics
 from . import onlinemed
-from . import portable
 from . import remocon
+from . import resilience
+from . import startup
+from . import tracing
 from . import utils
-from . import browser
+
+# 機種によっては使わないモジュールは、最初に使うときに読み込む
+# (selenium は portable 以外、watchdog は portable のみ)
+browser = lazy.load(f'{__package__}.browser', 'browser')
+fwatchdog = lazy.load(f'{__package__}.fwatchdog', 'portable')
+portable = lazy.load(f'{__package__}.portable', 'portable')
+# nfc (libusb) は import に時間がかかるので、起動処理でリーダーを作るときに読み込む
+felica = lazy.load(f'{__package__}.felica', 'felica')
+tt3 = lazy.load('nfc.tag.tt3', 'felica')
+# diagnostics, leaks, tracing は標準ライブラリだけを使う小さなモジュールで、
+# onlinemed と __main__ も読み込むため遅延させない
 
 from .configs import *
 from .whiteboard import Whiteboard
@@ -43,6 +59,22 @@ logger = getLogger(__name__)
 
 _g_cube = None
 
+_g_browser_pool = None
+
+_g_felica_registry = None
+
+_g_tap_queue = None
+# 最後に受け付けたタッチ (タッチから解錠までの時間の計測用)
+_g_last_tap = None
+
+_g_startup = None
+
+_g_leak_monitor = None
+# イベントバスの購読
+_g_subscriptions = []
+
+_BROWSER_PROFILE = r"t8qam33a.OnlineMed Cube"
+
 # remocon.init(
 #           turnon_source=_TV_TURNON_SOURCE, turnon_wait=_TV_TURNON_WAIT, turnon_retry=_TV_TURNON_RETRY
 #         , turnoff_source=_TV_TURNOFF_SOURCE, turnoff_wait=_TV_TURNOFF_WAIT, turnoff_retry=_TV_TURNOFF_RETRY
@@ -50,6 +82,31 @@ _g_cube = None
 #         )
 
 
+TCUD_REQUEST_SECONDS = metrics.histogram(
+    'cube_tcud_request_seconds', 'tcud request time', ('command',))
+TAP_TO_UNLOCK_SECONDS = metrics.histogram(
+    'cube_tap_to_unlock_seconds', 'time from the card tap to the door unlock')
+CONSULTATIONS = metrics.counter('cube_consultations', 'consultations started', ('mode',))
+CONSULTATION_SECONDS = metrics.histogram(
+    'cube_consultation_seconds', 'time from cube open to finish',
+    buckets=(60.0, 300.0, 600.0, 900.0, 1200.0, 1800.0, 2700.0, 3600.0))
+
+
+# tcud・リレーへの要求はタイムアウトを指定できないため、専用のスレッドで実行して期限までだけ待つ
+TCUD = resilience.breaker('tcud', timeout=TCUD_TIMEOUT, isolate=True)
+RELAY = resilience.breaker('relay', timeout=RELAY_TIMEOUT, isolate=True)
+
+
+def _tcud_request(command) :
+  """ tcud へ要求を送る (処理時間を記録する)
+
+  応答がない場合は resilience.DeadlineExceeded、続けて失敗している場合は
+  resilience.CircuitOpenError が発生する。
+  """
+  with TCUD_REQUEST_SECONDS.labels(command).time() :
+    return TCUD.call(tcu.client.request, command, address=(TCUPI_DAEMON_HOST, TCUPI_DAEMON_PORT))
+
+
 class MedCubeException(Exception):
   pass
 
@@ -78,7 +135,10 @@ class _SensorThread(Thread):
 
     global onlinemed_client
 
-    tcu.client.request("start", address=(TCUPI_DAEMON_HOST, TCUPI_DAEMON_PORT))
+    try :
+      _tcud_request("start")
+    except resilience.ResilienceError :
+      logger.exception("tcud start failed.")
     try :
       self._do = True
 
@@ -86,8 +146,7 @@ class _SensorThread(Thread):
 
         if onlinemed_client :
           try :
-            result, measure = tcu.client.request(
-                "measure", address=(TCUPI_DAEMON_HOST, TCUPI_DAEMON_PORT))
+            result, measure = _tcud_request("measure")
 
             if result == tcu.constant.CODE_SUCCESS:
               onlinemed_client.measure(measure)
@@ -97,8 +156,10 @@ class _SensorThread(Thread):
         self._timer_event.wait(self._interval)
 
     finally :
-      tcu.client.request("stop", address=(
-          TCUPI_DAEMON_HOST, TCUPI_DAEMON_PORT))
+      try :
+        _tcud_request("stop")
+      except resilience.ResilienceError :
+        logger.exception("tcud stop failed.")
 
   def kill(self):
     self._do = False
@@ -110,6 +171,30 @@ class _SensorThread(Thread):
 
 from cube import cube_thread
 
+
+class DistanceEvent(events.Event) :
+  """ 距離センサーのイベント """
+  __slots__ = ('sensor',)
+
+  def __init__(self, sensor) :
+    self.sensor = sensor
+
+
+class PatientEntered(DistanceEvent) :
+  """ 患者が入室した """
+  __slots__ = ()
+
+
+class PatientLeft(DistanceEvent) :
+  """ 患者が退出した """
+  __slots__ = ()
+
+
+class DistanceTimeout(DistanceEvent) :
+  """ 入室・退出を待つ時間が過ぎた """
+  __slots__ = ()
+
+
 class _DistanceSensor(cube_thread):
   """ 距離センサー
   """
@@ -133,41 +218,48 @@ class _DistanceSensor(cube_thread):
     """"""
     return self._await_leave
 
-  def __init__(self, interval, period, threshold, leave_threshold=None, *, ch=2):
-    """"""
+  def __init__(self, interval, period, threshold, leave_threshold=None, *, ch=2,
+               clock: clocks.Clock | None = None, bus: events.EventBus | None = None):
+    """ 入室・退出・タイムアウトは bus に PatientEntered, PatientLeft, DistanceTimeout を発行する """
     super().__init__("DistanceSensor")
 
+    self._clock = clock or clocks.get()
+    self._bus = bus or events.BUS
+
     self._await_enter = False
     self._is_enter = Event()
-    self.on_enter = None
 
     self._await_leave = False
     self._is_leave = Event()
-    self.on_leave = None
 
     self._timeout = 0
-    self.on_timeout = None
 
     self._interval = interval
     self._period = period
     self._threshold = threshold
     self._leave_threshold = threshold if leave_threshold is None else leave_threshold
 
+    self._distance = 0.0
+
   def clear(self) :
     """"""
     self._is_enter.clear()
     self._is_leave.clear()
 
   def get(self) :
-    """"""
-    _, distance = tcu.client.request(
-        "distance", address=(TCUPI_DAEMON_HOST, TCUPI_DAEMON_PORT))
+    """ 距離を取得する。tcud が応答しない場合は最後に取得した距離 (変化なし) を返す """
+    try :
+      _, distance = _tcud_request("distance")
+    except resilience.ResilienceError as e :
+      logger.warning(f"request distance failed. {e}")
+      return self._distance
     # logger.info(f"request distance result:{result} distance:{distance}")
+    self._distance = distance
     return distance
 
   def enter_wait(self, timeout:float|None=None) -> bool:
     """"""
-    return self._is_enter.wait(timeout)
+    return self._clock.wait(self._is_enter, timeout)
 
   def is_enter(self, timeout: float | None = None) -> bool:
     """"""
@@ -181,17 +273,16 @@ class _DistanceSensor(cube_thread):
       self._await_enter = True
       self._is_enter.clear()
       if 0 < timeout :
-        self._timeout = time.time() + timeout
+        self._timeout = self._clock.monotonic() + timeout
       else :
         self._timeout = 0
       self.start()
     else :
-      if self.on_enter :
-        self.on_enter()
+      self._bus.publish(PatientEntered(self))
 
   def leave_wait(self, timeout:float|None=None) -> bool:
     """"""
-    return self._is_leave.wait(timeout)
+    return self._clock.wait(self._is_leave, timeout)
 
   def is_leave(self, timeout: float | None = None) -> bool:
     """"""
@@ -205,7 +296,7 @@ class _DistanceSensor(cube_thread):
     self._await_leave = True
     self._is_leave.clear()
     if 0 < timeout :
-      self._timeout = time.time() + timeout
+      self._timeout = self._clock.monotonic() + timeout
     else :
       self._timeout = 0
     self.start()
@@ -214,13 +305,13 @@ class _DistanceSensor(cube_thread):
     """"""
     try :
       if 0 < timeout :
-        self._timeout = time.time() + timeout
+        self._timeout = self._clock.monotonic() + timeout
     except :
       pass
 
   def run(self) :
     """"""
-    stime = time.time()
+    stime = self._clock.monotonic()
 
     mvavg_window_size, mod = divmod(self._period, self._interval)
     if mod :
@@ -233,19 +324,19 @@ class _DistanceSensor(cube_thread):
 
     try :
       self._do = True
-      pre1sec = pre = tm = time.time()
+      pre1sec = pre = tm = self._clock.monotonic()
       while self._do :
         # interval
         pre = tm
-        tm = time.time()
+        tm = self._clock.monotonic()
         interval = self._interval - (tm - pre)
         if interval > 0.0 :
-          time.sleep(interval)
+          self._clock.sleep(interval)
 
         #
         # check is there
         #
-        tm = time.time()
+        tm = self._clock.monotonic()
         #
         dist = self.get()
         try :
@@ -263,23 +354,21 @@ class _DistanceSensor(cube_thread):
           else :
             mvavg = mvavg_sum
 
-          logstr = f"distance {dist} diff {diff}"
-          logstr += f" is enter:{self._is_enter.is_set()} is leave:{self._is_leave.is_set()}"
-          logstr += f" time {tm-stime:0.3f}"
-          logstr += f" avg {mvavg:0.3f} num {num}"
           logoutput = False
           if 1.0 <= tm - pre1sec :
             pre1sec = tm
             logoutput = True
-            logger.debug(logstr)
+            # 文字列の生成は出力するときだけ行う
+            logger.debug(
+                "distance %s diff %s is enter:%s is leave:%s time %0.3f avg %0.3f num %d",
+                dist, diff, self._is_enter.is_set(), self._is_leave.is_set(), tm - stime, mvavg, num)
           # else :
           #   logger.debug(logstr)
 
           if mvavg_window_size <= num :
             if self._await_enter :
-              logstr = f"distance is judge ? threshold enter {self._threshold} < value:{mvavg:0.3f}"
               if logoutput :
-                logger.info(logstr)
+                logger.info("distance is judge ? threshold enter %s < value:%0.3f", self._threshold, mvavg)
               # else :
               #   logger.debug(logstr)
 
@@ -288,14 +377,12 @@ class _DistanceSensor(cube_thread):
                   self._is_enter.set()
                   self._await_enter = False
                   logger.info("enter.")
-                  if self.on_enter :
-                    self.on_enter()
+                  self._bus.publish(PatientEntered(self))
                   break
 
             if self._await_leave :
-              logstr = f"distance is judge ? threshold value {mvavg:0.3f} < leave {self._leave_threshold}"
               if logoutput :
-                logger.info(logstr)
+                logger.info("distance is judge ? threshold value %0.3f < leave %s", mvavg, self._leave_threshold)
               # else :
               #   logger.debug(logstr)
 
@@ -304,8 +391,7 @@ class _DistanceSensor(cube_thread):
                   self._is_leave.set()
                   self._await_leave = False
                   logger.info("leave.")
-                  if self.on_leave :
-                    self.on_leave()
+                  self._bus.publish(PatientLeft(self))
                   break
         finally :
           distance = dist
@@ -313,12 +399,161 @@ class _DistanceSensor(cube_thread):
         if 0 < self._timeout < tm :
           logger.info(f'distance time is over timeout:{tm-stime:0.3f} ')
           self.stop()
-          if self.on_timeout :
-            self.on_timeout()
+          self._bus.publish(DistanceTimeout(self))
     finally :
       self._do = False
       self.clear()
 
+# ##############################################################################
+class _Prefetch(object) :
+  """ cube_open受信時に先行して読み込んだ通話画面とホワイトボード
+  """
+
+  def __init__(self, reservation_id, future_browser, future_whiteboard) :
+    self.reservation_id = reservation_id
+    self.future_browser = future_browser
+    self.future_whiteboard = future_whiteboard
+
+  def browser(self, timeout: float | None = None) :
+    """ 先行して読み込んだブラウザ。読み込めなかった場合はNone """
+    if self.future_browser is None :
+      return None
+    try :
+      return self.future_browser.result(timeout)
+    except Exception :
+      logger.exception("prefetch browser failed.")
+      return None
+
+  def whiteboard_loaded(self, timeout: float | None = None) -> bool :
+    """ ホワイトボードの先行読み込みが完了したか (ホワイトボードが受け付けなかった場合は False) """
+    if self.future_whiteboard is None :
+      return False
+    try :
+      return bool(self.future_whiteboard.result(timeout))
+    except Exception :
+      logger.exception("prefetch whiteboard failed.")
+      return False
+
+
+class _WarmUp(object) :
+  """ カードのタッチから cube_open までの間に先行して行う準備
+
+  テレビの電源、通話画面用ブラウザの読み込み、リレーサーバの確認を並行して行う。
+  cube_open で使われなかった準備は discard() で元に戻す。
+  """
+
+  def __init__(self, idm, executor: concurrent.futures.Executor) :
+    self.idm = idm
+    self.started = time.monotonic()
+    self._executor = executor
+    self._lock = Lock()
+    self._cancelled = Event()
+    self._tv_taken = False
+    self._browser_taken = False
+    self.future_tv = None
+    self.future_browser = None
+    self.future_relay = None
+
+  def start(self) :
+    if TV_CONTROL and _is_available('tv') :
+      self.future_tv = tracing.submit(self._executor, 'warm_up.tv', self._warm_tv)
+    if _g_browser_pool and _is_available('browser_pool') :
+      self.future_browser = tracing.submit(self._executor, 'warm_up.browser', self._warm_browser)
+    self.future_relay = tracing.submit(self._executor, 'warm_up.relay', self._check_relay)
+
+  @property
+  def is_cancelled(self) -> bool :
+    return self._cancelled.is_set()
+
+  def _warm_tv(self) -> bool :
+    """ テレビの電源を入れる。電源を入れた場合は True """
+    if self._cancelled.is_set() :
+      return False
+    if remocon.is_on() :
+      return False
+    t = time.monotonic()
+    remocon.turnon(TV_TURNON_WAIT, TV_TURNON_RETRY)
+    logger.info(f"warm up tv {time.monotonic() - t:0.3f}s")
+    return True
+
+  def _warm_browser(self) :
+    """ 通話画面のサイトを読み込んだブラウザを用意する """
+    if self._cancelled.is_set() :
+      return None
+    t = time.monotonic()
+    wb = _g_browser_pool.acquire(f"https://{ONLINEMED_PATIENT_URL}", timeout=60.0, hidden=True)
+    logger.info(f"warm up browser {time.monotonic() - t:0.3f}s")
+    return wb
+
+  def _check_relay(self) -> bool :
+    """ リレーサーバへ接続できるか確認し、スイッチの状態を更新しておく """
+    if self._cancelled.is_set() :
+      return False
+    t = time.monotonic()
+    try :
+      # イベントループを作らずに、同期APIをリレーの遮断器経由で呼び出す
+      resp = RELAY.call(tcu.relay.client.get_status, (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
+    except resilience.ResilienceError as e :
+      logger.warning(f"warm up relay is not available. {type(e).__name__}: {e}")
+      return False
+    if resp :
+      client_request(resp)
+    logger.info(f"warm up relay {time.monotonic() - t:0.3f}s reachable:{bool(resp)}")
+    return bool(resp)
+
+  def take_tv(self) -> bool :
+    """ テレビの電源が入るのを待つ。電源を入れた場合は True """
+    with self._lock :
+      if self.future_tv is None or self._tv_taken :
+        return False
+      self._tv_taken = True
+    try :
+      return self.future_tv.result()
+    except Exception :
+      logger.exception("warm up tv failed.")
+      return False
+
+  def take_browser(self) -> concurrent.futures.Future | None :
+    """ 用意しているブラウザを受け取る。受け取ったブラウザは discard() で戻さない """
+    with self._lock :
+      if self.future_browser is None or self._browser_taken :
+        return None
+      self._browser_taken = True
+      return self.future_browser
+
+  def discard(self) :
+    """ 受け取られなかった準備を元に戻す """
+    with self._lock :
+      if self._cancelled.is_set() :
+        return
+      self._cancelled.set()
+      revert_tv = self.future_tv is not None and not self._tv_taken
+      revert_browser = self.future_browser is not None and not self._browser_taken
+      self._tv_taken = self._browser_taken = True
+
+    if not revert_tv and not revert_browser :
+      return
+    logger.info(f"discard warm up idm:{self.idm}")
+
+    def _revert(future_tv, future_browser) :
+      if future_tv is not None and not future_tv.cancel() :
+        try :
+          if future_tv.result() :
+            remocon.turnoff(TV_TURNOFF_WAIT, TV_TURNOFF_RETRY)
+        except Exception :
+          logger.exception("warm up tv failed.")
+      if future_browser is not None and not future_browser.cancel() :
+        try :
+          wb = future_browser.result()
+          if wb and _g_browser_pool :
+            _g_browser_pool.release(wb)
+        except Exception :
+          logger.exception("warm up browser failed.")
+
+    self._executor.submit(
+        _revert, self.future_tv if revert_tv else None, self.future_browser if revert_browser else None)
+
+
 # ##############################################################################
 class Cube() :
   """"""
@@ -352,7 +587,12 @@ class Cube() :
     """"""
     return self._open_time
 
-  def __init__(self) :
+  @property
+  def clock(self) -> clocks.Clock :
+    """ 時刻・待機に使う時計 """
+    return self._clock
+
+  def __init__(self, *, clock: clocks.Clock | None = None, bus: events.EventBus | None = None) :
     """"""
     with Cube._create_lock :
       if Cube._instance is not None:
@@ -361,11 +601,19 @@ class Cube() :
       super().__init__()
       logger.info(f'_cube.__init__({type(self)}:{self})')
 
+      self._clock = clock or clocks.get()
+
+      self._bus = bus or events.BUS
+
       self._distance =  _DistanceSensor(
-          interval=DISTANCE_INTERVAL, period=DISTANCE_PERIOD, threshold=DISTANCE_IS_THERE_OF_CHANGE, leave_threshold=DISTANCE_IS_NOT_THERE_OF_CHANGE)
+          interval=DISTANCE_INTERVAL, period=DISTANCE_PERIOD, threshold=DISTANCE_IS_THERE_OF_CHANGE, leave_threshold=DISTANCE_IS_NOT_THERE_OF_CHANGE
+          , clock=self._clock, bus=self._bus)
 
-      self._distance.on_enter = self.on_enter
-      self._distance.on_timeout = self.on_timeout
+      # 入室・タイムアウトの処理はセンサーのスレッドを止めないよう、購読のスレッドで発生順に行う
+      # on_enter() は _resource_access を取得するため、open() 等が保持している間は待たされ、
+      # この購読の後続のイベント (on_timeout() 等) も待つ
+      self._distance_subscription = self._bus.subscribe(
+          DistanceEvent, self._on_distance_event, name='cube.distance')
 
       self._has_patient_entered = False
 
@@ -387,11 +635,23 @@ class Cube() :
 
       self._resource_access = RLock()
 
+      self._prefetch = None
+      self._prefetch_lock = Lock()
+      self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=2, thread_name_prefix="prefetch")
+
+      self._warm_up = None
+      self._warm_up_timer = None
+      self._warm_up_lock = Lock()
+      self._warm_up_executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=4, thread_name_prefix="warm_up")
+
       Cube._instance = self
 
   def stop(self) :
     """"""
     try :
+      self._distance_subscription.unsubscribe()
       if self._session :
         self._session = None
 
@@ -404,8 +664,18 @@ class Cube() :
         try :
           self._distance.stop()
         finally :
-          if self._whiteboard :
-            self._whiteboard.close()
+          try :
+            self.discard_prefetch()
+            self._prefetch_executor.shutdown(wait=False)
+            self.discard_warm_up()
+            self._warm_up_executor.shutdown(wait=False)
+          finally :
+            try :
+              if self._whiteboard :
+                self._whiteboard.close()
+            finally :
+              if TV_CONTROL :
+                remocon.close()
 
   def is_doctor_ready(self):
     return self._doctor_ready.is_set()
@@ -414,7 +684,7 @@ class Cube() :
     return self._doctor_ready.set()
 
   def wait_for_doctor_ready(self, timeout:float|None=None)->bool:
-    return self._doctor_ready.wait(timeout)
+    return self._clock.wait(self._doctor_ready, timeout)
 
   def enter_wait(self):
     self._distance.enter_wait()
@@ -423,7 +693,7 @@ class Cube() :
     self._distance.is_enter()
 
   def wait_for_close_consultation(self, timeout: float | None = None) -> bool:
-    return self._finish_event.wait(timeout)
+    return self._clock.wait(self._finish_event, timeout)
 
   def is_closed_consultation(self) -> bool :
     return self._finish_event.is_set()
@@ -438,6 +708,8 @@ class Cube() :
 
   # ############################################################################
   def on_enter(self) :
+    logs.update_session(phase='enter')
+    tracing.end_span('distance.wait_enter')
     with self._resource_access:
       logger.info(
           f'on enter. reservation_id:{self.reservation_id} idm:{self.idm} doctor is ready:{self._doctor_ready.is_set()}')
@@ -461,33 +733,51 @@ class Cube() :
     if self._distance.is_awaiting_entry:
       terminate_consultation()
 
+  def _on_distance_event(self, event: DistanceEvent) :
+    if event.sensor is not self._distance :
+      return
+    if isinstance(event, PatientEntered) :
+      self.on_enter()
+    elif isinstance(event, DistanceTimeout) :
+      self.on_timeout()
+
   # ############################################################################
-  def open(self, session:onlinemed.Session, mode=None) :
+  def open(self, session:onlinemed.Session, mode=None, warm_up: _WarmUp | None = None) :
     """ cube_openコマンド受信時の処理
+
+    warm_up は take_warm_up() で受け取ったタッチ時の準備。元に戻すのは呼び出し側で行う。
     """
     if self._resource_access.acquire(timeout=10.0):
       try:
         if not self._session :
 
-          open_time = time.time()
+          open_time = self._clock.time()
 
           logger.info(
               f'cube open reservation_id: {session.reservation_id} idm:{session.idm} mode:{mode} MODEL:{MODEL} time:{open_time:0.3f}')
 
           if LIGHT_WITH :
             # light on
-            light_on()
+            with tracing.span('light.on') :
+              light_on()
           try:
-            if TV_CONTROL :
-              remocon.turnon(TV_TURNON_WAIT, TV_TURNON_RETRY)
+            if TV_CONTROL and _is_available('tv') :
+              # タッチ時に電源を入れ始めていれば、完了を待つだけにする
+              with tracing.span('tv.turnon', warm_up=bool(warm_up)) :
+                if not (warm_up and warm_up.take_tv()) :
+                  remocon.turnon(TV_TURNON_WAIT, TV_TURNON_RETRY)
             try :
               if MODEL == MODEL_CUBE:
-                t = time.time()
+                t = self._clock.monotonic()
                 # 電子錠を解錠する。
                 door_controller = door_control.get_controller()
                 logger.debug(f"unlock door.(by cube.open())")
-                door_controller.disengage_lock()
-                logger.info(f"door was unlocked at {time.time()-t:0.3f}")
+                with tracing.span('door.unlock') :
+                  door_controller.disengage_lock()
+                logger.info(f"door was unlocked at {self._clock.monotonic()-t:0.3f}")
+                tap = _g_last_tap
+                if tap and tap.idm == session.idm :
+                  TAP_TO_UNLOCK_SECONDS.observe(time.monotonic() - tap.tapped_time)
 
                 if mode == 'continueus':
                   # continueus access mode ではドアは開放した状態で、患者を順に入れ替えながら診察する。
@@ -499,9 +789,13 @@ class Cube() :
 
                     try:
                       # ドアが開くのを待つ
-                      if door_controller.wait_for_open() :
+                      with tracing.span('door.wait_open') :
+                        is_opened = door_controller.wait_for_open()
+                      if is_opened :
                         # 患者がまだ入室してなければ、入室を待つ。
                         if not self._has_patient_entered :
+                          # on_enter() で終了する
+                          tracing.start_span('distance.wait_enter')
                           self.wait_enter()
                     except door_control.TimeoutException as e:
                       # ドアが規定時間内に開かなかったら、door_controller.wait_for_open()で
@@ -516,21 +810,146 @@ class Cube() :
               self._access_mode = mode
               self._open_time = open_time
             except :
-              if TV_CONTROL :
-                remocon.turnoff(TV_TURNOFF_WAIT, TV_TURNOFF_RETRY)
+              if TV_CONTROL and _is_available('tv') :
+                # 期限を過ぎていても消す
+                with resilience.deadline(None, inherit=False) :
+                  remocon.turnoff(TV_TURNOFF_WAIT, TV_TURNOFF_RETRY)
               raise
           except :
             if LIGHT_WITH:
               logger.info(f'light off... because {__class__}.open has occuert exception')
-              light_off()
+              with resilience.deadline(None, inherit=False) :
+                light_off()
             raise
       finally :
         self._resource_access.release()
   # ############################################################################
+  def prefetch(self, reservation_id, warm_up: _WarmUp | None = None) -> None :
+    """ 通話画面とホワイトボードを先行して読み込む。
+
+    診察開始(consultation_start)を待たずに、医者と患者の準備を待つ間に
+    ページの読み込みを済ませておく。診察が開始されなかった場合は
+    discard_prefetch()で破棄する。
+    warm_up を渡した場合は、タッチ時に用意したブラウザを受け取って使う。
+    """
+
+    def prefetch_browser(reservation_id, warm_up_browser: concurrent.futures.Future | None) :
+      url = _patient_url(reservation_id)
+      logger.info(f"prefetch browser url {url}")
+      wb = None
+      if warm_up_browser :
+        try :
+          wb = warm_up_browser.result(60.0)
+        except Exception :
+          logger.exception("warm up browser failed.")
+      if wb :
+        # タッチ時にサイトを読み込んだブラウザで、通話画面を開く
+        try :
+          wb.get(url)
+          return wb
+        except Exception :
+          logger.exception("warm up browser is not available.")
+          _g_browser_pool.discard(wb)
+      return _g_browser_pool.acquire(url, timeout=60.0, hidden=True)
+
+    def prefetch_whiteboard(wb: Whiteboard, reservation_id) -> bool :
+      return wb.preload(reservation_id)
+
+    with self._prefetch_lock :
+      if self._prefetch :
+        if self._prefetch.reservation_id == reservation_id :
+          return
+    self.discard_prefetch()
+
+    with self._prefetch_lock :
+      logger.info(f"prefetch reservation_id:{reservation_id}")
+      future_browser = None
+      if MODEL != MODEL_PORTABLE and _g_browser_pool and _is_available('browser_pool') :
+        warm_up_browser = warm_up.take_browser() if warm_up else None
+        future_browser = tracing.submit(
+            self._prefetch_executor, 'prefetch.browser', prefetch_browser, reservation_id, warm_up_browser)
+      future_whiteboard = None
+      if MODEL != MODEL_PORTABLE and self._whiteboard and self._whiteboard.preload_supported :
+        future_whiteboard = tracing.submit(
+            self._prefetch_executor, 'prefetch.whiteboard', prefetch_whiteboard, self._whiteboard, reservation_id)
+      self._prefetch = _Prefetch(reservation_id, future_browser, future_whiteboard)
+
+  def _take_prefetch(self, reservation_id) -> _Prefetch | None :
+    """ 予約IDが一致する先行読み込みを取り出す。 """
+    with self._prefetch_lock :
+      prefetch = self._prefetch
+      if prefetch and prefetch.reservation_id == reservation_id :
+        self._prefetch = None
+        return prefetch
+    return None
+
+  def discard_prefetch(self) -> None :
+    """ 先行して読み込んだ通話画面とホワイトボードを破棄する。 """
+    with self._prefetch_lock :
+      prefetch = self._prefetch
+      self._prefetch = None
+
+    if not prefetch :
+      return
+
+    logger.info(f"discard prefetch reservation_id:{prefetch.reservation_id}")
+
+    def _discard(prefetch: _Prefetch, wb: Whiteboard) :
+      blowser = prefetch.browser()
+      if blowser and _g_browser_pool :
+        _g_browser_pool.release(blowser)
+      if wb and prefetch.whiteboard_loaded() :
+        wb.close()
+
+    self._prefetch_executor.submit(_discard, prefetch, self._whiteboard)
+
+  # ############################################################################
+  def warm_up(self, idm) -> None :
+    """ カードのタッチ時に、cube_open を待たずにテレビ・ブラウザ・リレーの準備を始める。
+
+    WARMUP_TIMEOUT 秒以内に open() で使われなかった場合は元に戻す。
+    """
+    with self._warm_up_lock :
+      if self._session or (self._warm_up and self._warm_up.idm == idm) :
+        return
+    self.discard_warm_up()
+
+    with self._warm_up_lock :
+      logger.info(f"warm up idm:{idm}")
+      self._warm_up = _WarmUp(idm, self._warm_up_executor)
+      self._warm_up.start()
+      self._warm_up_timer = Timer(WARMUP_TIMEOUT, self._expire_warm_up, args=(self._warm_up,))
+      self._warm_up_timer.daemon = True
+      self._warm_up_timer.start()
+
+  def _expire_warm_up(self, warm_up: _WarmUp) -> None :
+    with self._warm_up_lock :
+      if self._warm_up is not warm_up :
+        return
+    logger.info(f"warm up timeout idm:{warm_up.idm}")
+    self.discard_warm_up()
+
+  def take_warm_up(self) -> _WarmUp | None :
+    """ タッチ時に始めた準備を受け取る。受け取った側が最後に discard() すること """
+    with self._warm_up_lock :
+      warm_up = self._warm_up
+      self._warm_up = None
+      if self._warm_up_timer :
+        self._warm_up_timer.cancel()
+        self._warm_up_timer = None
+    return warm_up
+
+  def discard_warm_up(self) -> None :
+    """ タッチ時に始めた準備を元に戻す """
+    warm_up = self.take_warm_up()
+    if warm_up :
+      warm_up.discard()
+
+  # ############################################################################
   def web_open(self, reservation_id) -> None :
     """ web_openコマンド受信時の処理
     """
-    with self._resource_access:
+    with self._resource_access, tracing.span('web_open') :
       logger.info(
           f'cube web open mode:{self.mode} reservation_id:{reservation_id}')
       # 医者が待機中の状態に設定
@@ -545,32 +964,57 @@ class Cube() :
   def consultation_start(self) :
     """ 診察を開始する。
     """
+    logs.update_session(phase='consultation')
+    CONSULTATIONS.labels(self._access_mode or 'normal').inc()
 
-    def open_whiteboard(wb: Whiteboard, reservation_id: object | None = None):
+    def open_whiteboard(wb: Whiteboard, reservation_id: object | None = None, prefetch: _Prefetch | None = None):
       """"""
       if isinstance(wb, Whiteboard):
+        if prefetch :
+          # 先行読み込みの完了を待ってから表示する
+          prefetch.whiteboard_loaded()
         wb.open(reservation_id)
 
-    def open_blowser(reservation_id: object | None = None):
+    def open_blowser(reservation_id: object | None = None, prefetch: _Prefetch | None = None):
       """"""
-      url = f"https://{ONLINEMED_PATIENT_URL}?reservation_id={reservation_id}"
+      if prefetch :
+        # 先行して読み込んだ通話画面を表示する
+        wb = prefetch.browser()
+        if wb is not None :
+          wb.show()
+          logger.info(f"selenium browser show prefetched page. reservation_id:{reservation_id}")
+          return wb
+
+      url = _patient_url(reservation_id)
       logger.info(f"selenium browser open url {url}")
+      if _g_browser_pool and _is_available('browser_pool') :
+        # 待機中のブラウザで通話画面へ移動する
+        wb = _g_browser_pool.acquire(url, timeout=60.0)
+        if wb is not None :
+          return wb
+        logger.warning("browser pool has no browser. open new browser.")
       return browser.open(
-          url, kiosk=ONLINEMED_PATIENT_KIOSK, profile=r"t8qam33a.OnlineMed Cube")
+          url, kiosk=ONLINEMED_PATIENT_KIOSK, profile=_BROWSER_PROFILE)
 
-    with self._resource_access :
+    with self._resource_access, tracing.span('consultation_start'), resilience.deadline(CONSULTATION_START_DEADLINE) :
       if self._session :
+        prefetch = self._take_prefetch(self.reservation_id)
         #
         with concurrent.futures.ThreadPoolExecutor(thread_name_prefix="consultation_start") as executor:
           # ホワイトボードを開く
-          future_open_whiteboard = executor.submit(open_whiteboard, self._whiteboard, self.reservation_id)
+          future_open_whiteboard = tracing.submit(
+              executor, 'whiteboard.open', open_whiteboard, self._whiteboard, self.reservation_id, prefetch)
           try :
             if MODEL != MODEL_PORTABLE:
               if not self._blowser :
                 # 通話画面を起動する
-                future_open_blowser = executor.submit(
-                    open_blowser, self.reservation_id)
+                future_open_blowser = tracing.submit(
+                    executor, 'browser.open', open_blowser, self.reservation_id, prefetch)
                 self._blowser = future_open_blowser.result()
+              elif prefetch :
+                prefetch_blowser = prefetch.browser()
+                if prefetch_blowser and _g_browser_pool :
+                  _g_browser_pool.release(prefetch_blowser)
           finally:
             future_open_whiteboard.result()
 
@@ -586,6 +1030,7 @@ class Cube() :
   def close_consultation(self):
     """ 退出時の処理
     """
+    logs.update_session(phase='close')
     logger.info(f'Cube.close_consultation() MODEL:{MODEL}')
     def _close_consultation_thread():
       """"""
@@ -608,15 +1053,17 @@ class Cube() :
 
           logger.debug(f'wait for close at door controller...')
           # ドアが閉じるのを待つ
-          door_controller.wait_for_close()
+          with tracing.span('door.wait_close') :
+            door_controller.wait_for_close()
           # if MODEL == MODEL_CUBE:
         try :
           if self._distance.wait_to_leave:
             # 患者が退出するのを待つ
             logger.debug(f'wait leave...')
-            self._distance.wait_leave()
-            logger.debug(f'fin wait for door close.')
-            self._distance.leave_wait()
+            with tracing.span('distance.wait_leave') :
+              self._distance.wait_leave()
+              logger.debug(f'fin wait for door close.')
+              self._distance.leave_wait()
           # 診察を完了する。
           self.finish_consultation()
         except door_control.LockTimeoutException:
@@ -626,7 +1073,7 @@ class Cube() :
       raise BusyError("deveice already in process.")
 
     try :
-      thread = Thread(target=_close_consultation_thread, daemon=False)
+      thread = Thread(target=tracing.wrap(_close_consultation_thread, 'close_consultation'), daemon=False)
       thread.start()
     finally:
       self._resource_access.release()
@@ -663,7 +1110,11 @@ class Cube() :
       cube._doctor_ready.clear()
 
       if cube._blowser:
-        cube._blowser.close()
+        if _g_browser_pool :
+          # ブラウザは終了せずに初期化して待機状態に戻す
+          _g_browser_pool.release(cube._blowser)
+        else :
+          cube._blowser.close()
       cube._blowser = None
 
     def terminate_tv(cube: Cube):
@@ -673,57 +1124,71 @@ class Cube() :
           f'remocon turnoff wait:{TV_TURNOFF_WAIT} retry:{TV_TURNOFF_RETRY}')
       remocon.turnoff(TV_TURNOFF_WAIT, TV_TURNOFF_RETRY)
 
-    with self._resource_access:
+    with self._resource_access, tracing.span('finish_consultation') :
       if self._session :
-
+        logs.update_session(phase='finish')
         logger.info(f'finish consultation. MODEL:{MODEL}')
 
-        # 照明を消す。
-        if LIGHT_WITH:
-          logger.info(f'light off...')
-          light_off()
+        # 周辺機器が応答しなくても期限までに終える
+        with resilience.deadline(FINISH_DEADLINE) :
+          # 照明を消す。
+          if LIGHT_WITH:
+            logger.info(f'light off...')
+            try :
+              light_off()
+            except resilience.ResilienceError :
+              # 照明を消せなくても診察は完了させる
+              logger.exception('light off failed.')
 
-        # 距離センサーを停止する。
-        self._distance.stop()
+          # 距離センサーを停止する。
+          self._distance.stop()
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="finish_consultation") as executor:
-          # サーバーへ患者の退出を通知する。
-          future_notify_patient_exit = executor.submit(notify_patient_exit, self)
-          try :
-            # ホワイトボードを閉じる
-            future_terminate_whiteboard = executor.submit(
-                terminate_whiteboard, self)
+          with concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="finish_consultation") as executor:
+            # サーバーへ患者の退出を通知する。
+            future_notify_patient_exit = tracing.submit(executor, 'notify_patient_exit', notify_patient_exit, self)
             try :
-              # ブラウザを閉じる
-              future_terminate_blowser = executor.submit(terminate_blowser, self)
+              # ホワイトボードを閉じる
+              future_terminate_whiteboard = tracing.submit(
+                  executor, 'whiteboard.close', terminate_whiteboard, self)
               try :
-                # TVを接続していれば、テレビを消す。
-                if TV_CONTROL:
-                  future_terminate_tv = executor.submit(terminate_tv, self)
-                  future_terminate_tv.result()
+                # ブラウザを閉じる
+                future_terminate_blowser = tracing.submit(executor, 'browser.close', terminate_blowser, self)
+                try :
+                  # TVを接続していれば、テレビを消す。
+                  if TV_CONTROL and _is_available('tv') :
+                    future_terminate_tv = tracing.submit(executor, 'tv.turnoff', terminate_tv, self)
+                    future_terminate_tv.result()
+                finally :
+                  future_terminate_blowser.result()
               finally :
-                future_terminate_blowser.result()
+                future_terminate_whiteboard.result()
             finally :
-              future_terminate_whiteboard.result()
-          finally :
-            future_notify_patient_exit.result()
+              future_notify_patient_exit.result()
 
-        # 距離センサーの停止を待つ
-        self._distance.join()
+          # 距離センサーの停止を待つ
+          self._distance.join()
 
         # 各処理が正常終了したかを確認する。
         if not self._sensor :
           if not self._blowser :
             # 完了を確認して、セッションを終了する。
             self._session = None
+            if self._open_time :
+              CONSULTATION_SECONDS.observe(self._clock.time() - self._open_time)
 
             # UVライトを点灯して、室内を消毒する。
             if UVLITE_WITH and 0.0 < UVLITE_PERIOD:
               logger.info(f'uv light on ... wait {UVLITE_PERIOD} sec.')
-              irradiate_uvlight(wait=UVLITE_WAIT_WHILE_LIT)
+              irradiate_uvlight(wait=UVLITE_WAIT_WHILE_LIT, clock=self._clock)
 
             terminate_consultation()
             logger.info(f'terminate onlinemed.')
+            logs.end_session()
+            tracing.end_trace(result='finished')
+            if _g_leak_monitor :
+              # 診察ごとに増えたスレッド・メモリ等を記録する (採取は別スレッドで行う)
+              Thread(target=_g_leak_monitor.mark, args=(f'consultation {self.reservation_id}',),
+                     name='LeakSample', daemon=True).start()
 
             self._finish_event.set()
 
@@ -736,6 +1201,8 @@ class Cube() :
     """
     self._session = None
     self._open_time = None
+    self.discard_prefetch()
+    self.discard_warm_up()
 
 # class _cube() :   ############################################################
 
@@ -743,9 +1210,35 @@ class Cube() :
 # ##############################################################################
 #
 # ##############################################################################
+def _wait_capability(name) -> bool :
+  """ 起動中であれば、機能 name に必要なサブシステムの準備を待つ (最大 CAPABILITY_WAIT_TIMEOUT 秒) """
+  orchestrator = _g_startup
+  if orchestrator is None or orchestrator.wait(name, CAPABILITY_WAIT_TIMEOUT) :
+    return True
+  logger.warning(f'{name} is not ready. waiting for {orchestrator.not_ready(name)}')
+  return False
+
+
+def _is_available(name) -> bool :
+  """ サブシステム name を使えるか。起動管理の対象でなければ True """
+  orchestrator = _g_startup
+  return orchestrator is None or name not in orchestrator or orchestrator.is_ready(name)
+
+
 def on_cube_open(client: onlinemed.Client):
+  logs.update_session(reservation_id=client.reservation_id, idm=client.idm, phase='open')
+  tracing.end_span('onlinemed.auth', authenticated=client.is_authenticated)
+  tracing.set_attributes(reservation_id=client.reservation_id)
   logger.info(f"Felica authentication. reservationid {client.reservation_id}")
-  if client.is_authenticated:
+  if client.is_authenticated and not _wait_capability('consultation') :
+    # ドアを操作できなければ診察を始めない
+    terminate_consultation()
+    logs.end_session()
+    tracing.end_trace(result='not_ready')
+  elif client.is_authenticated:
+    if _g_startup is not None and _g_startup.not_ready('devices') :
+      # カメラ・ブラウザプール・TV は無くても診察できる (使えないものは省略する)
+      logger.warning(f"consultation starts without {_g_startup.not_ready('devices')}")
     if _g_cube.reservation_id :
       # 暫定処理。Cube.reset()のdocstringを参照のこと。
       if _g_cube.reservation_id != client.reservation_id :
@@ -756,29 +1249,39 @@ def on_cube_open(client: onlinemed.Client):
           client.reservation_id, PORTABLE_MESSAGE_FILE, PORTABLE_MESSAGE_TIMEOUT)
       mode = None
     else :
-      # felica.csvにidmがある場合は、continueusモードで診療を行う。
-      felica_list_file = 'felica.csv'
-      felica_idm_list = []
-      if os.path.isfile(felica_list_file) :
-        try :
-          with open(felica_list_file, newline='') as csvfile:
-            csvreader_felica = csv.reader(csvfile, dialect='excel')
-            for row in csvreader_felica:
-              felica_idm_list.append(row[0])
-        except :
-          pass
-
-      if client.idm in felica_idm_list :
-        mode = 'continueus'
-      else :
-        mode = None
+      # felica.csvに登録されたidmの場合は、登録されたモード(continueus)で診療を行う。
+      mode = None
+      if _g_felica_registry and client.idm :
+        mode = _g_felica_registry.mode_of(client.idm, room=client.device_id)
+    # タッチ時の準備 (テレビ・ブラウザ) を受け取り、prefetch と open へ渡す
+    warm_up = _g_cube.take_warm_up()
+    if warm_up :
+      logger.info(f'cube open {time.monotonic() - warm_up.started:0.3f}s after warm up started.')
     try :
-      _g_cube.open(client.session, mode)
-    except door_control.Exception:
+      if MODEL != MODEL_PORTABLE :
+        # 診察開始を待たずに通話画面とホワイトボードの読み込みを始める
+        _g_cube.prefetch(client.reservation_id, warm_up)
+      with resilience.deadline(CUBE_OPEN_DEADLINE), tracing.span('cube.open', mode=mode) :
+        _g_cube.open(client.session, mode, warm_up)
+    except door_control.DoorControlException:
       # 正常終了しなかったら、
       terminate_consultation()
+      logs.end_session()
+      tracing.end_trace(result='door_timeout')
+    except resilience.ResilienceError as e :
+      # リレー等の周辺機器が応答しない、または期限を過ぎた
+      logger.warning(f"cube open failed. {type(e).__name__}: {e}")
+      terminate_consultation()
+      logs.end_session()
+      tracing.end_trace(result='peripheral_unavailable')
+    finally :
+      if warm_up :
+        # 受け取られなかった準備を元に戻す
+        warm_up.discard()
   else :
     terminate_consultation()
+    logs.end_session()
+    tracing.end_trace(result='unauthenticated')
 # def on_cube_open() :  ########################################################
 
 
@@ -894,6 +1397,20 @@ def on_panel_func_exit(client: onlinemed.Client, status):
 # ##############################################################################
 onlinemed_client = None
 def authentication(idm) :
+  if not (logs.current_session() and logs.current_session().idm == idm) :
+    # 以降のログをこのカードのセッションとして索引に記録する
+    session = logs.begin_session(idm=idm, phase='authentication')
+    # タッチした時刻から診察のトレースを開始する
+    tap = _g_last_tap
+    tapped_time = tracing.wall_time(tap.tapped_time) if tap and tap.idm == idm else None
+    tracing.begin_trace('consultation', start_time=tapped_time, idm=idm, session=session.seq)
+    if tapped_time is not None :
+      tracing.start_span('felica.tap', start_time=tapped_time).end()
+  with tracing.span('authentication') :
+    _authentication(idm)
+
+
+def _authentication(idm) :
   global onlinemed_client
 
   logger.info(f'cube authentication idm {idm} onlinemed_client:{onlinemed_client}')
@@ -901,6 +1418,9 @@ def authentication(idm) :
   if MODEL == MODEL_PORTABLE :
     portable.send_start_message(
         idm, PORTABLE_MESSAGE_FILE, PORTABLE_MESSAGE_TIMEOUT)
+  elif WARMUP and _g_cube :
+    # サーバの応答を待つ間に、テレビ等の準備を始めておく
+    _g_cube.warm_up(idm)
 
   if not onlinemed_client:
 
@@ -909,23 +1429,20 @@ def authentication(idm) :
                                         , ONLINEMED_CUBE_ROOT_TOPIC
                                         , ONLINEMED_PATIENT_URL)
 
-    client.on_request_cube_open = on_cube_open
-    client.on_request_web_open = on_web_open
-    client.on_request_shoot_spo2 = on_request_spo2
-    client.on_request_shoot_usbcamera = on_request_usbcamera
-    client.on_panel_function = on_panel_function
-    client.on_panel_func_button = on_panel_func_button
-    client.on_panel_func_stop = on_panel_func_stop
-    client.on_panel_func_exit = on_panel_func_exit
-
-    result, deviceid = tcu.client.request(
-        "deviceid", address=(TCUPI_DAEMON_HOST, TCUPI_DAEMON_PORT))
-    if result == tcu.constant.CODE_SUCCESS :
+    # 起動時に問い合わせたデバイスIDを使用する (未取得の場合のみ問い合わせる)
+    try :
+      deviceid = identity.daemon_device_id(_tcud_request)
+    except resilience.ResilienceError as e :
+      logger.warning(f"deviceid request failed. {type(e).__name__}: {e}")
+      deviceid = None
+    if deviceid is not None :
       client.device_id = deviceid
 
     onlinemed_client = client
 
   try :
+    # cube_open (on_cube_open()) の受信で終了する
+    tracing.start_span('onlinemed.auth')
     onlinemed_client.authentication(idm, timeout=10.0)
   except onlinemed.DoubleAuthError as e:
     logger.info(f"Onlinemed authentication is already in progress.\n{str(e)}")
@@ -940,56 +1457,67 @@ def terminate_consultation() :
       onlinemed_client.disconnect()
   finally :
     onlinemed_client = None
+    if _g_cube :
+      # 診察が開始されなかった場合の先行読み込みを破棄する
+      _g_cube.discard_prefetch()
+      _g_cube.discard_warm_up()
 # def authentication() : #######################################################
 
 
+def _patient_url(reservation_id) -> str :
+  """ 通話画面のURL """
+  return f"https://{ONLINEMED_PATIENT_URL}?reservation_id={reservation_id}"
+
+
 def light_on() :
   """"""
   logger.info("light on")
-  rest_msg = tcu.relay.client.light_on((TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
+  rest_msg = RELAY.call(tcu.relay.client.light_on, (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
   client_request(rest_msg)
 
 
 def light_off() :
   """"""
   logger.info("light off")
-  rest_msg = tcu.relay.client.light_off((TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
+  rest_msg = RELAY.call(tcu.relay.client.light_off, (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
   client_request(rest_msg)
 
 
 def uvlight_on() :
   """"""
   logger.info("uvlight on")
-  rest_msg = tcu.relay.client.uvlight_on((TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
+  rest_msg = RELAY.call(tcu.relay.client.uvlight_on, (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
   client_request(rest_msg)
 
 
 def uvlight_off() :
   """"""
   logger.info("uvlight off")
-  rest_msg = tcu.relay.client.uvlight_off((TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
+  rest_msg = RELAY.call(tcu.relay.client.uvlight_off, (TCUPI_RELAY_HOST, TCUPI_RELAY_PORT))
   client_request(rest_msg)
 
 
-def irradiate_uvlight(*, wait=False) :
+def irradiate_uvlight(*, wait=False, clock: clocks.Clock | None = None) :
   """"""
+  clock = clock or clocks.get()
   #
   def _irradiate_uvlight(period) :
     rest_msg = uvlight_on()
     client_request(rest_msg)
-    start = time.time()
+    start = clock.monotonic()
     while True :
-      time.sleep(0.1)
-      t = time.time()
+      clock.sleep(0.1)
+      t = clock.monotonic()
       if period <= t - start :
         rest_msg = uvlight_off()
         client_request(rest_msg)
         break
 
   if wait :
-    _irradiate_uvlight(UVLITE_PERIOD)
+    with tracing.span('uvlight', period=UVLITE_PERIOD) :
+      _irradiate_uvlight(UVLITE_PERIOD)
   else :
-    thread = Thread(target=_irradiate_uvlight, args=(UVLITE_PERIOD,))
+    thread = Thread(target=tracing.wrap(_irradiate_uvlight, 'uvlight'), args=(UVLITE_PERIOD,))
     thread.start()
 
 
@@ -1031,40 +1559,91 @@ def on_switch() :
       logger.info(f"Cube Busy. {type(e)}: {e}")
 
 
+def on_leak_suspected(label, exceeded: dict, growth: dict):
+  """ リークの疑いがある場合の処理 """
+  if 'threads' in exceeded :
+    # 増えたスレッドがどこで止まっているかを残しておく
+    diagnostics.write_stacks()
+
+
+def on_entry_published(event: onlinemed.EntryPublished):
+  if _g_tap_queue :
+    _g_tap_queue.record_published(event.idm)
+
+
+# サーバからのコマンドごとの処理 (ハンドラ, status を渡すか)
+_SERVER_COMMAND_HANDLERS = {
+    onlinemed.CubeOpenRequested : (on_cube_open, False),
+    onlinemed.WebOpenRequested : (on_web_open, False),
+    onlinemed.ShootSpo2Requested : (on_request_spo2, False),
+    onlinemed.ShootUsbCameraRequested : (on_request_usbcamera, False),
+    onlinemed.PanelFunction : (on_panel_function, True),
+    onlinemed.PanelFuncButton : (on_panel_func_button, True),
+    onlinemed.PanelFuncStop : (on_panel_func_stop, True),
+    onlinemed.PanelFuncExit : (on_panel_func_exit, True),
+}
+
+
+def on_server_command(event: onlinemed.ServerCommand):
+  """ サーバからのコマンドを処理する (MQTT のスレッドは待たせない) """
+  handler, with_status = _SERVER_COMMAND_HANDLERS[type(event)]
+  if with_status :
+    handler(event.client, event.status)
+  else :
+    handler(event.client)
+
+
 def felica_reader_on_connected(tag):
   """"""
-  if isinstance(tag, nfc.tag.tt3.Type3Tag):
+  if isinstance(tag, tt3.Type3Tag):
     binidm = binascii.hexlify(tag.identifier).upper()
     idm = binidm.decode('utf-8')
-    try:
-      if MODEL == MODEL_PANEL:
-        if _g_cube.reservation_id:
-          logger.info(
-              f"Felica authentication idm:{idm} reservation_id:{_g_cube.reservation_id}.")
-          if _g_cube.open_time:
-            t = time.time()
-            if t >= _g_cube.open_time + FELICA_SWITCH_INTERVAL:
-              if _g_cube.idm and _g_cube.idm == idm:
-                try :
-                  _g_cube.close_consultation()
-                except BusyError as e:
-                  logger.info(f"Cube Busy. {type(e)}: {e}")
-        else:
-          authentication(idm)
-      else:
-        authentication(idm)
-    # except TimeoutError as e:
-    except socket.gaierror:
-      pass
-    except TimeoutError:
-      pass
-    except:
-      logger.exception('')
+    if _g_tap_queue :
+      # 認証はTapQueueのスレッドで行い、リーダーはすぐにポーリングへ戻る
+      _g_tap_queue.put(idm)
+    else :
+      on_felica_tap(felica.Tap(idm, time.monotonic()))
 
   return True  # カードが離れるまでに1回のみ
 # def felica_reader_on_connected(tag):
 
 
+def on_felica_tap(tap: 'felica.Tap'):
+  """"""
+  global _g_last_tap
+  _g_last_tap = tap
+  idm = tap.idm
+  if not _wait_capability('entry') :
+    # サーバ・tcud へ接続できるまでは認証できない
+    logger.info(f"Felica tap ignored. idm:{idm}")
+    return
+  try:
+    if MODEL == MODEL_PANEL:
+      if _g_cube.reservation_id:
+        logger.info(
+            f"Felica authentication idm:{idm} reservation_id:{_g_cube.reservation_id}.")
+        if _g_cube.open_time:
+          t = _g_cube.clock.time()
+          if t >= _g_cube.open_time + FELICA_SWITCH_INTERVAL:
+            if _g_cube.idm and _g_cube.idm == idm:
+              try :
+                _g_cube.close_consultation()
+              except BusyError as e:
+                logger.info(f"Cube Busy. {type(e)}: {e}")
+      else:
+        authentication(idm)
+    else:
+      authentication(idm)
+  # except TimeoutError as e:
+  except socket.gaierror:
+    pass
+  except TimeoutError:
+    pass
+  except:
+    logger.exception('')
+# def on_felica_tap(tap): ######################################################
+
+
 def on_changed_message_file(event):
   """"""
   logger.info(f'on_changed_message_file {event}')
@@ -1162,11 +1741,95 @@ async def client_connected(reader:asyncio.StreamReader, writer:asyncio.StreamWri
   except :
     logger.exception(f"client_connected has occerrd exception. peername:{peername} sockname:{sockname}.")
 
+
+class Serving(events.Event) :
+  """ cube のサーバが接続を受け付け始めた """
+  __slots__ = ('address',)
+
+  def __init__(self, address) :
+    self.address = address
+
+
 _g_serving_event = Event()
 _g_async_event_stop = asyncio.Event()
 _g_cube = None
 _g_thread = None
 _g_loop = None
+async def _probe_connection(host, port) :
+  """ TCPで接続できるか確認する """
+  reader, writer = await asyncio.open_connection(host, port)
+  writer.close()
+  await writer.wait_closed()
+
+
+def _create_startup(felica_reader: 'felica.Reader') -> startup.Orchestrator :
+  """ 起動時に立ち上げるサブシステムと、機能ごとに必要なサブシステム """
+  orchestrator = startup.Orchestrator()
+
+  def start_identity() :
+    # 機器の識別情報を調べておき、以降はネットワークの変更時のみ調べ直す
+    identity.get()
+    identity.start_monitor()
+
+  def start_tcud() :
+    if identity.daemon_device_id(_tcud_request) is None :
+      raise ConnectionError('deviceid request failed.')
+
+  async def start_relay() :
+    resp = await tcu.relay.client.get_status_async((TCUPI_RELAY_HOST, TCUPI_RELAY_PORT), 5.0)
+    if not resp :
+      raise ConnectionError('relay server did not respond.')
+    client_request(resp)
+
+  async def start_camera() :
+    await _probe_connection(TCUPI_CAMERA_HOST, TCUPI_CAMERA_PORT)
+
+  async def start_broker() :
+    await _probe_connection(ONLINEMED_SERVER_URL, ONLINEMED_SERVER_PORT)
+
+  def start_felica() :
+    if felica_reader.ident is None :
+      felica_reader.start()
+    if not felica_reader.wait(5.0) :
+      raise felica_reader.exception or TimeoutError('FeliCa reader is not ready.')
+
+  def start_browser_pool() :
+    _g_browser_pool.start()
+    if not _g_browser_pool.wait_ready(60.0) :
+      raise TimeoutError('browser pool is not ready.')
+
+  def start_tv() :
+    if not remocon.connect() :
+      raise ConnectionError('cec-client is not available.')
+
+  orchestrator.add('identity', start_identity)
+  orchestrator.add('tcud', start_tcud, ('identity',), attempt_timeout=10.0)
+  orchestrator.add('relay', start_relay, attempt_timeout=10.0)
+  orchestrator.add('broker', start_broker, ('identity',), attempt_timeout=10.0)
+  orchestrator.add('felica', start_felica)
+  entry = ['felica', 'broker', 'tcud']
+  devices = []
+  if MODEL != MODEL_PORTABLE :
+    orchestrator.add('camera', start_camera, ('identity',), attempt_timeout=5.0)
+    devices.append('camera')
+  if _g_browser_pool :
+    orchestrator.add('browser_pool', start_browser_pool, max_delay=30.0)
+    devices.append('browser_pool')
+  if TV_CONTROL :
+    orchestrator.add('tv', start_tv, max_delay=60.0)
+    devices.append('tv')
+
+  # タッチして認証できる
+  orchestrator.capability('entry', *entry)
+  # ドアと照明を操作できる
+  orchestrator.capability('door', 'relay')
+  # 診察を行える
+  orchestrator.capability('consultation', 'relay')
+  # 診察で使う機器 (準備ができていなければ、その機器を使わずに診察する)
+  orchestrator.capability('devices', *devices)
+  return orchestrator
+
+
 async def start_async(host: str | None = None, port: int | None = None, loop: asyncio.AbstractEventLoop | None = None):
   """"""
   global _g_serving_event
@@ -1174,6 +1837,12 @@ async def start_async(host: str | None = None, port: int | None = None, loop: as
   global _g_cube
   global _g_loop
   global _g_thread
+  global _g_browser_pool
+  global _g_felica_registry
+  global _g_tap_queue
+  global _g_startup
+  global _g_leak_monitor
+  global _g_subscriptions
 
   if not host :
     host = TCUPI_HOST
@@ -1215,7 +1884,7 @@ async def start_async(host: str | None = None, port: int | None = None, loop: as
       addr = async_server.sockets[0].getsockname()
 
       logger.info(f'Serving on {addr}')
-      _callback_on_serving()
+      events.publish(Serving(addr))
       _g_serving_event.set()
       try :
         door_control.create_controller(UNLOCK_TIMEOUT)
@@ -1223,55 +1892,93 @@ async def start_async(host: str | None = None, port: int | None = None, loop: as
 
         _g_cube = Cube()
         logger.info(f'_g_cube create Instance... {_g_cube}')
+        # サーバからのコマンドは種類ごとに受信した順に処理する
+        # (cube_open は扉が開くまで待つため、web_open・撮影・操作パネルのコマンドを待たせない)
+        _g_subscriptions = [
+            events.subscribe(onlinemed.CubeOpenRequested, on_server_command, name='onlinemed.cube_open'),
+            events.subscribe(onlinemed.WebOpenRequested, on_server_command, name='onlinemed.web_open'),
+            events.subscribe(onlinemed.ShootRequested, on_server_command, name='onlinemed.shoot'),
+            events.subscribe(onlinemed.PanelCommand, on_server_command, name='onlinemed.panel'),
+            events.subscribe(onlinemed.EntryPublished, on_entry_published, name='onlinemed.entry'),
+        ]
+
+        if MODEL != MODEL_PORTABLE :
+          _g_felica_registry = felica_registry.Registry(FELICA_LIST_FILE)
+          if FELICA_LIST_WATCH :
+            _g_felica_registry.watch()
+          else :
+            _g_felica_registry.reload()
+
+        if MODEL != MODEL_PORTABLE and 0 < ONLINEMED_PATIENT_BROWSER_POOL :
+          # 通話画面用のブラウザを事前に起動しておく (起動は startup で行う)
+          _g_browser_pool = browser.BrowserPool(
+              ONLINEMED_PATIENT_BROWSER_POOL, kiosk=ONLINEMED_PATIENT_KIOSK, profile=_BROWSER_PROFILE)
+          logger.info(f'BrowserPool create Instance... {_g_browser_pool}')
         try :
           Switches.getInstance()
           logger.info('Switches create Instance...')
 
+          _g_tap_queue = felica.TapQueue(on_felica_tap, FELICA_TAP_WINDOW, daemon=True)
+          _g_tap_queue.start()
           _felica_reader = felica.Reader(on_connected=felica_reader_on_connected)
+          _g_startup = _create_startup(_felica_reader)
+          startup_task = asyncio.ensure_future(_g_startup.run(_g_async_event_stop))
+          # 各モジュールの統計を計測値として出力する
+          metrics.collector('felica_taps', lambda : _g_tap_queue.stats() if _g_tap_queue else None)
+          metrics.collector('felica_reader', _felica_reader.stats)
+          metrics.collector('startup', _g_startup.report)
+          metrics.collector('import', lazy.report)
+          metrics.collector('log', logs.stats)
+          metrics.collector('trace', tracing.stats)
+          resilience.configure(failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT)
+          metrics.collector('breaker', resilience.stats)
+          metrics.collector('events', events.stats)
+          if TRACE_FORMAT and TRACE_FORMAT != 'none' :
+            trace_file = TRACE_FILE
+            if not trace_file and logs.log_file() :
+              trace_file = os.path.join(os.path.dirname(logs.log_file()), 'trace.jsonl')
+            tracing.configure(trace_file, TRACE_FORMAT, {'service.name': 'cube', 'host.name': socket.gethostname()})
+          metrics_publisher = None
+          if METRICS_PORT :
+            try :
+              metrics.serve(METRICS_HOST, METRICS_PORT)
+            except OSError :
+              logger.exception(f'metrics server is not available. {METRICS_HOST}:{METRICS_PORT}')
           try:
-            _felica_reader.start()
-
-            _occured_exception = None
-            while not _g_async_event_stop.is_set():
-              try:
-                resp = await tcu.relay.client.get_status_async((TCUPI_RELAY_HOST, TCUPI_RELAY_PORT), 20)
-                if resp :
-                  client_request(resp)
-                  break
-              except (ConnectionError, asyncio.TimeoutError) as e:
-                if type(_occured_exception) != type(e) :
-                  logger.warning(f"wait connect relay server... {type(e)}:{e}")
-                _occured_exception = e
-              except OSError as e:
-                if os.name == 'nt':
-                  if type(_occured_exception) != type(e):
-                    logger.warning(
-                        f"wait connect relay server... {type(e)}:errno {e.errno} winerrno {e.winerror} {e}")
-                else :
-                  if type(_occured_exception) != type(e):
-                    logger.exception(
-                        f"wait connect relay server... {type(e)}:errno {e.errno} {e}")
-                _occured_exception = e
-              except KeyboardInterrupt:
-                raise
-              except asyncio.exceptions.CancelledError:
-                raise
-              except Exception as e:
-                if type(_occured_exception) != type(e):
-                  logger.exception(
-                      f"An unexpected error occurred while connecting to the relay server.")
-                _occured_exception = e
-
-
-              await asyncio.sleep(10.0)
-
-            if _g_async_event_stop.is_set() :
+            # 各サブシステムは並行して立ち上げ、リレーサーバへ接続できたら動作を開始する
+            if not await _g_startup.wait_async('door', _g_async_event_stop) :
               return
+            logger.info(lazy.format_report())
+
+            if 0.0 < LEAK_INTERVAL :
+              # 起動の完了後から監視する (最初の採取が基準になる)
+              leaks.start_tracemalloc(LEAK_TRACEMALLOC_FRAMES)
+              _g_leak_monitor = leaks.Monitor(LEAK_INTERVAL, {
+                  'memory_bytes': int(LEAK_MEMORY_GROWTH_MB * 1024 * 1024),
+                  'threads': LEAK_THREAD_GROWTH,
+                  'children': LEAK_CHILD_GROWTH,
+                  'fds': LEAK_FD_GROWTH,
+                  'objects': LEAK_OBJECT_GROWTH,
+              }, on_alert=on_leak_suspected)
+              _g_leak_monitor.start()
+              metrics.collector('leak', _g_leak_monitor.stats)
+
+            if 0.0 < METRICS_MQTT_INTERVAL :
+              metrics_publisher = metrics.MqttPublisher(
+                  ONLINEMED_SERVER_URL, ONLINEMED_SERVER_PORT,
+                  f'{ONLINEMED_CUBE_ROOT_TOPIC}/status/{identity.get().device_id}', METRICS_MQTT_INTERVAL)
+              metrics_publisher.start()
 
             if MODEL == MODEL_PORTABLE :
               observer = fwatchdog.observe(PORTABLE_MESSAGE_R_FILE)
-              observer.on_created = on_changed_message_file
-              observer.on_modified = on_changed_message_file
+
+              def on_message_file_event(event: fwatchdog.FileChanged) :
+                if event.observer is observer and (
+                    fwatchdog.is_created(event.event) or fwatchdog.is_modified(event.event)) :
+                  on_changed_message_file(event.event)
+
+              _g_subscriptions.append(events.subscribe(
+                  fwatchdog.FileChanged, on_message_file_event, name='portable.message'))
               observer.start()
               logger.debug('cube observer.start()')
             else :
@@ -1286,12 +1993,32 @@ async def start_async(host: str | None = None, port: int | None = None, loop: as
                 observer.join()
                 logger.debug('observer.stop()')
           finally:
+            if not startup_task.done() :
+              startup_task.cancel()
+            if metrics_publisher :
+              metrics_publisher.stop()
+            if _g_leak_monitor :
+              _g_leak_monitor.stop()
+              _g_leak_monitor = None
+            metrics.shutdown()
             _felica_reader.stop()
             logger.debug('_felica_reader.stop()')
+            _g_tap_queue.stop()
+            _g_tap_queue = None
         finally:
+          for subscription in _g_subscriptions :
+            subscription.unsubscribe()
+          _g_subscriptions = []
           if _g_cube :
             _g_cube.stop()
             _g_cube = None
+          if _g_browser_pool :
+            _g_browser_pool.close()
+            _g_browser_pool = None
+          if _g_felica_registry :
+            _g_felica_registry.close()
+            _g_felica_registry = None
+          identity.stop_monitor()
           logger.debug('cube exit')
       except KeyboardInterrupt :
         raise
@@ -1309,6 +2036,10 @@ def is_serving(timeout=0.0) :
   """"""
   return _g_serving_event.wait(timeout)
 
+def is_running() -> bool :
+  """ start_async() が待ち受けを始めてから終了するまでの間は True """
+  return _g_thread is not None
+
 def stop():
   """"""
   logger.debug(f'medcube.stop() start. _g_thread:{_g_thread}')
@@ -1331,14 +2062,6 @@ def stop():
         logger.debug('medcube.stop(). Stopped from another thread.')
 
 
-def _callback_on_serving():
-  pass
-
-
-def set_callback_on_serving(callback) :
-  global _callback_on_serving
-  if callable(callback) :
-    _callback_on_serving = callback
 
 if __name__ == '__main__':
   # start()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 動作状況の計測値 (メトリクス)
+
+カウンタ・ゲージ・ヒストグラム (固定のバケット) を登録して値を記録し、
+Prometheus のテキスト形式で出力する。
+
+  TCUD_REQUEST = metrics.histogram('cube_tcud_request_seconds', 'tcud request time', ('command',))
+  with TCUD_REQUEST.labels(command='distance').time() :
+    ...
+
+各モジュールが独自に持っている統計 (TapQueue.stats() 等) は collector() で登録すると、
+出力するときに呼び出してゲージとして出力する。
+
+serve() でローカルの HTTP (/metrics, /metrics.json) に、MqttPublisher で
+定期的に MQTT に出力する。
+
+共有する状態を持つので、他のモジュールからは `from cube import metrics` で参照すること。
+"""
+import bisect
+from contextlib import contextmanager
+import http.server
+import json
+from logging import getLogger
+import math
+import re
+import threading
+import time
+
+logger = getLogger(__name__)
+
+# 処理時間 (秒) のバケット
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NAME_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _format_value(value) -> str :
+  if value == math.inf :
+    return '+Inf'
+  if isinstance(value, bool) :
+    return '1' if value else '0'
+  if isinstance(value, int) :
+    return str(value)
+  return repr(float(value))
+
+
+def _format_labels(labelnames, labelvalues, extra=()) -> str :
+  pairs = list(zip(labelnames, labelvalues)) + list(extra)
+  if not pairs :
+    return ''
+  escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+  return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric(object) :
+  """ 値をラベルの組み合わせごとに持つ計測値 """
+  kind = None
+
+  def __init__(self, name, help='', labelnames=()) :
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self._lock = threading.Lock()
+    self._children = {}
+    if not self.labelnames :
+      self._default = self._children[()] = self._create()
+
+  def _create(self) :
+    raise NotImplementedError
+
+  def labels(self, *values, **kwargs) :
+    if kwargs :
+      values = tuple(kwargs[name] for name in self.labelnames)
+    values = tuple(str(value) for value in values)
+    if len(values) != len(self.labelnames) :
+      raise ValueError(f'{self.name} requires labels {self.labelnames}.')
+    child = self._children.get(values)
+    if child is None :
+      with self._lock :
+        child = self._children.setdefault(values, self._create())
+    return child
+
+  def samples(self) :
+    """ [(名前の接尾辞, ラベルの値, 追加のラベル, 値)] """
+    raise NotImplementedError
+
+
+class _CounterValue(object) :
+  __slots__ = ('value', '_lock')
+
+  def __init__(self) :
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1) :
+    with self._lock :
+      self.value += amount
+
+
+class Counter(_Metric) :
+  """ 増加だけする値 (回数等) """
+  kind = 'counter'
+
+  def _create(self) :
+    return _CounterValue()
+
+  def inc(self, amount=1) :
+    self._default.inc(amount)
+
+  def samples(self) :
+    return [('_total', labels, (), child.value) for labels, child in list(self._children.items())]
+
+
+class _GaugeValue(object) :
+  __slots__ = ('value', '_lock')
+
+  def __init__(self) :
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def set(self, value) :
+    self.value = value
+
+  def inc(self, amount=1) :
+    with self._lock :
+      self.value += amount
+
+  def dec(self, amount=1) :
+    self.inc(-amount)
+
+
+class Gauge(_Metric) :
+  """ 増減する値 (キューの長さ等)。function を指定すると出力するときに呼び出す """
+  kind = 'gauge'
+
+  def __init__(self, name, help='', labelnames=(), function=None) :
+    super().__init__(name, help, labelnames)
+    self._function = function
+
+  def _create(self) :
+    return _GaugeValue()
+
+  def set(self, value) :
+    self._default.set(value)
+
+  def inc(self, amount=1) :
+    self._default.inc(amount)
+
+  def dec(self, amount=1) :
+    self._default.dec(amount)
+
+  def samples(self) :
+    if self._function is not None :
+      return [('', (), (), self._function())]
+    return [('', labels, (), child.value) for labels, child in list(self._children.items())]
+
+
+class _HistogramValue(object) :
+  __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+  def __init__(self, buckets) :
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+    self._lock = threading.Lock()
+
+  def observe(self, value) :
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock :
+      self.counts[index] += 1
+      self.sum += value
+      self.count += 1
+
+  @contextmanager
+  def time(self) :
+    """ 囲んだ範囲の処理時間を記録する (例外が発生した場合も記録する) """
+    t = time.perf_counter()
+    try :
+      yield
+    finally :
+      self.observe(time.perf_counter() - t)
+
+
+class Histogram(_Metric) :
+  """ 固定のバケットごとの件数と合計 (処理時間等) """
+  kind = 'histogram'
+
+  def __init__(self, name, help='', labelnames=(), buckets=DEFAULT_BUCKETS) :
+    self.buckets = tuple(sorted(buckets))
+    super().__init__(name, help, labelnames)
+
+  def _create(self) :
+    return _HistogramValue(self.buckets)
+
+  def observe(self, value) :
+    self._default.observe(value)
+
+  def time(self) :
+    return self._default.time()
+
+  def samples(self) :
+    samples = []
+    for labels, child in list(self._children.items()) :
+      with child._lock :
+        counts = list(child.counts)
+        total, count = child.sum, child.count
+      cumulative = 0
+      for bound, n in zip(self.buckets + (math.inf,), counts) :
+        cumulative += n
+        samples.append(('_bucket', labels, (('le', _format_value(bound)),), cumulative))
+      samples.append(('_sum', labels, (), total))
+      samples.append(('_count', labels, (), count))
+    return samples
+
+
+class Registry(object) :
+  """ 計測値の登録先 """
+
+  def __init__(self) :
+    self._lock = threading.Lock()
+    self._metrics = {}
+    self._collectors = {}
+
+  def _get_or_create(self, cls, name, *args, **kwargs) :
+    with self._lock :
+      metric = self._metrics.get(name)
+      if metric is None :
+        metric = self._metrics[name] = cls(name, *args, **kwargs)
+      elif not isinstance(metric, cls) :
+        raise ValueError(f'metric {name} is already registered as {metric.kind}.')
+      return metric
+
+  def counter(self, name, help='', labelnames=()) -> Counter :
+    return self._get_or_create(Counter, name, help, labelnames)
+
+  def gauge(self, name, help='', labelnames=(), function=None) -> Gauge :
+    return self._get_or_create(Gauge, name, help, labelnames, function=function)
+
+  def histogram(self, name, help='', labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram :
+    return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+  def collector(self, name, function) :
+    """ function() が返す dict の数値を cube_<name>_<キー> のゲージとして出力する
+
+    入れ子の dict はキーを _ でつなぐ。数値以外の値は出力しない。
+    function が None を返した場合は出力しない。同じ name で登録し直すと置き換える。
+    """
+    with self._lock :
+      self._collectors[name] = function
+
+  def remove_collector(self, name) :
+    with self._lock :
+      self._collectors.pop(name, None)
+
+  def _collected(self) :
+    with self._lock :
+      collectors = list(self._collectors.items())
+    for name, function in collectors :
+      try :
+        values = function()
+      except Exception :
+        logger.exception(f'metrics collector {name} failed.')
+        continue
+      if values is None :
+        continue
+      yield from _flatten(f'cube_{name}', values)
+
+  def collect(self) :
+    """ [(名前, 種類, 説明, [(名前, ラベル文字列, 値)])] """
+    with self._lock :
+      metrics = list(self._metrics.values())
+    families = []
+    for metric in metrics :
+      samples = [(metric.name + suffix, _format_labels(metric.labelnames, labels, extra), value)
+                 for suffix, labels, extra, value in metric.samples()]
+      families.append((metric.name, metric.kind, metric.help, samples))
+    for name, value in self._collected() :
+      families.append((name, 'gauge', '', [(name, '', value)]))
+    return families
+
+  def render(self) -> str :
+    """ Prometheus のテキスト形式 """
+    lines = []
+    for name, kind, help, samples in self.collect() :
+      if help :
+        lines.append(f'# HELP {name} {help}')
+      lines.append(f'# TYPE {name} {kind}')
+      for sample_name, labels, value in samples :
+        lines.append(f'{sample_name}{labels} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+  def snapshot(self) -> dict :
+    """ {名前{ラベル}: 値} (MQTT 等で送る JSON 用) """
+    return {f'{sample_name}{labels}' : value
+            for _, _, _, samples in self.collect() for sample_name, labels, value in samples}
+
+
+def _flatten(prefix, values) :
+  for key, value in values.items() :
+    name = f'{prefix}_{_NAME_RE.sub("_", str(key))}'
+    if isinstance(value, dict) :
+      yield from _flatten(name, value)
+    elif isinstance(value, (int, float)) :
+      yield name, value
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+collector = REGISTRY.collector
+remove_collector = REGISTRY.remove_collector
+render = REGISTRY.render
+snapshot = REGISTRY.snapshot
+
+gauge('cube_threads', 'number of alive threads', function=threading.active_count)
+_started = time.time()
+gauge('cube_uptime_seconds', 'seconds since the process started', function=lambda : time.time() - _started)
+
+
+# ##############################################################################
+# 出力
+# ##############################################################################
+class _Handler(http.server.BaseHTTPRequestHandler) :
+  registry = REGISTRY
+
+  def do_GET(self) :
+    if self.path in ('/', '/metrics') :
+      body = self.registry.render().encode('utf-8')
+      content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    elif self.path == '/metrics.json' :
+      body = json.dumps(self.registry.snapshot()).encode('utf-8')
+      content_type = 'application/json'
+    else :
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args) :
+    logger.debug(format, *args)
+
+
+_server = None
+
+
+def serve(host='127.0.0.1', port=9464) :
+  """ /metrics を出力する HTTP サーバを別スレッドで開始する """
+  global _server
+  if _server is not None :
+    return _server
+  server = http.server.ThreadingHTTPServer((host, port), _Handler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+  thread.start()
+  _server = server
+  logger.info(f'metrics serving on http://{host}:{port}/metrics')
+  return server
+
+
+def shutdown() :
+  global _server
+  server, _server = _server, None
+  if server is not None :
+    server.shutdown()
+    server.server_close()
+
+
+class MqttPublisher(threading.Thread) :
+  """ interval 秒ごとに計測値 (JSON) を MQTT の topic に送信する """
+
+  def __init__(self, broker, port, topic, interval: float = 60.0, registry: Registry = REGISTRY) :
+    super().__init__(name='metrics-mqtt', daemon=True)
+    self._broker = broker
+    self._port = port
+    self._topic = topic
+    self._interval = interval
+    self._registry = registry
+    self._stopped = threading.Event()
+
+  def stop(self) :
+    self._stopped.set()
+
+  def run(self) :
+    import paho.mqtt.client
+    client = paho.mqtt.client.Client(protocol=paho.mqtt.client.MQTTv311)
+    try :
+      client.connect_async(self._broker, self._port)
+      client.loop_start()
+      while not self._stopped.wait(self._interval) :
+        message = {'unixtime': int(time.time()), 'metrics': self._registry.snapshot()}
+        client.publish(self._topic, json.dumps(message))
+    except Exception :
+      logger.exception('metrics mqtt publish failed.')
+    finally :
+      client.loop_stop()
+      client.disconnect()
@@ -9,8 +9,21 @@ import os
 import time
 from threading import Thread, Lock, Event
 
+from cube import clocks
+from cube import events
+from cube import identity
+from cube import leaks
+from cube import metrics
+from cube import tracing
+
 logger = getLogger(__name__)
 
+MQTT_CONNECT_SECONDS = metrics.histogram('cube_mqtt_connect_seconds', 'mqtt connect time')
+MQTT_PUBLISH_SECONDS = metrics.histogram('cube_mqtt_publish_seconds', 'mqtt publish call time', ('topic',))
+MQTT_PUBLISH_BYTES = metrics.counter('cube_mqtt_publish_bytes', 'mqtt published payload size', ('topic',))
+AUTH_RESPONSE_SECONDS = metrics.histogram(
+    'cube_auth_response_seconds', 'time from the entry publish to cube_open')
+
 
 class DoubleAuthError(Exception):
   """
@@ -23,6 +36,74 @@ class DoubleAuthError(Exception):
   """
   pass
 
+# ##############################################################################
+# イベント (Client の bus に発行する)
+# ##############################################################################
+class ServerCommand(events.Event) :
+  """ サーバからのコマンド (購読すると、全てのコマンドを受信した順に受け取る) """
+  __slots__ = ('client', 'status')
+
+  def __init__(self, client, status=None) :
+    self.client = client
+    self.status = status
+
+
+class OpenRequested(ServerCommand) :
+  """ 診察の開始の要求 (cube_open, web_open) """
+  __slots__ = ()
+
+
+class CubeOpenRequested(OpenRequested) :
+  __slots__ = ()
+
+
+class WebOpenRequested(OpenRequested) :
+  __slots__ = ()
+
+
+class ShootRequested(ServerCommand) :
+  """ 撮影の要求 (shoot_spo2, shoot_usbcamera) """
+  __slots__ = ()
+
+
+class ShootSpo2Requested(ShootRequested) :
+  __slots__ = ()
+
+
+class ShootUsbCameraRequested(ShootRequested) :
+  __slots__ = ()
+
+
+class PanelCommand(ServerCommand) :
+  """ 操作パネルの機能 (panel_func_*) """
+  __slots__ = ()
+
+
+class PanelFunction(PanelCommand) :
+  __slots__ = ()
+
+
+class PanelFuncButton(PanelCommand) :
+  __slots__ = ()
+
+
+class PanelFuncStop(PanelCommand) :
+  __slots__ = ()
+
+
+class PanelFuncExit(PanelCommand) :
+  __slots__ = ()
+
+
+class EntryPublished(events.Event) :
+  """ 認証の要求 (entry) を送信した """
+  __slots__ = ('client', 'idm')
+
+  def __init__(self, client, idm) :
+    self.client = client
+    self.idm = idm
+
+
 class Session(object) :
   """
   """
@@ -52,6 +133,7 @@ class Session(object) :
     self.idm = idm
     self._reservation_id_set(reservation_id)
     self._client = client
+    leaks.track(self)
 
   def __bool__(self):
     logger.debug(f'{self}.__bool__()')
@@ -113,40 +195,21 @@ class Client(object):
   def is_authenticated(self) -> bool:
     return bool(self.reservation_id)
 
-  def __init__(self, broker:str, port:int, roottopics: str = '', url: str = '', keepalive=60, timeout: float = 10.0):
-
-    if os.name == 'posix':
-      import netifaces
-      # MAC ADDRESS
-      iface_data = None
-      for interface in netifaces.interfaces():
-        ifaddress = netifaces.ifaddresses(interface)
-        logger.debug ('Interface: {}'.format(interface))
-        logger.debug ('\tMAC Address')
-        logger.debug ('\t\t{}'.format(ifaddress.get(netifaces.AF_LINK)))
-        logger.debug ('\tIPv4 Address')
-        logger.debug ('\t\t{}'.format(ifaddress.get(netifaces.AF_INET)))
-        logger.debug ('\tIPv6 Address')
-        logger.debug ('\t\t{}'.format(ifaddress.get(netifaces.AF_INET6)))
-
-        if ifaddress.get(netifaces.AF_INET) is not None :
-          if interface == "eth0" :
-            iface_data = ifaddress
-            break
-          else :
-            if iface_data is None :
-              iface_data = ifaddress
+  def __init__(self, broker:str, port:int, roottopics: str = '', url: str = '', keepalive=60, timeout: float = 10.0
+               , *, clock: clocks.Clock | None = None, bus: events.EventBus | None = None):
 
-      self._device_id = iface_data.get(netifaces.AF_LINK)[0]["addr"]
-      self._ip_addr = iface_data.get(netifaces.AF_INET)[0]['addr']
-    else :
-      self._device_id = 'deviceid'
+    # 起動時に調べたMACアドレスとIPアドレスを使用する
+    ident = identity.get()
+    self._device_id = ident.device_id
+    self._ip_addr = ident.ip_addr
 
     self._broker = broker
     self._port = port
     self._keepalive = keepalive
     self._timeout = timeout
     self._root_topics = roottopics
+    self._clock = clock or clocks.get()
+    self._bus = bus or events.BUS
 
     self._idm = None
     self._client = None
@@ -159,15 +222,9 @@ class Client(object):
     self._auth_done_event = Event()
     # self._on_disconnect_event = Event()
     self._session = None
+    self._entry_published_time = None
 
-    self.on_request_cube_open = None
-    self.on_request_web_open = None
-    self.on_request_shoot_spo2 = None
-    self.on_request_shoot_usbcamera = None
-    self.on_panel_function = None
-    self.on_panel_func_button = None
-    self.on_panel_func_stop = None
-    self.on_panel_func_exit = None
+    leaks.track(self)
 
     self._url = url.rstrip('/')
 
@@ -226,6 +283,7 @@ class Client(object):
           if auth_locked_event :
             auth_locked_event.set()
 
+          connect_span = tracing.start_span('mqtt.connect')
           if self._client is None:
             self._client = paho.mqtt.client.Client(
                 userdata=self, protocol=paho.mqtt.client.MQTTv311)
@@ -250,16 +308,19 @@ class Client(object):
           self._client.loop_start()
           logger.info(f"mqtt loop start")
 
-          t = time.time()
-          if not self._on_connect_event.wait(timeout):
+          t = self._clock.monotonic()
+          if not self._clock.wait(self._on_connect_event, timeout):
             errer_msg = "mqtt connect timeout"
             logger.info(errer_msg)
             self._client.loop_stop()
+            connect_span.end(status=tracing.STATUS_ERROR)
             raise TimeoutError(errno.ETIMEDOUT, os.strerror(
                 errno.ETIMEDOUT), errer_msg)
+          MQTT_CONNECT_SECONDS.observe(self._clock.monotonic() - t)
+          connect_span.end()
 
           if timeout is not None:
-            timeout -= time.time() - t
+            timeout -= self._clock.monotonic() - t
             if timeout < 0.0 :
               timeout = 0.0
 
@@ -267,18 +328,22 @@ class Client(object):
           # entry コマンド送信
           publish_topics = f"{self._root_topics}/entry/{self._device_id}"
           message = {
-              'unixtime': int(time.time()), 'ferica_id': idm
+              'unixtime': int(self._clock.time()), 'ferica_id': idm
           }
           logger.info(f"authentication:{publish_topics}")
           logger.info(f"message:{message}")
 
           self._auth_done_event.clear()
-          self._client.publish(publish_topics, json.dumps(message))
+          with tracing.span('mqtt.entry') :
+            self._publish('entry', publish_topics, message)
+          self._entry_published_time = self._clock.monotonic()
           self._session = Session(self, idm)
 
+          self._bus.publish(EntryPublished(self, idm))
+
           if timeout is not None:
             # timeoutが指定されている場合は、認証完了を待つ
-            if not self._auth_done_event.wait(timeout):
+            if not self._clock.wait(self._auth_done_event, timeout):
               # 認証処理がタイムアウト
               self.disconnect()
           else :
@@ -296,7 +361,7 @@ class Client(object):
 
       # 認証スレッドを開始
       auth_locked_event = Event()
-      thread = Thread(target=authentication_thread, kwargs={
+      thread = Thread(target=tracing.wrap(authentication_thread), kwargs={
                       'timeout': timeout, 'auth_locked_event': auth_locked_event})
       thread.start()
       # 認証処理ロック取得完了まで待機
@@ -320,6 +385,13 @@ class Client(object):
     logger.info('--')
     logger.info('')
 
+  def _publish(self, kind, topic, message: dict) :
+    """ message を JSON で送信する (送信にかかった時間とサイズを記録する) """
+    payload = json.dumps(message)
+    with MQTT_PUBLISH_SECONDS.labels(kind).time() :
+      self._client.publish(topic, payload)
+    MQTT_PUBLISH_BYTES.labels(kind).inc(len(payload))
+
   def measure(self, data : dict) :
     publish_topics = f"{self._root_topics}"
     message = {
@@ -328,7 +400,7 @@ class Client(object):
     logger.debug(f"measure:{publish_topics}")
     logger.debug(f"message:{message}")
 
-    self._client.publish(publish_topics, json.dumps(message))
+    self._publish('measure', publish_topics, message)
 
   def res_spo2(self, image) :
     publish_topics = f"{self._root_topics}/resspo2/{self._device_id}"
@@ -347,7 +419,7 @@ class Client(object):
     logger.info(f"b64encode  type {type(image_b64encode)} size {len(image_b64encode):} bytes")
     logger.info(f"utf8decord type {type(image_utf8decord)} size {len(image_utf8decord)} bytes")
 
-    self._client.publish(publish_topics, json.dumps(message))
+    self._publish('resspo2', publish_topics, message)
 
   def res_usbcamera(self, image) :
     publish_topics = f"{self._root_topics}/resusbcam/{self._device_id}"
@@ -366,7 +438,7 @@ class Client(object):
     logger.info(f"b64encode  type {type(image_b64encode)} size {len(image_b64encode):} bytes")
     logger.info(f"utf8decord type {type(image_utf8decord)} size {len(image_utf8decord)} bytes")
 
-    self._client.publish(publish_topics, json.dumps(message))
+    self._publish('resusbcam', publish_topics, message)
 
   def patient_status(self, status) :
 
@@ -379,7 +451,7 @@ class Client(object):
     logger.info(f"patient_status:{publish_topics}")
     logger.info(f"message:{message}")
 
-    self._client.publish(publish_topics, json.dumps(message))
+    self._publish('patient_status', publish_topics, message)
 
   def patient_enter(self) :
     return self.patient_status('enter')
@@ -390,14 +462,16 @@ class Client(object):
   def _handle_cube_open(self, unixtime=None, reservation_id=None):
     """"""
     self._auth_done_event.set()
+    if self._entry_published_time is not None :
+      AUTH_RESPONSE_SECONDS.observe(self._clock.monotonic() - self._entry_published_time)
+      self._entry_published_time = None
 
     if not reservation_id:
       self._session = None
     else:
       self._session._reservation_id_set(reservation_id)
 
-    if self.on_request_cube_open:
-      self.on_request_cube_open(self)
+    self._bus.publish(CubeOpenRequested(self))
 
   def _handle_web_open(self, unixtime=None, reservation_id=None, status=None):
     """"""
@@ -407,48 +481,41 @@ class Client(object):
     else:
       self._session._reservation_id_set(reservation_id)
 
-    if self.on_request_web_open:
-      self.on_request_web_open(self)
+    self._bus.publish(WebOpenRequested(self))
 
   def _handle_shoot_spo2(self, unixtime=None, reservation_id=None):
     """"""
     logger.info(f"_on_request_shoot_spo2")
-    if self.on_request_shoot_spo2:
-      self.on_request_shoot_spo2(self)
+    self._bus.publish(ShootSpo2Requested(self))
 
   def _handle_shoot_usbcamera(self, unixtime=None, reservation_id=None):
     """"""
     logger.info(f"_on_request_shoot_usbcamera")
-    if self.on_request_shoot_usbcamera:
-      self.on_request_shoot_usbcamera(self)
+    self._bus.publish(ShootUsbCameraRequested(self))
 
   def _handle_function(self, unixtime=None, reservation_id=None, status=None):
     """"""
     logger.info(
         f"_on_panel_function reservation_id:{reservation_id} status is {status}")
-    if self.on_panel_function:
-      self.on_panel_function(self, status)
+    self._bus.publish(PanelFunction(self, status))
 
   def _handle_func_button(self, unixtime=None, reservation_id=None, status=None):
     """"""
     logger.info(
         f"_on_panel_function reservation_id:{reservation_id} status is {status}")
-    if self.on_panel_func_button:
-      self.on_panel_func_button(self, status)
+    self._bus.publish(PanelFuncButton(self, status))
 
   def _handle_func_stop(self, unixtime=None, reservation_id=None, status=None):
     """"""
     logger.info(
         f"_on_panel_func_stop reservation_id:{reservation_id} status is {status}")
-    if self.on_panel_func_stop:
-      self.on_panel_func_stop(self, status)
+    self._bus.publish(PanelFuncStop(self, status))
 
   def _handle_func_exit(self, unixtime=None, reservation_id=None, status=None):
     """"""
     logger.info(
         f"_on_panel_func_exit reservation_id:{reservation_id} status is {status}")
-    if self.on_panel_func_exit:
-      self.on_panel_func_exit(self, status)
+    self._bus.publish(PanelFuncExit(self, status))
 
 
 def on_connect(client: paho.mqtt.client.Client, userdata: Client, flags, rc):
@@ -481,8 +548,7 @@ def on_disconnect(client: paho.mqtt.client.Client, userdata: Client, rc):
 
 def on_message(client: paho.mqtt.client.Client, userdata: Client, msg):
   try:
-    logger.info(
-        f"Received from `{msg.topic}` `{msg.payload}` with userdata `{userdata}`")
+    logger.info("Received from `%s` `%s` with userdata `%s`", msg.topic, msg.payload, userdata)
     topics = msg.topic.rsplit('/', 2)
 
     deviceid = topics[-1]
@@ -510,8 +576,8 @@ def on_message(client: paho.mqtt.client.Client, userdata: Client, msg):
           userdata._handle_func_exit(**msg_data)
       except:
         logger.exception('Exception occurred on_message_thread()!')
-    thread = Thread(target=on_message_thread, kwargs=msg_data)
-    thread.start()
+    # コマンドの処理は購読側のスレッドで行うため、ここでは発行だけを行う
+    on_message_thread(**msg_data)
   except:
     logger.exception('Exception occurred on_message()!')
 
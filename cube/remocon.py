@@ -2,11 +2,15 @@
 # -*- coding: utf-8 -*-
 from logging import getLogger
 
+import threading
 import time
 
 import application
 import cecclient
-import irrp
+from cube import lazy
+
+# IRで操作する場合のみ読み込む (pigpio, numpy)
+irrp = lazy.load('irrp', 'ir')
 
 logger = getLogger(__name__)
 
@@ -69,6 +73,32 @@ def init( turnon_source=_turnon_source
   logger.debug(f"  ├ turnoff_retry  :{_turnoff_retry}")
   logger.debug(f"  └ cec_use        :{_cec_use}")
 
+def prepare() :
+  """ CECを使用する場合は、cec-client をバックグラウンドで起動しておく。 """
+  if _cec_use :
+    thread = threading.Thread(target=cecclient.get_session, name="cecclient.prepare", daemon=True)
+    thread.start()
+
+def connect() -> bool :
+  """ 常駐させる cec-client を起動する。CECを使用しない場合は何もしない """
+  if _cec_use :
+    return cecclient.get_session() is not None
+  return True
+
+def close() :
+  """ 常駐させた cec-client と IR送信のpigpio接続を終了する。 """
+  try :
+    cecclient.close_session()
+  finally :
+    if lazy.is_loaded(irrp) :
+      irrp.close()
+
+def is_on() -> bool | None :
+  """ テレビの電源が入っているか。CECを使用しない場合は分からないので None """
+  if _cec_use :
+    return bool(cecclient.power_status())
+  return None
+
 def on() :
   logger.debug(f"on turnon_source:{_turnon_source} cec_use:{_cec_use}")
   if _turnon_source == 'IR' :
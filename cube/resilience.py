@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 周辺機器の呼び出しの期限とサーキットブレーカー
+
+期限 (deadline)
+  with resilience.deadline(60.0) : で囲んだ範囲の呼び出しは、残り時間
+  (remaining()) を超えて待たない。入れ子にした場合は短い方になる。
+  期限は contextvars で持つので、tracing.wrap() / tracing.submit() で
+  実行したスレッドにも引き継がれる。
+
+サーキットブレーカー
+  接続先 (tcud, リレー, ホワイトボード, cec-client 等) ごとに1つ持つ。
+  failure_threshold 回続けて失敗すると開き、reset_timeout 秒の間は呼び出さずに
+  CircuitOpenError で失敗する。その後1回だけ試し (half open)、成功すれば閉じる。
+
+    RELAY = resilience.breaker('relay', timeout=5.0, isolate=True)
+    RELAY.call(client.door_lock, address, pulse, delay)
+
+  タイムアウトを指定できない呼び出しは isolate=True にすると、専用のスレッドで
+  実行して期限までだけ待つ。(期限を過ぎた呼び出しはそのスレッドで終わるまで残る)
+  タイムアウトを指定できる呼び出しは、呼び出し先で remaining() を使う。
+
+期限と、開いてから試すまでの時間は clocks.get() (CircuitBreaker は clock を指定
+すればその時計) の時刻で計る。(isolate=True の呼び出しの完了は実時間で待つ)
+
+共有する状態を持つので、他のモジュールからは `from cube import resilience` で参照すること。
+"""
+import concurrent.futures
+from contextlib import contextmanager
+import contextvars
+from logging import getLogger
+import queue
+import threading
+import time
+
+from cube import clocks
+from cube import metrics
+
+logger = getLogger(__name__)
+
+# 呼び出し1回の既定の時間 (秒)
+DEFAULT_TIMEOUT = 5.0
+# 開くまでの連続した失敗の回数
+FAILURE_THRESHOLD = 3
+# 開いてから試すまでの時間 (秒)
+RESET_TIMEOUT = 30.0
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+_STATE_CODES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+CALL_SECONDS = metrics.histogram(
+    'cube_peripheral_call_seconds', 'peripheral call time', ('endpoint', 'result'))
+
+
+class ResilienceError(Exception) :
+  pass
+
+
+class DeadlineExceeded(ResilienceError, TimeoutError) :
+  """ 期限までに呼び出しが終わらなかった (期限を過ぎていた) """
+  pass
+
+
+class CircuitOpenError(ResilienceError, ConnectionError) :
+  """ 接続先が続けて失敗しているため呼び出さなかった """
+  pass
+
+
+# ##############################################################################
+# 期限
+# ##############################################################################
+_deadline = contextvars.ContextVar('cube_deadline', default=None)
+
+
+@contextmanager
+def deadline(seconds: float | None, *, inherit: bool = True) :
+  """ 囲んだ範囲の期限を seconds 秒後にする (外側の期限の方が早ければそのまま)
+
+  seconds が None の場合は期限を追加しない。inherit=False の場合は外側の期限を
+  引き継がない (期限を過ぎた後の後始末等で使う)。
+  """
+  outer = _deadline.get() if inherit else None
+  value = None if seconds is None else clocks.get().monotonic() + seconds
+  if value is None or (outer is not None and outer < value) :
+    value = outer
+  token = _deadline.set(value)
+  try :
+    yield value
+  finally :
+    _deadline.reset(token)
+
+
+def remaining(default: float | None = None) -> float | None :
+  """ 期限までの残り時間 (秒)。default を指定した場合は default 以下にする。
+  期限も default もない場合は None
+  """
+  value = _deadline.get()
+  if value is None :
+    return default
+  left = max(0.0, value - clocks.get().monotonic())
+  return left if default is None else min(left, default)
+
+
+def check(operation='') -> None :
+  """ 期限を過ぎていれば DeadlineExceeded """
+  value = _deadline.get()
+  if value is not None and value <= clocks.get().monotonic() :
+    raise DeadlineExceeded(f'deadline exceeded. {operation}')
+
+
+# ##############################################################################
+# 専用のスレッドでの実行
+# ##############################################################################
+class _Isolation(object) :
+  """ 呼び出しを実行する daemon スレッド (必要になった時に max_workers まで起動する)
+
+  ThreadPoolExecutor のスレッドは終了時に待たれるため、戻らない呼び出しが
+  プロセスの終了を妨げないよう daemon のスレッドを使う。
+  """
+
+  def __init__(self, name, max_workers) :
+    self._name = name
+    self._max_workers = max_workers
+    self._queue = queue.SimpleQueue()
+    self._lock = threading.Lock()
+    self._workers = 0
+    self._idle = 0
+
+  def submit(self, function, *args, **kwargs) -> concurrent.futures.Future :
+    future = concurrent.futures.Future()
+    # 呼び出し元の期限・トレースを引き継ぐ
+    context = contextvars.copy_context()
+    self._queue.put((future, context, function, args, kwargs))
+    with self._lock :
+      if self._idle == 0 and self._workers < self._max_workers :
+        self._workers += 1
+        threading.Thread(target=self._work, name=f'{self._name}-{self._workers}', daemon=True).start()
+    return future
+
+  def _work(self) :
+    while True :
+      with self._lock :
+        self._idle += 1
+      future, context, function, args, kwargs = self._queue.get()
+      with self._lock :
+        self._idle -= 1
+      if not future.set_running_or_notify_cancel() :
+        continue
+      try :
+        future.set_result(context.run(function, *args, **kwargs))
+      except BaseException as e :
+        future.set_exception(e)
+
+  @property
+  def busy(self) -> int :
+    with self._lock :
+      return self._workers - self._idle
+
+
+# ##############################################################################
+# サーキットブレーカー
+# ##############################################################################
+class CircuitBreaker(object) :
+  """ 接続先1つ分のサーキットブレーカー """
+
+  def __init__(self, name, *, timeout: float = DEFAULT_TIMEOUT, failure_threshold: int | None = None,
+               reset_timeout: float | None = None, isolate: bool = False, max_workers: int = 2,
+               clock: clocks.Clock | None = None) :
+    self.name = name
+    # 省略した場合は呼び出した時点の clocks.get() を使う (モジュールの変数で持つブレーカーのため)
+    self._clock = clock
+    self.timeout = timeout
+    self.failure_threshold = FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+    self.reset_timeout = RESET_TIMEOUT if reset_timeout is None else reset_timeout
+    self._isolation = _Isolation(f'breaker-{name}', max_workers) if isolate else None
+
+    self._lock = threading.Lock()
+    self._state = STATE_CLOSED
+    self._opened_time = 0.0
+    self._probing = False
+    self._failures = 0
+
+    self.calls = 0
+    self.succeeded = 0
+    self.failed = 0
+    self.rejected = 0
+    self.timeouts = 0
+    self.opened = 0
+    self.seconds = 0.0
+    self.last_error = None
+
+  def _monotonic(self) -> float :
+    return (self._clock or clocks.get()).monotonic()
+
+  @property
+  def state(self) -> str :
+    with self._lock :
+      if self._state == STATE_OPEN and self.reset_timeout <= self._monotonic() - self._opened_time :
+        return STATE_HALF_OPEN
+      return self._state
+
+  def _acquire(self) -> bool :
+    """ 呼び出してよければ True。half open の場合は試す1回だけ True (試しの呼び出しなら _probing) """
+    with self._lock :
+      if self._state == STATE_CLOSED :
+        return True
+      if self._state == STATE_OPEN :
+        if self._monotonic() - self._opened_time < self.reset_timeout :
+          return False
+        self._state = STATE_HALF_OPEN
+      if self._probing :
+        return False
+      self._probing = True
+      return True
+
+  def _on_success(self) :
+    with self._lock :
+      self.succeeded += 1
+      self._failures = 0
+      self._probing = False
+      if self._state != STATE_CLOSED :
+        logger.info(f'breaker {self.name} closed.')
+        self._state = STATE_CLOSED
+
+  def _on_failure(self, error) :
+    with self._lock :
+      self.failed += 1
+      self._failures += 1
+      self.last_error = f'{type(error).__name__}: {error}'
+      probing, self._probing = self._probing, False
+      if probing or (self._state == STATE_CLOSED and self.failure_threshold <= self._failures) :
+        self._state = STATE_OPEN
+        self._opened_time = self._monotonic()
+        self.opened += 1
+        opened = True
+      else :
+        opened = False
+    if opened :
+      logger.warning(f'breaker {self.name} opened for {self.reset_timeout}s. failures:{self._failures} {self.last_error}')
+
+  def call(self, function, *args, timeout: float | None = None, **kwargs) :
+    """ function(*args, **kwargs) を呼び出す。
+
+    timeout (省略時は breaker の timeout) と、呼び出し元の期限の短い方まで待つ。
+    """
+    budget = remaining(self.timeout if timeout is None else timeout)
+    if budget is not None and budget <= 0.0 :
+      # 呼び出し元の期限切れは接続先の失敗として数えない
+      CALL_SECONDS.labels(self.name, 'deadline').observe(0.0)
+      raise DeadlineExceeded(f'{self.name} deadline exceeded before the call.')
+    if not self._acquire() :
+      with self._lock :
+        self.rejected += 1
+      CALL_SECONDS.labels(self.name, 'rejected').observe(0.0)
+      raise CircuitOpenError(f'{self.name} circuit is open. {self.last_error}')
+
+    t = time.perf_counter()
+    result = 'error'
+    try :
+      with deadline(budget) :
+        if self._isolation is not None :
+          future = self._isolation.submit(function, *args, **kwargs)
+          try :
+            value = future.result(budget)
+          except concurrent.futures.TimeoutError :
+            future.cancel()
+            with self._lock :
+              self.timeouts += 1
+            result = 'timeout'
+            raise DeadlineExceeded(f'{self.name} did not respond in {budget:0.3f}s.') from None
+        else :
+          value = function(*args, **kwargs)
+    except BaseException as e :
+      if isinstance(e, Exception) :
+        self._on_failure(e)
+      else :
+        with self._lock :
+          self._probing = False
+      raise
+    else :
+      result = 'ok'
+      self._on_success()
+      return value
+    finally :
+      seconds = time.perf_counter() - t
+      with self._lock :
+        self.calls += 1
+        self.seconds += seconds
+      CALL_SECONDS.labels(self.name, result).observe(seconds)
+
+  def reset(self) :
+    """ 閉じた状態に戻す """
+    with self._lock :
+      self._state = STATE_CLOSED
+      self._failures = 0
+      self._probing = False
+
+  def stats(self) -> dict :
+    state = self.state
+    with self._lock :
+      return {
+          'state': _STATE_CODES[state],
+          'open': state == STATE_OPEN,
+          'calls': self.calls,
+          'succeeded': self.succeeded,
+          'failed': self.failed,
+          'rejected': self.rejected,
+          'timeouts': self.timeouts,
+          'opened': self.opened,
+          'seconds': self.seconds,
+          'busy': self._isolation.busy if self._isolation is not None else 0,
+      }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name, **kwargs) -> CircuitBreaker :
+  """ name の接続先のサーキットブレーカー (なければ作る。kwargs は作る時だけ使う) """
+  with _breakers_lock :
+    instance = _breakers.get(name)
+    if instance is None :
+      instance = _breakers[name] = CircuitBreaker(name, **kwargs)
+    return instance
+
+
+def configure(*, failure_threshold: int | None = None, reset_timeout: float | None = None) -> None :
+  """ 開くまでの失敗の回数と、開いてから試すまでの時間を設定する (作成済みのブレーカーも変更する) """
+  global FAILURE_THRESHOLD
+  global RESET_TIMEOUT
+  with _breakers_lock :
+    if failure_threshold is not None :
+      FAILURE_THRESHOLD = failure_threshold
+    if reset_timeout is not None :
+      RESET_TIMEOUT = reset_timeout
+    for instance in _breakers.values() :
+      instance.failure_threshold = FAILURE_THRESHOLD
+      instance.reset_timeout = RESET_TIMEOUT
+
+
+def stats() -> dict :
+  """ {接続先: 状態} (state は 0:closed 1:half_open 2:open) """
+  with _breakers_lock :
+    breakers = list(_breakers.values())
+  return {instance.name : instance.stats() for instance in breakers}
+
+
+def states() -> dict :
+  """ {接続先: 'closed' | 'half_open' | 'open'} """
+  with _breakers_lock :
+    breakers = list(_breakers.values())
+  return {instance.name : instance.state for instance in breakers}
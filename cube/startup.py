@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 起動時のサブシステムの立ち上げ
+
+サブシステムごとに依存関係を宣言し、依存先の準備ができたものから並行して
+立ち上げる。失敗した場合は間隔を倍にしながら (ゆらぎ付きで) 再試行する。
+機能 (capability) ごとに必要なサブシステムを宣言しておくと、その機能が
+使えるようになったかを個別に確認できる。
+"""
+import asyncio
+import inspect
+from logging import getLogger
+import random
+from threading import Event
+import time
+
+logger = getLogger(__name__)
+
+STATE_PENDING = 'pending'
+STATE_STARTING = 'starting'
+STATE_READY = 'ready'
+STATE_STOPPED = 'stopped'
+
+# 再試行の間隔 (秒)
+RETRY_INTERVAL_MIN = 0.2
+RETRY_INTERVAL_MAX = 10.0
+# 再試行の間隔のゆらぎ (割合)
+RETRY_JITTER = 0.2
+
+
+class Subsystem(object) :
+  """ 立ち上げるサブシステム1つ分 """
+
+  def __init__(self, name, start, depends=(), *, attempt_timeout: float | None = None,
+               initial_delay: float = RETRY_INTERVAL_MIN, max_delay: float = RETRY_INTERVAL_MAX) :
+    self.name = name
+    self.start = start
+    self.depends = tuple(depends)
+    self.attempt_timeout = attempt_timeout
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+
+    self.state = STATE_PENDING
+    self.attempts = 0
+    self.result = None
+    self.last_error = None
+    # 依存先の準備ができて、立ち上げを始めた時刻
+    self.started_time = None
+    self.ready_time = None
+    self._ready_event = Event()
+    # スレッドで実行中の start (attempt_timeout を過ぎても戻っていないもの)
+    self._running = None
+
+  def is_ready(self) -> bool :
+    return self._ready_event.is_set()
+
+  def wait(self, timeout: float | None = None) -> bool :
+    return self._ready_event.wait(timeout)
+
+  def to_dict(self, origin: float) -> dict :
+    return {
+        'state': self.state,
+        'attempts': self.attempts,
+        'time_to_ready': None if self.ready_time is None else self.ready_time - origin,
+        'bring_up': None if self.ready_time is None else self.ready_time - self.started_time,
+        'error': None if self.last_error is None else repr(self.last_error),
+    }
+
+
+class Orchestrator(object) :
+  """ サブシステムの立ち上げを管理する
+
+  start には同期関数またはコルーチン関数を指定する。同期関数はスレッドで実行する。
+  例外が発生せずに終了すれば準備完了とし、戻り値を Subsystem.result に保持する。
+  """
+
+  def __init__(self) :
+    self._subsystems = {}
+    self._capabilities = {}
+    self._origin = time.monotonic()
+    self._tasks = []
+    self._async_events = {}
+
+  def add(self, name, start, depends=(), **kwargs) -> Subsystem :
+    if name in self._subsystems :
+      raise ValueError(f'subsystem {name} is already added.')
+    for depend in depends :
+      if depend not in self._subsystems :
+        raise ValueError(f'subsystem {name} depends on unknown subsystem {depend}.')
+    subsystem = Subsystem(name, start, depends, **kwargs)
+    self._subsystems[name] = subsystem
+    return subsystem
+
+  def capability(self, name, *subsystems) :
+    """ 機能 name に必要なサブシステムを宣言する """
+    for subsystem in subsystems :
+      if subsystem not in self._subsystems :
+        raise ValueError(f'capability {name} requires unknown subsystem {subsystem}.')
+    self._capabilities[name] = tuple(subsystems)
+
+  def __getitem__(self, name) -> Subsystem :
+    return self._subsystems[name]
+
+  def __contains__(self, name) -> bool :
+    return name in self._subsystems
+
+  def is_ready(self, name) -> bool :
+    """ サブシステムまたは機能の準備ができているか """
+    if name in self._capabilities :
+      return all(self._subsystems[n].is_ready() for n in self._capabilities[name])
+    return self._subsystems[name].is_ready()
+
+  def not_ready(self, name) -> list :
+    """ サブシステムまたは機能に必要なもののうち、準備ができていないサブシステムの名前 """
+    return [n for n in self._capabilities.get(name, (name,)) if not self._subsystems[n].is_ready()]
+
+  def wait(self, name, timeout: float | None = None) -> bool :
+    """ サブシステムまたは機能の準備ができるのを待つ (スレッドから呼び出す) """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    names = self._capabilities.get(name, (name,))
+    for n in names :
+      remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+      if not self._subsystems[n].wait(remaining) :
+        return False
+    return True
+
+  def _async_event(self, name) -> asyncio.Event :
+    event = self._async_events.get(name)
+    if event is None :
+      event = self._async_events[name] = asyncio.Event()
+      if self._subsystems[name].is_ready() :
+        event.set()
+    return event
+
+  async def wait_async(self, name, stop_event: asyncio.Event | None = None) -> bool :
+    """ サブシステムまたは機能の準備ができるのを待つ。stop_event がセットされたら False """
+    for n in self._capabilities.get(name, (name,)) :
+      ready = self._async_event(n)
+      if ready.is_set() :
+        continue
+      if stop_event is None :
+        await ready.wait()
+        continue
+      waiters = [asyncio.ensure_future(ready.wait()), asyncio.ensure_future(stop_event.wait())]
+      try :
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+      finally :
+        for waiter in waiters :
+          waiter.cancel()
+      if not ready.is_set() :
+        return False
+    return True
+
+  def report(self) -> dict :
+    return {name: subsystem.to_dict(self._origin) for name, subsystem in self._subsystems.items()}
+
+  async def _call(self, subsystem: Subsystem) :
+    if inspect.iscoroutinefunction(subsystem.start) :
+      coro = subsystem.start()
+      if subsystem.attempt_timeout is None :
+        return await coro
+      return await asyncio.wait_for(coro, subsystem.attempt_timeout)
+
+    # スレッドで実行した start は取り消せないため、前回が戻っていなければ
+    # 新たに呼び出さずに、前回の終了を待つ (呼び出しが積み重ならないように)
+    running = subsystem._running
+    if running is None :
+      running = subsystem._running = asyncio.get_running_loop().run_in_executor(None, subsystem.start)
+    elif not running.done() :
+      logger.debug(f'startup {subsystem.name} previous attempt is still running.')
+    try :
+      if subsystem.attempt_timeout is None :
+        return await running
+      return await asyncio.wait_for(asyncio.shield(running), subsystem.attempt_timeout)
+    finally :
+      if running.done() :
+        subsystem._running = None
+
+  async def _bring_up(self, subsystem: Subsystem, stop_event: asyncio.Event | None) :
+    for depend in subsystem.depends :
+      if not await self.wait_async(depend, stop_event) :
+        subsystem.state = STATE_STOPPED
+        return
+
+    subsystem.state = STATE_STARTING
+    subsystem.started_time = time.monotonic()
+    delay = subsystem.initial_delay
+    while stop_event is None or not stop_event.is_set() :
+      subsystem.attempts += 1
+      try :
+        subsystem.result = await self._call(subsystem)
+      except asyncio.CancelledError :
+        raise
+      except Exception as e :
+        if type(subsystem.last_error) != type(e) :
+          logger.warning(f'startup {subsystem.name} failed. retry... {type(e)}:{e}')
+        subsystem.last_error = e
+      else :
+        subsystem.last_error = None
+        subsystem.ready_time = time.monotonic()
+        subsystem.state = STATE_READY
+        subsystem._ready_event.set()
+        self._async_event(subsystem.name).set()
+        logger.info(
+            f'startup {subsystem.name} ready at {subsystem.ready_time - self._origin:0.3f}s '
+            f'(bring up {subsystem.ready_time - subsystem.started_time:0.3f}s, attempts {subsystem.attempts})')
+        return
+
+      # 間隔を倍にしながら、同時に再試行しないようゆらぎを持たせて待つ
+      wait = delay * random.uniform(1.0 - RETRY_JITTER, 1.0 + RETRY_JITTER)
+      delay = min(delay * 2, subsystem.max_delay)
+      if stop_event is None :
+        await asyncio.sleep(wait)
+      else :
+        try :
+          await asyncio.wait_for(stop_event.wait(), wait)
+        except asyncio.TimeoutError :
+          pass
+    subsystem.state = STATE_STOPPED
+
+  async def run(self, stop_event: asyncio.Event | None = None) :
+    """ 全てのサブシステムを立ち上げる。全て準備できるか、stop_event がセットされたら戻る """
+    self._origin = time.monotonic()
+    self._tasks = [asyncio.ensure_future(self._bring_up(subsystem, stop_event))
+                   for subsystem in self._subsystems.values()]
+    try :
+      await asyncio.gather(*self._tasks)
+    finally :
+      for task in self._tasks :
+        task.cancel()
+    if all(subsystem.is_ready() for subsystem in self._subsystems.values()) :
+      logger.info(f'startup all subsystems ready at {time.monotonic() - self._origin:0.3f}s')
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" プロセス内のコンポーネント (スレッド) の監視
+
+各コンポーネントはスレッドで実行し、終了は通知として受け取る。(定期的な確認はしない)
+異常終了したコンポーネントは、間隔を倍にしながら (ゆらぎ付きで) 再起動する。
+終了時は全てのコンポーネントの停止を並行して行い、全体の期限までに
+終了しなかったコンポーネントを報告する。
+"""
+from logging import getLogger
+import queue
+import random
+import threading
+import time
+
+logger = getLogger(__name__)
+
+# 再起動の間隔 (秒)
+RESTART_INTERVAL_MIN = 0.5
+RESTART_INTERVAL_MAX = 30.0
+# 再起動の間隔のゆらぎ (割合)
+RESTART_JITTER = 0.2
+# 再起動せずに動作し続けたら、再起動の間隔を最小に戻す (秒)
+RESTART_RESET_TIME = 60.0
+# 終了処理の期限 (秒)
+SHUTDOWN_DEADLINE = 10.0
+# 通知を待つ最大時間 (秒)。Windows ではロックの待ちが Ctrl+C で中断されないため区切って待つ
+EVENT_WAIT_TIMEOUT = 1.0
+
+_EVENT_EXITED = 'exited'
+_EVENT_RESTART = 'restart'
+_EVENT_STOP = 'stop'
+
+
+class Component(object) :
+  """ 監視するコンポーネント1つ分
+
+  target はスレッドで実行する関数。stop は target を終了させる関数。
+  restart は再起動する条件。True (常に), False (しない), または
+  例外 (正常終了の場合は None) を受け取って bool を返す関数。
+  """
+
+  def __init__(self, name, target, stop=None, *, restart=False, daemon=False,
+               initial_delay: float = RESTART_INTERVAL_MIN, max_delay: float = RESTART_INTERVAL_MAX) :
+    self.name = name
+    self.target = target
+    self.stop = stop
+    self.restart = restart
+    self.daemon = daemon
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+
+    self.thread = None
+    self.restarts = 0
+    self.started_time = None
+    self.exception = None
+    self._delay = initial_delay
+
+  def should_restart(self, exception) -> bool :
+    if callable(self.restart) :
+      return bool(self.restart(exception))
+    return bool(self.restart)
+
+  def next_delay(self) -> float :
+    """ 再起動までの待ち時間 """
+    if self.started_time is not None and RESTART_RESET_TIME <= time.monotonic() - self.started_time :
+      self._delay = self.initial_delay
+    delay = self._delay * random.uniform(1.0 - RESTART_JITTER, 1.0 + RESTART_JITTER)
+    self._delay = min(self._delay * 2, self.max_delay)
+    return delay
+
+  def is_alive(self) -> bool :
+    return self.thread is not None and self.thread.is_alive()
+
+
+class Supervisor(object) :
+  """ コンポーネントを起動して、終了を監視する
+
+  run() は stop() が呼ばれるか、再起動しないコンポーネントが終了するまで戻らない。
+  戻る前に全てのコンポーネントを停止する。
+  """
+
+  def __init__(self, *, shutdown_deadline: float = SHUTDOWN_DEADLINE) :
+    self._components = {}
+    self._events = queue.SimpleQueue()
+    self._stopping = threading.Event()
+    self._timers = []
+    self.shutdown_deadline = shutdown_deadline
+    self._deadline = None
+    self.shutdown_report = {}
+
+  def add(self, name, target, stop=None, **kwargs) -> Component :
+    component = Component(name, target, stop, **kwargs)
+    self._components[name] = component
+    return component
+
+  def __getitem__(self, name) -> Component :
+    return self._components[name]
+
+  @property
+  def is_stopping(self) -> bool :
+    return self._stopping.is_set()
+
+  def stop(self, reason='requested') :
+    """ 全てのコンポーネントを停止する (どのスレッドから呼び出してもよい) """
+    self._events.put((_EVENT_STOP, reason, None))
+
+  def _start(self, component: Component) :
+    def _run() :
+      exception = None
+      try :
+        component.target()
+      except BaseException as e :
+        exception = e
+      finally :
+        self._events.put((_EVENT_EXITED, component.name, exception))
+
+    component.exception = None
+    component.started_time = time.monotonic()
+    component.thread = threading.Thread(target=_run, name=component.name, daemon=component.daemon)
+    component.thread.start()
+    logger.info(f'supervisor start {component.name} (restarts {component.restarts})')
+
+  def _schedule_restart(self, component: Component) :
+    delay = component.next_delay()
+    logger.info(f'supervisor restart {component.name} after {delay:0.2f}s')
+    timer = threading.Timer(delay, self._events.put, args=((_EVENT_RESTART, component.name, None),))
+    timer.daemon = True
+    timer.start()
+    self._timers.append(timer)
+
+  def run(self) -> None :
+    for component in self._components.values() :
+      self._start(component)
+
+    try :
+      while True :
+        try :
+          event, name, exception = self._events.get(timeout=EVENT_WAIT_TIMEOUT)
+        except queue.Empty :
+          continue
+        if event == _EVENT_STOP :
+          logger.info(f'supervisor stop. ({name})')
+          break
+
+        component = self._components[name]
+        if event == _EVENT_RESTART :
+          component.restarts += 1
+          self._start(component)
+          continue
+
+        # _EVENT_EXITED
+        component.exception = exception
+        if isinstance(exception, KeyboardInterrupt) :
+          raise exception
+        if component.should_restart(exception) :
+          logger.info(f'supervisor {name} exited. {exception!r}')
+          self._schedule_restart(component)
+          continue
+        if exception is not None :
+          logger.error(f'{name} has occured exception.', exc_info=exception)
+        logger.info(f'supervisor {name} done.')
+        break
+    finally :
+      self.shutdown()
+
+  def shutdown(self) -> dict :
+    """ 全てのコンポーネントを並行して停止し、期限まで終了を待つ。
+
+    コンポーネントごとの停止にかかった時間 (終了しなかった場合は None) を返す。
+    """
+    if self._stopping.is_set() :
+      return self.shutdown_report
+    self._stopping.set()
+    for timer in self._timers :
+      timer.cancel()
+
+    started = time.monotonic()
+    deadline = self._deadline = started + self.shutdown_deadline
+    components = list(self._components.values())
+
+    report = {component.name : None for component in components}
+
+    def _stop(component: Component) :
+      t = time.monotonic()
+      if component.stop is not None :
+        try :
+          component.stop()
+        except Exception :
+          logger.exception(f'supervisor stop {component.name} failed.')
+      if component.thread is not None :
+        component.thread.join(max(0.0, deadline - time.monotonic()))
+      if not component.is_alive() :
+        report[component.name] = time.monotonic() - t
+
+    # 停止が終わらないコンポーネントがあっても、プロセスの終了を妨げないよう daemon で実行する
+    stoppers = [threading.Thread(target=_stop, args=(component,), name=f'stop-{component.name}', daemon=True)
+                for component in components]
+    for stopper in stoppers :
+      stopper.start()
+    for stopper in stoppers :
+      stopper.join(max(0.0, deadline - time.monotonic()))
+
+    self.shutdown_report = report
+    stuck = [name for name, seconds in report.items() if seconds is None]
+    slowest = max(((s, n) for n, s in report.items() if s is not None), default=None)
+    logger.info(
+        f'supervisor shutdown {time.monotonic() - started:0.3f}s '
+        f'slowest:{slowest[1] if slowest else None}({slowest[0] if slowest else 0.0:0.3f}s) stuck:{stuck}')
+    for name in stuck :
+      logger.warning(f'supervisor {name} did not stop within {self.shutdown_deadline}s.')
+    return report
+
+  def wait_threads(self) -> list :
+    """ コンポーネント以外も含めた全ての (daemon ではない) スレッドの終了を、
+    shutdown() の期限まで待つ。期限までに終了しなかったスレッドを返す。
+    """
+    deadline = self._deadline
+    if deadline is None :
+      deadline = time.monotonic() + self.shutdown_deadline
+    current = threading.current_thread()
+    for thread in threading.enumerate() :
+      if thread is current or thread.daemon :
+        continue
+      thread.join(max(0.0, deadline - time.monotonic()))
+
+    alive = [thread for thread in threading.enumerate()
+             if thread is not current and not thread.daemon and thread.is_alive()]
+    for thread in alive :
+      logger.warning(f'supervisor thread is still alive after shutdown. {thread}')
+    return alive
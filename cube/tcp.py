@@ -1,61 +1,159 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
 import errno
 from logging import getLogger
 import os
+import queue
+import selectors
 import socket
+import struct
 import time
 import threading
 
 import utils
+from cube import identity
 
 
 logger = getLogger(__name__)
 
-def _client_thread(client, address, target) :
+# メッセージの区切り方
+# FRAMING_NONE   : 受信できたデータの塊を1メッセージとする(従来の動作)
+# FRAMING_LENGTH : 4byte(big endian)のデータ長を先頭に付加したメッセージ
+FRAMING_NONE = None
+FRAMING_LENGTH = 'length'
+
+_HEADER = struct.Struct('!I')
+
+_RECV_SIZE = 65536
+_BUFFER_POOL_SIZE = 16
+# FRAMING_NONE の Client が受け取る応答の最大長
+_RESPONSE_SIZE = 1024
+
+
+def resolve_address(address, port) :
+  """ "eth0", "wlan0" が指定された場合はインターフェースのアドレスに変換する。
+  アドレスは identity にキャッシュされたものを使用する。
+  """
+  if os.name == 'posix' and address in ("eth0", "wlan0") :
+    ipv4_addr = identity.interface_address(address)
+    if ipv4_addr is not None :
+      return (ipv4_addr, port), True
+    return ("localhost", port), False
+  return (address, port), True
+
+
+def send_frame(sock, data) :
+  """ データ長を付加してメッセージを送信する。(FRAMING_LENGTH)
+  """
+  if isinstance(data, str) :
+    data = data.encode('utf-8')
+  sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock) :
+  """ データ長付きのメッセージを1つ受信する。(FRAMING_LENGTH)
+  切断された場合はNoneを返す。
+  """
+  header = _recv_exactly(sock, _HEADER.size)
+  if header is None :
+    return None
+  length, = _HEADER.unpack(header)
+  return _recv_exactly(sock, length)
+
+
+def _recv_exactly(sock, size) :
+  buf = bytearray(size)
+  view = memoryview(buf)
+  received = 0
+  while received < size :
+    n = sock.recv_into(view[received:], size - received)
+    if n == 0 :
+      return None
+    received += n
+  return bytes(buf)
+
+
+class _Connection(object):
+  """ 接続ごとの状態 """
+
+  __slots__ = ('sock', 'address', 'buffer', 'last_active', 'busy', 'closed')
+
+  def __init__(self, sock, address, buffer) :
+    self.sock = sock
+    self.address = address
+    self.buffer = buffer
+    self.last_active = time.monotonic()
+    self.busy = False
+    self.closed = False
 
-  logger.debug(f"[*] Connected!! [ Source : {address}]")
-  message = client.recv(1024)
-  if 0 < len(message) :
-    logger.debug(f"[*] recived!! [{message}]")
-    # parameter = pickle.loads(message)
-    # message = message.decode('utf-8')
-    if target is not None :
-      target(client, address, message)
 
 class Server(threading.Thread):
-  """docstring for Server."""
+  """ selectorsを使ったTCPサーバー
+
+  1つのスレッドで全ての接続を監視し、受信したメッセージは
+  上限付きのスレッドプールで target(client, address, message) を呼び出す。
+
+  keep_alive が False の場合は従来どおり target から戻った時点で接続を閉じる。
+  True の場合は接続を監視対象に戻し、続けて次のメッセージを受け付ける。
+  省略した場合は FRAMING_LENGTH の場合だけ True にする。
+  """
+
+  @property
+  def accepted(self) -> int :
+    return self._accepted
 
-  def __init__(self, address, port, *, num=5, target=None, daemon=None) :
+  @property
+  def active(self) -> int :
+    return len(self._connections)
+
+  @property
+  def rejected(self) -> int :
+    return self._rejected
+
+  def __init__(self, address, port, *, num=5, target=None, daemon=None
+                , max_connections=64, max_workers=8, idle_timeout=30.0
+                , framing=FRAMING_NONE, max_message=None, keep_alive=None) :
     super().__init__(daemon=daemon)
-    if os.name == 'posix':
-      import netifaces
-      if address in ("eth0", "wlan0"):
-        iface = netifaces.ifaddresses(address)
-        ipv4_addr = iface.get(netifaces.AF_INET)
-        if ipv4_addr is not None :
-          self._address = (ipv4_addr[0]['addr'], port)
-          logger.info(
-              f"TCP server was created from address {self._address} [{address}]")
-        else:
-          self._address = ("localhost", port)
-          logger.info(f" {self._address} wasn't there,")
-          logger.info(" so TCP server was created on localhost.")
-      else :
-        self._address = (address, port)
-        logger.info(
-            f"TCP server was created from address {self._address}")
+
+    self._address, found = resolve_address(address, port)
+    if found :
+      logger.info(f"TCP server was created from address {self._address} [{address}]")
     else :
-      self._address = (address, port)
-      logger.info(
-          f"TCP server was created from address {self._address}")
+      logger.info(f" {self._address} wasn't there,")
+      logger.info(" so TCP server was created on localhost.")
+
+    if framing not in (FRAMING_NONE, FRAMING_LENGTH) :
+      raise ValueError(f"unknown framing {framing}")
 
     self._num = num
     self._target = target
+    self._max_connections = max_connections
+    self._max_workers = max_workers
+    self._idle_timeout = idle_timeout
+    self._framing = framing
+    self._max_message = max_message
+    self._keep_alive = (framing == FRAMING_LENGTH) if keep_alive is None else keep_alive
+
     self._do = False
     self._listen = False
 
+    self._selector = None
+    self._connections = {}
+    self._buffer_pool = []
+    self._recv_buffer = bytearray(_RECV_SIZE)
+    self._recv_view = memoryview(self._recv_buffer)
+
+    # ワーカースレッドから処理が終わった接続を戻すためのキュー
+    self._returned = queue.SimpleQueue()
+    self._wakeup_r, self._wakeup_w = socket.socketpair()
+    self._wakeup_r.setblocking(False)
+    self._wakeup_w.setblocking(False)
+
+    self._accepted = 0
+    self._rejected = 0
+
   def __enter__(self) :
     self.start()
     return self
@@ -63,6 +161,13 @@ class Server(threading.Thread):
   def __exit__(self, exc_type, exc_value, traceback):
     self.stop()
 
+  def stats(self) -> dict :
+    return {
+      'accepted' : self._accepted,
+      'active' : self.active,
+      'rejected' : self._rejected,
+    }
+
   def run(self) :
 
     addr_in_use = False
@@ -75,45 +180,238 @@ class Server(threading.Thread):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock :
           sock.bind(self._address)
           sock.listen(self._num)
+          sock.setblocking(False)
           if addr_in_use :
             addr_in_use = False
             logger.info(f"Address {self._address} bind success.")
-            self._listen = True
-
-          while self._do :
-            try :
-              client, address = sock.accept()
-              try :
-                thread = threading.Thread(target=_client_thread, args=(client, address, self._target))
-              finally :
-                client = None
-                address = None
-              thread.start()
-            except (socket.herror, socket.gaierror, socket.timeout):
-              raise
-            except Exception:
-              logger.exception(utils.location())
+          self._listen = True
+
+          try :
+            with ThreadPoolExecutor(max_workers=self._max_workers
+                                    , thread_name_prefix="tcp.Server") as executor :
+              with selectors.DefaultSelector() as selector :
+                self._selector = selector
+                try :
+                  selector.register(sock, selectors.EVENT_READ, None)
+                  selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup_r)
+                  self._serve(sock, executor)
+                finally :
+                  self._selector = None
+                  for conn in list(self._connections.values()) :
+                    self._close(conn)
+                  self._listen = False
+          finally :
+            # executor の終了を待ったので、実行中だったハンドラの接続は全て戻っている
+            self._restore_returned(None)
 
       except (socket.herror, socket.gaierror, socket.timeout) as e:
         utils.exception(logger)
         time.sleep(1)
       except OSError as oserr :
-        if oserr.errno in (errno.EADDRINUSE, errno.WSAEADDRINUSE):
+        if oserr.errno in (errno.EADDRINUSE, getattr(errno, 'WSAEADDRINUSE', errno.EADDRINUSE)):
           logger.info(
               f"Address {self._address} already in use.wait for release address.")
           addr_in_use = True
         else :
-          pass
+          logger.exception(utils.location())
+          time.sleep(1)
       except :
+        logger.exception(utils.location())
+        time.sleep(1)
+
+  def _serve(self, sock, executor) :
+    while self._do :
+      for key, mask in self._selector.select(self._select_timeout()) :
+        if key.data is None :
+          self._accept(sock)
+        elif key.data is self._wakeup_r :
+          self._drain_wakeup()
+        else :
+          self._read(key.data, executor)
+
+      self._restore_returned(executor)
+      self._expire_idle()
+
+  def _select_timeout(self) :
+    if not self._idle_timeout :
+      return None
+    return min(self._idle_timeout, 1.0)
+
+  def _accept(self, sock) :
+    try :
+      client, address = sock.accept()
+    except (BlockingIOError, InterruptedError) :
+      return
+
+    if self._max_connections <= len(self._connections) :
+      self._rejected += 1
+      logger.warning(
+          f"[*] Rejected!! [ Source : {address}] active {len(self._connections)}")
+      client.close()
+      return
+
+    self._accepted += 1
+    logger.debug("[*] Connected!! [ Source : %s]", address)
+    client.setblocking(False)
+    buffer = self._buffer_pool.pop() if self._buffer_pool else bytearray()
+    conn = _Connection(client, address, buffer)
+    self._connections[client.fileno()] = conn
+    self._selector.register(client, selectors.EVENT_READ, conn)
+
+  def _read(self, conn, executor) :
+    try :
+      while True :
+        n = conn.sock.recv_into(self._recv_view)
+        if n == 0 :
+          self._close(conn)
+          return
+        conn.buffer += self._recv_view[:n]
+        if n < _RECV_SIZE :
+          break
+    except (BlockingIOError, InterruptedError) :
+      pass
+    except OSError :
+      self._close(conn)
+      return
+
+    conn.last_active = time.monotonic()
+
+    if self._max_message and self._max_message < len(conn.buffer) :
+      logger.warning(f"[*] message too large [ Source : {conn.address}]")
+      self._close(conn)
+      return
+
+    self._dispatch(conn, executor)
+
+  def _next_message(self, conn) :
+    """ バッファから1メッセージを取り出す。揃っていなければNone """
+    buffer = conn.buffer
+    if self._framing == FRAMING_LENGTH :
+      if len(buffer) < _HEADER.size :
+        return None
+      length, = _HEADER.unpack_from(buffer)
+      if self._max_message and self._max_message < length :
+        raise ValueError(f"message too large {length}")
+      end = _HEADER.size + length
+      if len(buffer) < end :
+        return None
+      message = bytes(buffer[_HEADER.size:end])
+      del buffer[:end]
+      return message
+    else :
+      if not buffer :
+        return None
+      message = bytes(buffer)
+      buffer.clear()
+      return message
+
+  def _dispatch(self, conn, executor) :
+    try :
+      message = self._next_message(conn)
+    except ValueError :
+      logger.warning(f"[*] message too large [ Source : {conn.address}]")
+      self._close(conn)
+      return
+    if message is None :
+      return
+
+    logger.debug("[*] recived!! [%s]", message)
+    if self._target is None :
+      return
+
+    # ハンドラの実行中は監視対象から外し、ブロッキングモードで渡す
+    self._selector.unregister(conn.sock)
+    conn.busy = True
+    conn.sock.setblocking(True)
+    if self._idle_timeout :
+      conn.sock.settimeout(self._idle_timeout)
+    executor.submit(self._handle, conn, message)
+
+  def _handle(self, conn, message) :
+    try :
+      self._target(conn.sock, conn.address, message)
+    except Exception:
+      logger.exception(utils.location())
+    finally :
+      self._returned.put(conn)
+      try :
+        self._wakeup_w.send(b'\0')
+      except (BlockingIOError, OSError) :
         pass
 
+  def _restore_returned(self, executor) :
+    while True :
+      try :
+        conn = self._returned.get_nowait()
+      except queue.Empty :
+        return
+      conn.busy = False
+      if conn.closed :
+        # ハンドラの実行中に閉じられた接続
+        self._release(conn)
+        continue
+      if self._selector is None or not self._keep_alive :
+        self._close(conn)
+        continue
+      try :
+        conn.sock.setblocking(False)
+        conn.last_active = time.monotonic()
+        self._selector.register(conn.sock, selectors.EVENT_READ, conn)
+      except (OSError, ValueError) :
+        # ハンドラ内でソケットが閉じられた
+        self._close(conn)
+        continue
+      # 既に次のメッセージを受信済みであれば続けて処理する
+      self._dispatch(conn, executor)
+
+  def _drain_wakeup(self) :
+    try :
+      while self._wakeup_r.recv(4096) :
+        pass
+    except (BlockingIOError, InterruptedError) :
+      pass
+
+  def _expire_idle(self) :
+    if not self._idle_timeout :
+      return
+    limit = time.monotonic() - self._idle_timeout
+    for conn in list(self._connections.values()) :
+      if not conn.busy and conn.last_active < limit :
+        logger.debug(f"[*] Idle timeout!! [ Source : {conn.address}]")
+        self._close(conn)
+
+  def _close(self, conn) :
+    if conn.closed :
+      return
+    conn.closed = True
+    try :
+      if not conn.busy and self._selector is not None :
+        self._selector.unregister(conn.sock)
+    except (KeyError, ValueError, OSError) :
+      pass
+    for fileno, c in list(self._connections.items()) :
+      if c is conn :
+        del self._connections[fileno]
+        break
+    if not conn.busy :
+      self._release(conn)
+    # 実行中のハンドラがある場合は、戻ってきた時点で _restore_returned() から解放する
+
+  def _release(self, conn) :
+    """ ソケットを閉じ、バッファをプールへ戻す """
+    conn.sock.close()
+    buffer, conn.buffer = conn.buffer, None
+    if buffer is not None :
+      buffer.clear()
+      if len(self._buffer_pool) < _BUFFER_POOL_SIZE :
+        self._buffer_pool.append(buffer)
+
   def stop(self) :
       if self._do :
           self._do = False
           try :
-              with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                  s.connect(self._address)
-          except (socket.herror, socket.gaierror, socket.timeout):
+              self._wakeup_w.send(b'\0')
+          except OSError :
               pass
 
   def is_listen(self) :
@@ -122,29 +420,22 @@ class Server(threading.Thread):
 class Client(object):
   """docstring for Server."""
 
-  def __init__(self, address, port) :
+  def __init__(self, address, port, *, framing=FRAMING_NONE, timeout=None) :
 
     logger.debug("tcp.Client.__init__()")
-    if os.name == 'posix':
-      if address in ("eth0", "wlan0"):
-        iface = netifaces.ifaddresses(address)
-        ipv4_addr = iface.get(netifaces.AF_INET)
-        if ipv4_addr is not None :
-          self._address = (ipv4_addr[0]['addr'], port)
-          logger.debug(f"TCP crient was created from address {self._address} [{address}]")
-        else :
-          self._address = ("localhost", port)
-          logger.debug(f" {self._address} wasn't there,")
-          logger.debug( " so TCP crient was created on localhost.")
-      else :
-        self._address = (address, port)
-        logger.debug(f"TCP crient was created from address {self._address}")
-    else:
-      self._address = (address, port)
+    self._address, found = resolve_address(address, port)
+    if found :
       logger.debug(f"TCP crient was created from address {self._address}")
+    else :
+      logger.debug(f" {self._address} wasn't there,")
+      logger.debug( " so TCP crient was created on localhost.")
 
+    self._framing = framing
     self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     logger.debug("socket.socket(socket.AF_INET, socket.SOCK_STREAM)")
+    if timeout is not None :
+      # 接続・送信・受信のそれぞれを timeout 秒までしか待たない
+      self._socket.settimeout(timeout)
 
 
   def __enter__(self) :
@@ -157,18 +448,28 @@ class Client(object):
     self._socket.settimeout(timeout)
 
   def send(self, args) :
-    logger.debug(f"tcp.Client.send({args})")
+    """ args を送信して応答を返す。
+
+    FRAMING_NONE の場合、応答は1回の受信 (最大 _RESPONSE_SIZE byte) で読める分だけを返す。
+    相手が応答後に接続を閉じるとは限らないため、切断までは待たない。
+    それより長い応答を受け取る場合は FRAMING_LENGTH を使うこと。
+    """
+    logger.debug("tcp.Client.send(%s)", args)
     try :
       self._socket.connect(self._address)
-      logger.debug(f"self._socket.connect({self._address})")
+      logger.debug("self._socket.connect(%s)", self._address)
       try:
         # msg = pickle.dumps(args)
         msg = args.encode('utf-8')
-        self._socket.send(msg)
-        logger.debug(f"tcp.Client.send({msg})")
-        resp = self._socket.recv(1024)
+        if self._framing == FRAMING_LENGTH :
+          send_frame(self._socket, msg)
+          resp = recv_frame(self._socket) or b''
+        else :
+          self._socket.sendall(msg)
+          resp = self._socket.recv(_RESPONSE_SIZE)
+        logger.debug("tcp.Client.send(%s)", msg)
         response = resp.decode('utf-8')
-        logger.debug(f"response ----->:{response}")
+        logger.debug("response ----->:%s", response)
         return response
       finally :
         self._socket.close()
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" 診察ごとの処理時間のトレース (span)
+
+カードのタッチから UV ライトの消灯まで、診察の各段階を span として記録し、
+JSON lines のファイルに出力する。1回の診察が1つのトレースになる。
+
+  tracing.begin_trace('consultation', idm=idm)
+  with tracing.span('cube.open') :
+    with tracing.span('door.unlock') :
+      ...
+  tracing.end_trace()
+
+現在の span は contextvars で持つので、asyncio のタスクには自動で引き継がれる。
+別のスレッド・Executor で実行する処理は wrap() / submit() で引き継ぐ。
+引き継げない場所 (コールバック等) で作った span は、現在のトレースの最上位の
+span の子になる。トレースを開始していない間の span は記録しない。
+
+開始と終了が別のスレッドになる区間 (サーバの応答待ち、入室待ち等) は
+start_span() で開始し、end_span() で終了する。
+
+共有する状態を持つので、他のモジュールからは `from cube import tracing` で参照すること。
+
+python -m cube.tracing で、診察ごとの span の木とクリティカルパスを表示する。
+"""
+import contextvars
+import functools
+import json
+from logging import getLogger
+import math
+import os
+import threading
+import time
+
+logger = getLogger(__name__)
+
+# 出力形式
+FORMAT_JSONL = 'jsonl'
+FORMAT_OTLP = 'otlp'
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+# トレースの終了時に終了していなかった span
+STATUS_UNFINISHED = 'unfinished'
+
+_current = contextvars.ContextVar('cube_tracing_span', default=None)
+
+_lock = threading.Lock()
+_trace = None
+_exporter = None
+
+
+def _new_id(nbytes) -> str :
+  return os.urandom(nbytes).hex()
+
+
+def wall_time(monotonic_time: float) -> float :
+  """ time.monotonic() の時刻を time.time() の時刻に変換する """
+  return time.time() - (time.monotonic() - monotonic_time)
+
+
+class Span(object) :
+  """ 処理1つ分の区間
+
+  with で使うと、その間は現在の span になる。trace が None の span は記録しない。
+  """
+  __slots__ = ('name', 'trace', 'span_id', 'parent_id', 'start_time', 'end_time',
+               'attributes', 'status', 'thread', '_token')
+
+  def __init__(self, name, trace, parent_id=None, start_time: float | None = None, attributes=None) :
+    self.name = name
+    self.trace = trace
+    self.span_id = _new_id(8)
+    self.parent_id = parent_id
+    self.start_time = time.time() if start_time is None else start_time
+    self.end_time = None
+    self.attributes = dict(attributes or {})
+    self.status = STATUS_OK
+    self.thread = threading.current_thread().name
+    self._token = None
+
+  @property
+  def trace_id(self) -> str | None :
+    return self.trace.trace_id if self.trace is not None else None
+
+  @property
+  def duration(self) -> float | None :
+    return None if self.end_time is None else self.end_time - self.start_time
+
+  def set_attributes(self, **attributes) :
+    self.attributes.update(attributes)
+    return self
+
+  def set_error(self, exception) :
+    self.status = STATUS_ERROR
+    self.attributes['error'] = f'{type(exception).__name__}: {exception}'
+
+  def end(self, end_time: float | None = None, status: str | None = None) :
+    """ span を終了して出力する (2回目以降は何もしない) """
+    if self.end_time is not None :
+      return
+    self.end_time = time.time() if end_time is None else end_time
+    if status is not None :
+      self.status = status
+    if self.trace is not None :
+      self.trace._ended(self)
+
+  def __enter__(self) :
+    self._token = _current.set(self)
+    return self
+
+  def __exit__(self, exception_type, exception_value, traceback) :
+    if exception_value is not None and not isinstance(exception_value, GeneratorExit) :
+      self.set_error(exception_value)
+    _current.reset(self._token)
+    self._token = None
+    self.end()
+
+  def to_dict(self) -> dict :
+    return {
+        'trace': self.trace_id,
+        'span': self.span_id,
+        'parent': self.parent_id,
+        'name': self.name,
+        'start': round(self.start_time, 6),
+        'end': None if self.end_time is None else round(self.end_time, 6),
+        'thread': self.thread,
+        'status': self.status,
+        'attributes': self.attributes,
+    }
+
+  def __repr__(self) :
+    return f'Span({self.name!r}, trace={self.trace_id}, span={self.span_id})'
+
+
+class Trace(object) :
+  """ 診察1回分の span の集まり """
+
+  def __init__(self, name, start_time: float | None = None, attributes=None) :
+    self.trace_id = _new_id(16)
+    self._lock = threading.Lock()
+    # start_span() で開始して、まだ終了していない span
+    self._open = {}
+    self.spans = 0
+    self.root = Span(name, self, start_time=start_time, attributes=attributes)
+
+  def _ended(self, span: Span) :
+    with self._lock :
+      self.spans += 1
+      if self._open.get(span.name) is span :
+        del self._open[span.name]
+    exporter = _exporter
+    if exporter is not None :
+      exporter.export(span)
+
+  def end(self, **attributes) :
+    """ 終了していない span を打ち切って、最上位の span を終了する """
+    with self._lock :
+      unfinished = list(self._open.values())
+    end_time = time.time()
+    for span in unfinished :
+      span.end(end_time, STATUS_UNFINISHED)
+    self.root.set_attributes(**attributes)
+    self.root.end(end_time)
+
+
+def begin_trace(name='consultation', *, start_time: float | None = None, **attributes) -> Trace :
+  """ トレースを開始する。開始中のトレースは終了する """
+  global _trace
+  trace = Trace(name, start_time, attributes)
+  with _lock :
+    previous, _trace = _trace, trace
+  if previous is not None :
+    previous.end(superseded=True)
+  return trace
+
+
+def end_trace(**attributes) -> None :
+  """ 現在のトレースを終了する """
+  global _trace
+  with _lock :
+    trace, _trace = _trace, None
+  if trace is not None :
+    trace.end(**attributes)
+
+
+def current_trace() -> Trace | None :
+  return _trace
+
+
+def set_attributes(**attributes) -> None :
+  """ 現在のトレースの最上位の span に属性を追加する (予約ID等) """
+  trace = _trace
+  if trace is not None :
+    trace.root.set_attributes(**attributes)
+
+
+def current_span() -> Span | None :
+  return _current.get()
+
+
+def start_span(name, *, start_time: float | None = None, **attributes) -> Span :
+  """ span を開始する。現在の span にはせず、end() か end_span() で終了する """
+  parent = _current.get()
+  if parent is not None and parent.trace is not None :
+    trace = parent.trace
+  else :
+    trace = _trace
+    parent = trace.root if trace is not None else None
+  span = Span(name, trace, parent.span_id if parent is not None else None, start_time, attributes)
+  if trace is not None :
+    with trace._lock :
+      trace._open[name] = span
+  return span
+
+
+def end_span(name, **attributes) -> None :
+  """ 現在のトレースで start_span() した name の span を終了する """
+  trace = _trace
+  if trace is None :
+    return
+  with trace._lock :
+    span = trace._open.get(name)
+  if span is not None :
+    span.set_attributes(**attributes)
+    span.end()
+
+
+def span(name, **attributes) -> Span :
+  """ with で使う span """
+  parent = _current.get()
+  if parent is not None and parent.trace is not None :
+    return Span(name, parent.trace, parent.span_id, attributes=attributes)
+  trace = _trace
+  if trace is None :
+    return Span(name, None, attributes=attributes)
+  return Span(name, trace, trace.root.span_id, attributes=attributes)
+
+
+def traced(name=None) :
+  """ 関数の呼び出しを span にするデコレータ """
+  def _decorator(function) :
+    span_name = name or function.__qualname__
+
+    @functools.wraps(function)
+    def _wrapper(*args, **kwargs) :
+      with span(span_name) :
+        return function(*args, **kwargs)
+    return _wrapper
+  return _decorator
+
+
+def wrap(function, name=None) :
+  """ 現在の span (と期限等の contextvars) を引き継いで function を呼び出す関数を返す (スレッド・Executor 用)
+
+  name を指定すると、呼び出しをその名前の span にする。
+  """
+  context = contextvars.copy_context()
+
+  def _call(*args, **kwargs) :
+    if name is None :
+      return function(*args, **kwargs)
+    with span(name) :
+      return function(*args, **kwargs)
+
+  @functools.wraps(function)
+  def _wrapper(*args, **kwargs) :
+    # 同時に複数回呼び出されてもよいよう、呼び出しごとに複製する
+    return context.copy().run(_call, *args, **kwargs)
+  return _wrapper
+
+
+def submit(executor, name, function, /, *args, **kwargs) :
+  """ 現在の span を引き継いで executor.submit() し、呼び出しを name の span にする """
+  return executor.submit(wrap(function, name), *args, **kwargs)
+
+
+# ##############################################################################
+# 出力
+# ##############################################################################
+def _otlp_value(value) -> dict :
+  if isinstance(value, bool) :
+    return {'boolValue': value}
+  if isinstance(value, int) :
+    return {'intValue': str(value)}
+  if isinstance(value, float) :
+    return {'doubleValue': value}
+  return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes) -> list :
+  return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _otlp_span(span: Span) -> dict :
+  attributes = dict(span.attributes, **{'thread.name': span.thread})
+  record = {
+      'traceId': span.trace_id,
+      'spanId': span.span_id,
+      'name': span.name,
+      'kind': 1,
+      'startTimeUnixNano': str(int(span.start_time * 1e9)),
+      'endTimeUnixNano': str(int(span.end_time * 1e9)),
+      'attributes': _otlp_attributes(attributes),
+      'status': {'code': 2, 'message': span.status} if span.status != STATUS_OK else {'code': 1},
+  }
+  if span.parent_id :
+    record['parentSpanId'] = span.parent_id
+  return record
+
+
+class Exporter(object) :
+  """ 終了した span を1行ずつファイルに追記する
+
+  format は jsonl (Span.to_dict() の1行) または otlp (OTLP/JSON の
+  ExportTraceServiceRequest を1行。OpenTelemetry Collector の file receiver 等で読める)。
+  """
+
+  def __init__(self, path, format=FORMAT_JSONL, resource=None) :
+    if format not in (FORMAT_JSONL, FORMAT_OTLP) :
+      raise ValueError(f'unknown trace format {format}.')
+    self.path = path
+    self.format = format
+    self.resource = dict(resource or {'service.name': 'cube'})
+    self.exported = 0
+    self.failed = 0
+    self._lock = threading.Lock()
+
+  def _line(self, span: Span) -> str :
+    if self.format == FORMAT_OTLP :
+      return json.dumps({'resourceSpans': [{
+          'resource': {'attributes': _otlp_attributes(self.resource)},
+          'scopeSpans': [{'scope': {'name': __name__}, 'spans': [_otlp_span(span)]}],
+      }]}, ensure_ascii=False, default=str)
+    return json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+
+  def export(self, span: Span) :
+    try :
+      line = self._line(span)
+      with self._lock :
+        with open(self.path, 'a', encoding='utf-8') as f :
+          f.write(line + '\n')
+        self.exported += 1
+    except Exception :
+      self.failed += 1
+      logger.exception(f'trace export failed. {self.path}')
+
+  def stats(self) -> dict :
+    return {'exported': self.exported, 'failed': self.failed}
+
+
+def configure(path, format=FORMAT_JSONL, resource=None) -> Exporter | None :
+  """ span の出力先を設定する。path が空の場合は出力しない """
+  global _exporter
+  _exporter = Exporter(path, format, resource) if path else None
+  if _exporter is not None :
+    logger.info(f'trace export {format} {path}')
+  return _exporter
+
+
+def stats() -> dict | None :
+  exporter = _exporter
+  return exporter.stats() if exporter is not None else None
+
+
+# ##############################################################################
+# 読み込み・表示
+# ##############################################################################
+def _from_otlp(record) -> list :
+  spans = []
+  for resource_spans in record.get('resourceSpans', []) :
+    for scope_spans in resource_spans.get('scopeSpans', []) :
+      for s in scope_spans.get('spans', []) :
+        attributes = {a['key']: next(iter(a['value'].values()), None) for a in s.get('attributes', [])}
+        status = s.get('status', {})
+        spans.append({
+            'trace': s['traceId'],
+            'span': s['spanId'],
+            'parent': s.get('parentSpanId'),
+            'name': s['name'],
+            'start': int(s['startTimeUnixNano']) / 1e9,
+            'end': int(s['endTimeUnixNano']) / 1e9,
+            'thread': attributes.pop('thread.name', None),
+            'status': status.get('message', STATUS_ERROR) if status.get('code') == 2 else STATUS_OK,
+            'attributes': attributes,
+        })
+  return spans
+
+
+def load(path) -> dict :
+  """ {trace_id: [span の dict]} (jsonl と otlp のどちらの形式も読める) """
+  traces = {}
+  with open(path, encoding='utf-8') as f :
+    for line in f :
+      line = line.strip()
+      if not line :
+        continue
+      try :
+        record = json.loads(line)
+      except ValueError :
+        continue
+      for s in (_from_otlp(record) if 'resourceSpans' in record else [record]) :
+        traces.setdefault(s['trace'], []).append(s)
+  return traces
+
+
+def _root_of(spans) -> dict | None :
+  ids = {s['span'] for s in spans}
+  roots = [s for s in spans if not s.get('parent') or s['parent'] not in ids]
+  return min(roots, key=lambda s: s['start']) if roots else None
+
+
+def critical_path(spans) -> list :
+  """ 終了を遅らせていた span の一覧 (開始順)
+
+  各 span の子を終了の遅い順に見て、前の子の開始までに終了していた子を
+  つないだ列を、それぞれの子についても再帰的にたどる。
+  """
+  children = {}
+  for s in spans :
+    children.setdefault(s.get('parent'), []).append(s)
+
+  def _walk(node) :
+    path = [node]
+    t = node['end'] if node['end'] is not None else math.inf
+    chain = []
+    for child in sorted(children.get(node['span'], []), key=lambda s: s['end'] or 0.0, reverse=True) :
+      if child['end'] is not None and child['end'] <= t :
+        chain.append(child)
+        t = child['start']
+    for child in reversed(chain) :
+      path.extend(_walk(child))
+    return path
+
+  root = _root_of(spans)
+  return _walk(root) if root is not None else []
+
+
+def format_trace(spans) -> str :
+  """ span の木 (開始からの経過時間と処理時間)。クリティカルパスの span に * を付ける """
+  root = _root_of(spans)
+  if root is None :
+    return ''
+  critical = {s['span'] for s in critical_path(spans)}
+  children = {}
+  for s in spans :
+    children.setdefault(s.get('parent'), []).append(s)
+
+  attributes = ' '.join(f'{k}:{v}' for k, v in root['attributes'].items())
+  lines = [f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(root['start']))} "
+           f"{root['name']} trace:{root['trace']} {attributes}"]
+
+  def _add(node, depth) :
+    start = (node['start'] - root['start']) * 1000
+    duration = f"{(node['end'] - node['start']) * 1000:9.1f}ms" if node['end'] is not None else '        -  '
+    mark = '*' if node['span'] in critical else ' '
+    status = f" [{node['status']}]" if node['status'] != STATUS_OK else ''
+    lines.append(f"  {mark} {start:9.1f}ms {duration} {'  ' * depth}{node['name']}"
+                 f" ({node.get('thread')}){status}")
+    for child in sorted(children.get(node['span'], []), key=lambda s: s['start']) :
+      _add(child, depth + 1)
+
+  _add(root, 0)
+  return '\n'.join(lines)
+
+
+if __name__ == '__main__' :
+  import argparse
+
+  argp = argparse.ArgumentParser(description='show consultation traces and their critical path.')
+  argp.add_argument('path', help='trace file (jsonl or otlp)')
+  argp.add_argument('-r', '--reservation-id', help='show only this reservation')
+  argp.add_argument('-i', '--idm', help='show only this card')
+  argp.add_argument('-n', '--last', type=int, default=0, help='show only the last N traces')
+  args = argp.parse_args()
+
+  traces = []
+  for spans in load(args.path).values() :
+    root = _root_of(spans)
+    if root is None :
+      continue
+    if args.reservation_id and str(root['attributes'].get('reservation_id')) != args.reservation_id :
+      continue
+    if args.idm and root['attributes'].get('idm') != args.idm :
+      continue
+    traces.append((root['start'], spans))
+  traces.sort(key=lambda item: item[0])
+  if args.last :
+    traces = traces[-args.last:]
+  for _, spans in traces :
+    print(format_trace(spans))
+    print()
@@ -2,15 +2,18 @@
 # -*- coding: utf-8 -*-
 import json
 from logging import getLogger
+import time
 
 import application
 import tcp
+from cube import resilience
 
 _CMD_KEY_WHITEBOARD = "whiteboard"
 _CMD_KEY_STETHOSCOPE = "stethoscope"
 
 _CMD_KEY_OPERATION = "operation"
 _OPERATION_OPEN = "open"
+_OPERATION_PRELOAD = "preload"
 _OPERATION_CLOSE = "close"
 _OPERATION_CLICK = "click"
 
@@ -34,6 +37,13 @@ ONLINEMED_STETHOSCOPE_URL = application.configs.get('TCU', 'ONLINEMED_STETHOSCOP
 
 logger = getLogger(__name__)
 
+# ホワイトボードへの要求1回の応答を待つ時間
+WHITEBOARD_TIMEOUT = 5.0
+# preload に応答しなかったホワイトボードへ、再度 preload を送るまでの時間 (秒)
+PRELOAD_RETRY_INTERVAL = 600.0
+
+_BREAKER = resilience.breaker('whiteboard', timeout=WHITEBOARD_TIMEOUT)
+
 class Whiteboard(object) :
 
   def __init__(self, address, port
@@ -47,6 +57,8 @@ class Whiteboard(object) :
     self._port = port
     self._url = url
     self._mode = mode
+    # preload を確認できなかった時刻 (time.monotonic())
+    self._preload_rejected_time = None
 
   def __enter__(self) :
     return self.open()
@@ -54,23 +66,77 @@ class Whiteboard(object) :
   def __exit__(self, exception_type, exception_value, traceback) :
     self.close()
 
+  def _request(self, message) :
+    # 呼び出し元の期限 (breaker の timeout 以下) までしか待たない
+    with tcp.Client(self._addr, self._port, timeout=resilience.remaining()) as client :
+      response = client.send(message)
+    if response is None :
+      raise ConnectionError(f'whiteboard {self._addr}:{self._port} did not respond.')
+    return response
+
   def _send(self, command) :
-    with tcp.Client(self._addr, self._port) as client :
-      client.send(json.dumps(command))
+    try :
+      return _BREAKER.call(self._request, json.dumps(command))
+    except (ConnectionError, TimeoutError) as e :
+      # ホワイトボードが応答しなくても診察は続ける
+      logger.warning(f'whiteboard send failed. {type(e).__name__}: {e}')
+      return None
+
+  def _url_of(self, reservation_id) :
+    return f"https://{self._url}/" \
+            + f"?reservation_id={reservation_id}" \
+            + f"&mode={self._mode}"
 
   def open(self, reservation_id) :
     command = {
       _CMD_KEY_WHITEBOARD : {
         _CMD_KEY_OPERATION : _OPERATION_OPEN,
-        _CMD_KEY_URL : f"https://{self._url}/"
-                      + f"?reservation_id={reservation_id}"
-                      + f"&mode={self._mode}"
+        _CMD_KEY_URL : self._url_of(reservation_id)
       }
     }
     logger.info(f"Whiteboard open {command}")
     self._send(command)
     logger.info(f"Whiteboard opened")
 
+  @property
+  def preload_supported(self) -> bool :
+    """ preload を送るか (応答で確認できなかった場合は PRELOAD_RETRY_INTERVAL 秒の間は送らない) """
+    rejected = self._preload_rejected_time
+    return rejected is None or PRELOAD_RETRY_INTERVAL <= time.monotonic() - rejected
+
+  def preload(self, reservation_id) -> bool :
+    """ ホワイトボードのページを表示せずに読み込ませる。
+    open()で読み込み済みのページが表示される。
+
+    preload に対応したホワイトボードは {"whiteboard": {"operation": "preload", ...}} を
+    応答する。その応答を確認できた場合だけ True を返す。確認できなかった場合
+    (preload に対応していない古いホワイトボード等) は、しばらく preload を送らない。
+    対応していない操作で接続先の失敗を数えないよう、サーキットブレーカーは通さない。
+    """
+    if not self.preload_supported :
+      return False
+    command = {
+      _CMD_KEY_WHITEBOARD : {
+        _CMD_KEY_OPERATION : _OPERATION_PRELOAD,
+        _CMD_KEY_URL : self._url_of(reservation_id)
+      }
+    }
+    logger.info(f"Whiteboard preload {command}")
+    response = None
+    try :
+      with resilience.deadline(WHITEBOARD_TIMEOUT) :
+        response = self._request(json.dumps(command))
+    except (ConnectionError, TimeoutError) as e :
+      logger.warning(f'whiteboard preload failed. {type(e).__name__}: {e}')
+    if _acknowledged(response, _CMD_KEY_WHITEBOARD, _OPERATION_PRELOAD) :
+      self._preload_rejected_time = None
+      logger.info(f"Whiteboard preloaded")
+      return True
+    self._preload_rejected_time = time.monotonic()
+    logger.warning(
+        f"Whiteboard did not acknowledge preload. skip preload for {PRELOAD_RETRY_INTERVAL}s. response:{response!r}")
+    return False
+
   def close(self) :
     command = {
       _CMD_KEY_WHITEBOARD : {
@@ -114,6 +180,16 @@ class Whiteboard(object) :
 
 
 
+def _acknowledged(response, key, operation) -> bool :
+  """ 応答が key の operation を受け付けたことを示しているか """
+  try :
+    result = json.loads(response)
+  except (TypeError, ValueError) :
+    return False
+  return isinstance(result, dict) and isinstance(result.get(key), dict) \
+      and result[key].get(_CMD_KEY_OPERATION) == operation
+
+
 def open( address, port, reservation_id
           , *
           , url=ONLINEMED_WHITEBOARD_URL, mode=ONLINEMED_WHITEBOARD_MODE) :
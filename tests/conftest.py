@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+# setup.py の package_dir と同じく、cube 直下のモジュール (configs, utils 等) も import できるようにする
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(_ROOT, 'cube'), _ROOT) :
+  if path not in sys.path :
+    sys.path.insert(0, path)
+
+from cube import clocks  # noqa: E402 (sys.path を設定してから import する)
+
+
+@pytest.fixture
+def clock() :
+  """ テストの間 clocks.get() を仮想時計にする """
+  clock = clocks.VirtualClock()
+  with clocks.using(clock) :
+    yield clock
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+""" BrowserPool の貸し出し・返却と、異常なブラウザの入れ替え """
+import threading
+import time
+
+import pytest
+
+from cube import browser
+
+
+class FakeBrowser(object) :
+  """ WebDriver を使わずに呼び出しを記録するブラウザ """
+
+  def __init__(self, number) :
+    self.number = number
+    self.calls = []
+    self.alive = True
+    # set されるまで is_alive() / close() が戻らない (ハング)
+    self.responding = threading.Event()
+    self.responding.set()
+    self.closing = threading.Event()
+    self.closing.set()
+    self.closed = threading.Event()
+
+  def is_alive(self) :
+    self.responding.wait()
+    return self.alive
+
+  def get(self, url) :
+    self.calls.append(('get', url))
+
+  def hide(self) :
+    self.calls.append(('hide',))
+
+  def show(self) :
+    self.calls.append(('show',))
+
+  def reset(self, url=None) :
+    self.calls.append(('reset', url))
+
+  def close(self) :
+    self.closing.wait()
+    self.closed.set()
+
+
+@pytest.fixture
+def pool() :
+  pool = browser.BrowserPool(1, health_interval=0, probe_timeout=0.2)
+  created = []
+  spawned = threading.Condition()
+
+  def create() :
+    with spawned :
+      wb = FakeBrowser(len(created))
+      created.append(wb)
+      spawned.notify_all()
+      return wb
+
+  pool._create = create
+  pool.created = created
+  pool.start()
+  assert pool.wait_ready(5.0)
+  try :
+    yield pool
+  finally :
+    for wb in created :
+      wb.responding.set()
+      wb.closing.set()
+    pool.close()
+
+
+def wait_until(predicate, timeout=5.0) :
+  deadline = time.monotonic() + timeout
+  while not predicate() :
+    assert time.monotonic() < deadline, 'condition was not met.'
+    time.sleep(0.01)
+
+
+def test_acquire_and_release_reuses_browser(pool) :
+  wb = pool.acquire('https://example.com/', timeout=5.0, hidden=True)
+  assert wb is pool.created[0]
+  assert wb.calls == [('hide',), ('get', 'https://example.com/')]
+
+  pool.release(wb)
+  assert wb.calls[-2:] == [('reset', browser.BLANK_PAGE.as_uri()), ('show',)]
+  assert pool.acquire(timeout=5.0) is wb
+  assert len(pool.created) == 1
+
+
+def test_discard_respawns_after_quit(pool) :
+  """ 代わりのブラウザは、破棄したブラウザが終了してから起動する """
+  wb = pool.acquire(timeout=5.0)
+  wb.closing.clear()
+  pool.discard(wb)
+  time.sleep(0.1)
+  assert len(pool.created) == 1
+
+  wb.closing.set()
+  assert pool.wait_ready(5.0)
+  assert wb.closed.is_set()
+  assert pool.acquire(timeout=5.0) is pool.created[1]
+
+
+def test_discard_respawns_when_quit_hangs(pool) :
+  """ 終了処理が probe_timeout 秒以内に戻らなければ、待たずに起動する """
+  wb = pool.acquire(timeout=5.0)
+  wb.closing.clear()
+  pool.discard(wb)
+  wait_until(lambda : len(pool.created) == 2)
+  assert not wb.closed.is_set()
+
+
+def test_probe_restarts_dead_idle_browser(pool) :
+  pool.created[0].alive = False
+  pool.probe()
+  wait_until(lambda : len(pool.created) == 2)
+  assert pool.created[0].closed.is_set()
+
+
+def test_hung_browser_in_use_is_discarded_on_release(pool) :
+  """ 使用中にハングしたブラウザは返却時に操作せず破棄する """
+  hung = browser.page_load_stats.to_dict()['health']['hung']
+  wb = pool.acquire(timeout=5.0)
+  wb.responding.clear()
+  pool.probe()
+  # 前回の問い合わせが戻っていなければ、重ねて問い合わせない
+  pool.probe()
+
+  pool.release(wb)
+  assert not any(call[0] == 'reset' for call in wb.calls)
+  wait_until(lambda : len(pool.created) == 2)
+  assert browser.page_load_stats.to_dict()['health']['hung'] == hung + 2
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+""" 常駐させた cec-client (cecclient.Session) の電源状態のキャッシュとコマンド """
+import os
+import stat
+import sys
+import textwrap
+import time
+
+import pytest
+
+from cube import cecclient
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='the fake cec-client is a shebang script.')
+
+# cec-client の代わりに、受け取ったコマンドを記録して決まった出力を返す
+_FAKE_CEC_CLIENT = textwrap.dedent('''\
+    import os
+    import sys
+
+    power = 'standby'
+    with open(os.environ['FAKE_CEC_LOG'], 'a') as log :
+      for line in sys.stdin :
+        command = line.strip()
+        log.write(command + '\\n')
+        log.flush()
+        if command == 'q' :
+          break
+        if command == 'exit' :
+          sys.exit(1)
+        if command.startswith('pow') :
+          print(f'power status: {power}', flush=True)
+        elif command.startswith('on') :
+          power = 'on'
+          print('TRAFFIC: [   100]\\t>> 10:04', flush=True)
+          print('TRAFFIC: [   200]\\t>> 01:90:00', flush=True)
+        elif command.startswith('standby') :
+          power = 'standby'
+          print('TRAFFIC: [   300]\\t>> 1f:36', flush=True)
+    ''')
+
+
+def wait_until(predicate, timeout=5.0) :
+  deadline = time.monotonic() + timeout
+  while not predicate() :
+    assert time.monotonic() < deadline, 'condition was not met.'
+    time.sleep(0.01)
+
+
+@pytest.fixture
+def commands(tmp_path, monkeypatch) :
+  """ PATH の先頭に偽の cec-client を置き、送られたコマンドの一覧を返す関数を渡す """
+  script = tmp_path / 'cec-client'
+  script.write_text(f'#!{sys.executable}\n' + _FAKE_CEC_CLIENT)
+  script.chmod(script.stat().st_mode | stat.S_IXUSR)
+  log = tmp_path / 'commands.log'
+  log.touch()
+  monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+  monkeypatch.setenv('FAKE_CEC_LOG', str(log))
+  return lambda : log.read_text().split()
+
+
+@pytest.fixture
+def session(commands) :
+  session = cecclient.Session(cache_ttl=30.0)
+  assert session.start(10.0)
+  try :
+    yield session
+  finally :
+    session.stop()
+
+
+def test_start_reads_power_status(session, commands) :
+  assert session.is_alive()
+  assert session.power == 'standby'
+  assert commands() == ['pow', '0']
+
+
+def test_power_status_uses_cache(session, commands) :
+  assert session.power_status() is False
+  assert session.power_status() is False
+  # 起動時の問い合わせの結果を使い、改めて問い合わせない
+  assert commands().count('pow') == 1
+
+
+def test_power_status_queries_after_cache_expired(commands) :
+  with cecclient.Session(cache_ttl=0.0) as session :
+    assert session.power_status() is False
+  assert commands().count('pow') == 2
+
+
+def test_on_updates_power_from_traffic(session) :
+  assert session.on()
+  wait_until(lambda : session.power == 'on')
+  assert session.power_status() is True
+
+  assert session.standby()
+  wait_until(lambda : session.power == 'standby')
+  assert session.power_status() is False
+
+
+def test_parse_traffic() :
+  session = cecclient.Session()
+  session._parse('TRAFFIC: [ 1]\t>> 01:90:00')
+  assert session.power == 'on'
+  session._parse('TRAFFIC: [ 2]\t>> 0f:36')
+  assert session.power == 'standby'
+  session._parse('TRAFFIC: [ 3]\t>> 10:04')
+  assert session.power == 'in transition standby to on'
+  # TV 以外からの応答は無視する
+  session._parse('TRAFFIC: [ 4]\t>> 41:90:01')
+  assert session.power == 'in transition standby to on'
+
+
+def test_exit_fails_waiting_commands(session) :
+  """ cec-client が終了したら、応答を待っているコマンドを失敗させる """
+  session._run(session._command('exit'), 5.0)
+  with pytest.raises(ConnectionError) :
+    session._run(session._command('pow 0', 'power status:', 5.0), 5.0)
+  wait_until(lambda : not session.is_alive() and session.power is None)
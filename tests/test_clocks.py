@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+""" VirtualClock で時間のかかる動作を実時間を待たずに確認する """
+import threading
+import time
+
+import pytest
+
+from cube import clocks
+from cube import door_control
+from cube import resilience
+
+# シナリオ1つにかけてよい実時間 (秒)
+REAL_TIMEOUT = 10.0
+
+
+def run_scenario(clock: clocks.VirtualClock, function, waiters: int) :
+  """ function() を別のスレッドで実行し、終わるまで仮想時計を進める。
+
+  waiters (シナリオのスレッドと、動作中のスレッドの数) が待機に入るのを待ってから、
+  次に待機が終わる時刻まで進める。function() の戻り値と、かかった実時間を返す。
+  """
+  result = {}
+
+  def target() :
+    try :
+      result['value'] = function()
+    except BaseException as e :
+      result['error'] = e
+
+  started = time.monotonic()
+  thread = threading.Thread(target=target, name='scenario', daemon=True)
+  thread.start()
+  while thread.is_alive() :
+    assert time.monotonic() - started < REAL_TIMEOUT, 'scenario did not finish.'
+    if clock.idle(waiters, 0.01) :
+      clock.step()
+  elapsed = time.monotonic() - started
+  if 'error' in result :
+    raise result['error']
+  return result['value'], elapsed
+
+
+@pytest.fixture
+def relay(monkeypatch) :
+  """ リレーへの要求 (解錠・施錠) を記録する """
+  calls = []
+
+  def door_lock(*args) :
+    calls.append('lock')
+    return 'ok'
+
+  def door_unlock(*args) :
+    calls.append('unlock')
+    return 'ok'
+
+  monkeypatch.setattr(door_control.client, 'door_lock', door_lock)
+  monkeypatch.setattr(door_control.client, 'door_unlock', door_unlock)
+  door_control.RELAY.reset()
+  return calls
+
+
+@pytest.fixture
+def door(monkeypatch) :
+  """ ドアの開閉 (仮想時計の時刻 [開いた時刻, 閉じた時刻) の間だけ開いている) """
+  state = {'opened': None, 'closed': None}
+
+  def is_open() :
+    now = clocks.get().monotonic()
+    opened, closed = state['opened'], state['closed']
+    return opened is not None and opened <= now and (closed is None or now < closed)
+
+  monkeypatch.setattr(door_control, 'is_open', is_open)
+  return state
+
+
+@pytest.fixture
+def controller(clock, relay, door) :
+  door_control.Controller._instance = None
+  controller = door_control.create_controller(180.0, clock=clock)
+  try :
+    yield controller
+  finally :
+    controller.stop()
+    clock.advance(1.0)
+    controller.join()
+    door_control.Controller._instance = None
+
+
+def test_virtual_clock_sleep_and_timer() :
+  clock = clocks.VirtualClock(auto_advance=True)
+  fired = []
+  clock.call_later(30.0, fired.append, 'timer')
+  clock.sleep(60.0)
+  assert clock.monotonic() == 60.0
+  assert fired == ['timer']
+  assert not clock.wait(threading.Event(), 5.0)
+  assert clock.monotonic() == 65.0
+
+
+def test_deadline_uses_installed_clock(clock) :
+  with resilience.deadline(300.0) :
+    clock.advance(180.0)
+    assert resilience.remaining() == pytest.approx(120.0)
+    clock.advance(120.0)
+    with pytest.raises(resilience.DeadlineExceeded) :
+      resilience.check('scenario')
+
+
+def test_door_open_timeout(clock, controller, relay) :
+  """ ドアが開かないまま 180 秒経つと施錠して OpenTimeoutException """
+
+  def scenario() :
+    controller.disengage_lock()
+    controller.wait_for_open()
+
+  with pytest.raises(door_control.OpenTimeoutException) :
+    run_scenario(clock, scenario, waiters=2)
+  assert 180.0 < clock.monotonic() < 180.0 + 2 * door_control.DISTANCE_INTERVAL
+  assert relay == ['unlock', 'lock']
+
+
+def test_door_locks_after_close(clock, controller, relay, door) :
+  """ 開いてから閉じると DOOR_TIME_TO_LOCK_FROM_CLOSING 秒後に施錠する """
+  door['opened'] = 5.0
+  door['closed'] = 20.0
+
+  def scenario() :
+    controller.disengage_lock()
+    controller.wait_for_open()
+    opened = clock.monotonic()
+    controller.wait_for_close()
+    return opened, clock.monotonic()
+
+  (opened, closed), elapsed = run_scenario(clock, scenario, waiters=2)
+  interval = door_control.DISTANCE_INTERVAL
+  assert opened == pytest.approx(5.0, abs=2 * interval)
+  assert closed == pytest.approx(20.0 + door_control.DOOR_TIME_TO_LOCK_FROM_CLOSING, abs=3 * interval)
+  assert not controller.is_timeout()
+  assert relay == ['unlock', 'lock']
+  assert elapsed < REAL_TIMEOUT
+
+
+class TestCube :
+  """ 診察の一連の待機を仮想時計で進める """
+
+  @pytest.fixture
+  def medcube(self, monkeypatch, controller) :
+    from cube import medcube
+    monkeypatch.setattr(medcube, 'MODEL', medcube.MODEL_CUBE)
+    monkeypatch.setattr(medcube, 'LIGHT_WITH', False)
+    monkeypatch.setattr(medcube, 'TV_CONTROL', False)
+    # ホワイトボードへは接続しない
+    monkeypatch.setattr(medcube.Whiteboard, '_send', lambda self, command : None)
+    return medcube
+
+  @pytest.fixture
+  def cube(self, medcube, clock) :
+    medcube.Cube._instance = None
+    cube = medcube.Cube(clock=clock, bus=medcube.events.EventBus())
+    try :
+      yield cube
+    finally :
+      cube.stop()
+      medcube.Cube._instance = None
+
+  def session(self, reservation_id) :
+    from cube import onlinemed
+    return onlinemed.Session(None, '0123456789abcdef', reservation_id)
+
+  def test_open_times_out_when_door_is_not_opened(self, medcube, cube, clock, relay) :
+    """ 患者が来なければ UNLOCK_TIMEOUT 後に施錠し、診察を開始しない """
+
+    def scenario() :
+      with resilience.deadline(medcube.CUBE_OPEN_DEADLINE) :
+        with pytest.raises(door_control.OpenTimeoutException) :
+          cube.open(self.session(1))
+        return resilience.remaining()
+
+    left, elapsed = run_scenario(clock, scenario, waiters=2)
+    assert 180.0 < clock.monotonic() < 181.0
+    assert left == pytest.approx(medcube.CUBE_OPEN_DEADLINE - clock.monotonic())
+    assert cube.reservation_id is None
+    assert cube.open_time is None
+    assert relay == ['unlock', 'lock']
+    assert elapsed < REAL_TIMEOUT
+
+  def test_continuous_open_waits_for_doctor(self, monkeypatch, medcube, cube, clock) :
+    """ ドアのない機種は開始してすぐに医者の準備を待ち、その時間を仮想時間で進める """
+    monkeypatch.setattr(medcube, 'MODEL', medcube.MODEL_PANEL)
+
+    def scenario() :
+      cube.open(self.session(2), 'continueus')
+      opened = clock.time()
+      ready = cube.wait_for_doctor_ready(600.0)
+      return opened, ready
+
+    (opened, ready), elapsed = run_scenario(clock, scenario, waiters=1)
+    assert cube.reservation_id == 2
+    assert cube.open_time == opened
+    assert not ready
+    assert clock.monotonic() == pytest.approx(600.0)
+    assert elapsed < REAL_TIMEOUT
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+""" events.EventBus の購読ごとの配送と、キューが一杯の場合の動作 """
+import threading
+import time
+
+import pytest
+
+from cube import events
+
+
+class Numbered(events.Event) :
+  __slots__ = ('number',)
+
+  def __init__(self, number) :
+    self.number = number
+
+
+class Other(events.Event) :
+  __slots__ = ()
+
+
+class SlowHandler(object) :
+  """ release されるまで最初のイベントの処理を終えないハンドラ """
+
+  def __init__(self) :
+    self.numbers = []
+    self.started = threading.Event()
+    self.release = threading.Event()
+
+  def __call__(self, event) :
+    self.started.set()
+    assert self.release.wait(5.0)
+    self.numbers.append(event.number)
+
+
+@pytest.fixture
+def bus() :
+  bus = events.EventBus()
+  try :
+    yield bus
+  finally :
+    bus.clear()
+
+
+@pytest.fixture
+def handler() :
+  handler = SlowHandler()
+  try :
+    yield handler
+  finally :
+    handler.release.set()
+
+
+def wait_until(predicate, timeout=5.0) :
+  deadline = time.monotonic() + timeout
+  while not predicate() :
+    assert time.monotonic() < deadline, 'condition was not met.'
+    time.sleep(0.01)
+
+
+def fill(bus, handler, count) :
+  """ 1件目を処理中にしてから、続けて count 件発行する。キューに入れた数を返す """
+  assert bus.publish(Numbered(0))
+  assert handler.started.wait(5.0)
+  return sum(bus.publish(Numbered(number)) for number in range(1, count + 1))
+
+
+def test_drop_newest(bus, handler) :
+  subscription = bus.subscribe(Numbered, handler, name='slow', max_pending=2, overflow=events.DROP_NEWEST)
+  assert fill(bus, handler, 4) == 2
+  assert subscription.stats() == {'pending': 2, 'delivered': 0, 'dropped': 2, 'failed': 0}
+
+  handler.release.set()
+  wait_until(lambda : subscription.delivered == 3)
+  assert handler.numbers == [0, 1, 2]
+
+
+def test_drop_oldest(bus, handler) :
+  subscription = bus.subscribe(Numbered, handler, name='slow', max_pending=2, overflow=events.DROP_OLDEST)
+  assert fill(bus, handler, 4) == 4
+  assert subscription.dropped == 2
+
+  handler.release.set()
+  wait_until(lambda : subscription.delivered == 3)
+  assert handler.numbers == [0, 3, 4]
+
+
+def test_block_drops_after_timeout(bus, handler) :
+  """ BLOCK は block_timeout 秒まで発行側を待たせ、空かなければ新しいものを捨てる """
+  subscription = bus.subscribe(Numbered, handler, name='slow', max_pending=1, block_timeout=0.1)
+  assert fill(bus, handler, 1) == 1
+
+  started = time.monotonic()
+  assert bus.publish(Numbered(2)) == 0
+  assert 0.1 <= time.monotonic() - started
+  assert subscription.dropped == 1
+
+
+def test_block_waits_for_subscriber(bus, handler) :
+  """ 待っている間に空けば入れる """
+  subscription = bus.subscribe(Numbered, handler, name='slow', max_pending=1, block_timeout=5.0)
+  assert fill(bus, handler, 1) == 1
+
+  timer = threading.Timer(0.05, handler.release.set)
+  timer.start()
+  assert bus.publish(Numbered(2)) == 1
+  timer.join()
+  wait_until(lambda : subscription.delivered == 3)
+  assert handler.numbers == [0, 1, 2]
+  assert subscription.dropped == 0
+
+
+def test_slow_subscriber_does_not_delay_others(bus, handler) :
+  """ 購読ごとの専用スレッドで配送するため、他の購読は遅れない """
+  slow = bus.subscribe(Numbered, handler, name='slow', max_pending=1, overflow=events.DROP_NEWEST)
+  received = []
+  fast = bus.subscribe(events.Event, received.append, name='fast')
+
+  fill(bus, handler, 3)
+  bus.publish(Other())
+  wait_until(lambda : fast.delivered == 5)
+  assert [type(event) for event in received] == [Numbered] * 4 + [Other]
+  assert (slow.delivered, slow.dropped) == (0, 2)
+  assert set(bus.stats()) == {'slow', 'fast'}
+
+
+def test_failed_handler_continues(bus, caplog) :
+  received = []
+
+  def handler(event) :
+    if event.number == 1 :
+      raise RuntimeError('broken')
+    received.append(event.number)
+
+  subscription = bus.subscribe(Numbered, handler, name='failing')
+  for number in range(3) :
+    bus.publish(Numbered(number))
+  wait_until(lambda : subscription.delivered == 3)
+  assert received == [0, 2]
+  assert subscription.failed == 1
+  assert 'event handler failing failed.' in caplog.text
+
+
+def test_unsubscribe_discards_pending(bus, handler) :
+  subscription = bus.subscribe(Numbered, handler, name='slow', max_pending=4)
+  fill(bus, handler, 2)
+  subscription.unsubscribe()
+  assert subscription.pending == 0
+  assert bus.publish(Numbered(3)) == 0
+  handler.release.set()
+  wait_until(lambda : subscription.delivered == 1)
+  assert handler.numbers == [0]
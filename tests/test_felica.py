@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+""" felica.TapQueue の重複タッチの抑制とキューの動作 """
+import threading
+
+import pytest
+
+from cube import felica
+
+IDM_A = '0102030405060708'
+IDM_B = '1112131415161718'
+
+
+@pytest.fixture
+def taps() :
+  return []
+
+
+@pytest.fixture
+def tap_queue(taps) :
+  """ スレッドを起動していない TapQueue (put() の判定だけを確認する) """
+  return felica.TapQueue(taps.append, window=3.0, maxsize=4)
+
+
+def test_suppression_window_slides(tap_queue) :
+  """ 破棄したタッチの時刻からも数え直すため、かざし続ける間は認証しない """
+  assert tap_queue.put(IDM_A, 0.0)
+  assert not tap_queue.put(IDM_A, 2.0)
+  assert not tap_queue.put(IDM_A, 4.0)
+  assert not tap_queue.put(IDM_A, 6.5)
+  # 最後に検出してから window 秒経った
+  assert tap_queue.put(IDM_A, 9.5)
+  assert tap_queue.stats()['received'] == 5
+  assert tap_queue.suppressed == 3
+
+
+def test_other_cards_are_not_suppressed(tap_queue) :
+  assert tap_queue.put(IDM_A, 0.0)
+  assert tap_queue.put(IDM_B, 1.0)
+  assert not tap_queue.put(IDM_B, 2.0)
+  assert not tap_queue.put(IDM_A, 2.5)
+
+
+def test_expired_records_are_dropped(tap_queue) :
+  tap_queue.put(IDM_A, 0.0)
+  tap_queue.put(IDM_B, 10.0)
+  assert list(tap_queue._seen) == [IDM_B]
+
+
+def test_forget_accepts_next_tap(tap_queue) :
+  assert tap_queue.put(IDM_A, 0.0)
+  tap_queue.forget(IDM_A)
+  assert tap_queue.put(IDM_A, 1.0)
+
+
+def test_overflow_drops_taps(tap_queue) :
+  for i in range(4) :
+    assert tap_queue.put(f'{i:016x}', 0.0)
+  assert not tap_queue.put(IDM_A, 0.0)
+  assert tap_queue.overflowed == 1
+  assert tap_queue.stats()['queued'] == 4
+
+
+def test_handler_runs_on_queue_thread(taps) :
+  handled = threading.Event()
+  threads = []
+
+  def handler(tap) :
+    threads.append(threading.current_thread())
+    taps.append(tap)
+    handled.set()
+
+  tap_queue = felica.TapQueue(handler, window=3.0, daemon=True)
+  tap_queue.start()
+  try :
+    assert tap_queue.put(IDM_A, 1.0)
+    assert handled.wait(5.0)
+  finally :
+    tap_queue.stop()
+    tap_queue.join(5.0)
+  assert threads == [tap_queue]
+  assert taps[0].idm == IDM_A and taps[0].tapped_time == 1.0
+
+  # entry を送信するまでの時間を記録する
+  assert tap_queue.record_published(IDM_A, 1.25) == pytest.approx(0.25)
+  assert tap_queue.record_published(IDM_A, 2.0) is None
+  assert tap_queue.stats()['latency_last'] == pytest.approx(0.25)
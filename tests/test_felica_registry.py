@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+""" felica.csv・スナップショットの読み込みと、登録カードの照会 """
+import os
+import time
+
+import pytest
+
+from cube import felica_registry
+from cube.felica_registry import Card, Registry
+
+IDM_A = '0102030405060708'
+IDM_B = '1112131415161718'
+
+
+def write(path, text) :
+  path.write_text(text, encoding='utf-8')
+  # 同じ秒に書き直しても変更を検出できるよう mtime を進める
+  stat = os.stat(path)
+  os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+  return path
+
+
+def test_legacy_csv_reads_idm_only(tmp_path) :
+  """ 見出し行が無い従来の形式は、2列目以降 (備考など) を読まない """
+  path = write(tmp_path / 'felica.csv', f'{IDM_A},Yamada,2020-01-01\n# comment\n\n{IDM_B}\n')
+  cards = felica_registry.load_csv(path)
+  assert cards == {IDM_A : Card(IDM_A), IDM_B : Card(IDM_B)}
+
+
+def test_csv_with_header(tmp_path) :
+  path = write(tmp_path / 'felica.csv',
+               'idm,room,expiry,mode\n'
+               '01:02:03:04:05:06:07:08,room1,2030-01-01T09:00:00,\n'
+               f'{IDM_B},,,single\n')
+  cards = felica_registry.load_csv(path)
+  assert cards[IDM_A].room == 'room1'
+  assert cards[IDM_A].mode == felica_registry.DEFAULT_MODE
+  assert cards[IDM_A].expiry == pytest.approx(
+      time.mktime((2030, 1, 1, 9, 0, 0, 0, 0, -1)))
+  assert cards[IDM_B] == Card(IDM_B, 'single')
+
+
+def test_invalid_row_falls_back_to_idm(tmp_path, caplog) :
+  path = write(tmp_path / 'felica.csv', f'idm,mode,expiry\n{IDM_A},single,not a date\n')
+  cards = felica_registry.load_csv(path)
+  assert cards == {IDM_A : Card(IDM_A)}
+  assert 'use idm only' in caplog.text
+
+
+def test_snapshot_round_trip(tmp_path) :
+  cards = [Card(IDM_A, 'single', 1900000000.0, 'room1'), Card(IDM_B, None)]
+  path = tmp_path / 'felica.bin'
+  felica_registry.save_snapshot(cards, path)
+  assert felica_registry.load(path) == {card.idm : card for card in cards}
+
+
+def test_registry_lookup(tmp_path) :
+  path = write(tmp_path / 'felica.csv',
+               'idm,mode,expiry,room\n'
+               f'{IDM_A},single,,room1\n'
+               f'{IDM_B},,2000-01-01,\n')
+  registry = Registry(str(path))
+  assert registry.mode_of(IDM_A.lower(), room='room1') == 'single'
+  # 他のブースでは使えない
+  assert registry.lookup(IDM_A, room='room2') is None
+  # 期限切れ
+  assert IDM_B not in registry
+  assert registry.mode_of('ffffffffffffffff', default='none') == 'none'
+
+
+def test_registry_reloads_changed_file(tmp_path) :
+  path = write(tmp_path / 'felica.csv', f'{IDM_A}\n')
+  registry = Registry(str(path), check_interval=60.0)
+  assert len(registry) == 1
+
+  write(path, f'{IDM_A}\n{IDM_B}\n')
+  # check_interval の間はファイルを確認しない
+  assert IDM_B not in registry
+  registry.invalidate()
+  assert IDM_B in registry
+
+  os.remove(path)
+  assert registry.reload()
+  assert len(registry) == 0
+
+
+def test_registry_keeps_cards_when_load_fails(tmp_path, monkeypatch) :
+  path = write(tmp_path / 'felica.csv', f'{IDM_A}\n')
+  registry = Registry(str(path))
+  assert registry.reload()
+
+  def broken(path) :
+    raise OSError('busy')
+
+  monkeypatch.setattr(felica_registry, 'load', broken)
+  write(path, f'{IDM_B}\n')
+  assert not registry.reload()
+  assert registry.lookup(IDM_A) is not None
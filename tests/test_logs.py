@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+""" logs.QueueHandler の書き込みスレッドと、セッションごとのログの抽出 """
+import logging
+import time
+
+import pytest
+
+from cube import logs
+
+
+class ListHandler(logging.Handler) :
+  """ 受け取ったログを記録する """
+
+  def __init__(self) :
+    super().__init__()
+    self.records = []
+
+  def emit(self, record) :
+    self.records.append(record)
+
+
+def wait_compressed(handler, timeout=5.0) :
+  """ ローテートしたファイルの圧縮が終わるのを待つ """
+  deadline = time.monotonic() + timeout
+  while handler._maintainer is not None :
+    assert time.monotonic() < deadline, 'compression did not finish.'
+    time.sleep(0.01)
+
+
+@pytest.fixture
+def logger() :
+  logger = logging.getLogger('tests.logs')
+  logger.propagate = False
+  logger.setLevel(logging.DEBUG)
+  try :
+    yield logger
+  finally :
+    for handler in list(logger.handlers) :
+      logger.removeHandler(handler)
+      handler.close()
+    logs.end_session()
+
+
+def test_queue_handler_writes_on_listener_thread(logger) :
+  target = ListHandler()
+  handler = logs.QueueHandler([target])
+  logger.addHandler(handler)
+
+  values = ['before']
+  logger.info('value %s', values)
+  # 書き込むまでに変更されても、出力した時点の内容で書き込む
+  values.append('after')
+  logger.warning('done %d', 1)
+  handler.flush()
+
+  assert [record.getMessage() for record in target.records] == ["value ['before']", 'done 1']
+  assert handler.stats()['written'] == 2
+  assert handler.stats()['dropped'] == 0
+
+
+def test_queue_handler_drops_when_full() :
+  handler = logs.QueueHandler([ListHandler()], maxsize=1, block_timeout=0.01)
+  try :
+    # 書き込むスレッドを開始せずにキューを一杯にする
+    handler.enqueue(logging.makeLogRecord({'levelno': logging.INFO, 'msg': 'first'}))
+    handler.enqueue(logging.makeLogRecord({'levelno': logging.INFO, 'msg': 'info'}))
+    handler.enqueue(logging.makeLogRecord({'levelno': logging.ERROR, 'msg': 'error'}))
+    assert handler.stats() == {'enqueued': 1, 'written': 0, 'dropped': 2, 'queued': 1, 'max_queued': 1}
+  finally :
+    handler.close()
+
+
+def test_queue_handler_resolves_handler_names(logger) :
+  """ dictConfig で名前を付けたハンドラは、最初にログを受け取ったときに解決する """
+  handler = logs.QueueHandler(['tests.logs.memory'])
+  logger.addHandler(handler)
+  with pytest.raises(ValueError) :
+    handler.targets
+
+  target = ListHandler()
+  target.set_name('tests.logs.memory')
+  try :
+    logger.info('resolved')
+    handler.flush()
+    assert handler.targets == [target]
+    assert [record.getMessage() for record in target.records] == ['resolved']
+  finally :
+    target.close()
+
+
+def test_extract_session_logs(logger, tmp_path) :
+  """ 予約IDで、認証中のログも含めて1回の診察分のログだけを抽出する """
+  path = str(tmp_path / 'cube.log')
+  handler = logs.IndexedFileHandler(path, when='D', compress=True)
+  handler.setFormatter(logging.Formatter('%(message)s'))
+  logger.addHandler(handler)
+
+  logger.info('idle')
+  logs.begin_session(idm='0102030405060708', phase='auth')
+  logger.info('first tap')
+  logs.update_session(reservation_id=100, phase='open')
+  logger.info('first open')
+  logs.end_session()
+  logs.begin_session(idm='1112131415161718', reservation_id=200, phase='open')
+  logger.info('second open')
+  # ローテートして圧縮したファイルからも抽出できる
+  handler.doRollover()
+  logs.update_session(phase='close')
+  logger.info('second close')
+  handler.close()
+  logger.removeHandler(handler)
+  wait_compressed(handler)
+
+  assert logs.extract(path, reservation_id=100) == b'first tap\nfirst open\n'
+  assert logs.extract(path, reservation_id=200) == b'second open\nsecond close\n'
+  assert logs.extract(path, reservation_id=200, phase='close') == b'second close\n'
+  assert logs.extract(path, idm='0102030405060708') == b'first tap\nfirst open\n'
+
+  sessions = logs.find_sessions(path)
+  assert [session['reservation_id'] for session in sessions] == [100, 200]
+  assert sessions[1]['phases'] == ['open', 'close']
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+""" resilience.CircuitBreaker の開閉と、呼び出しの期限 """
+import threading
+
+import pytest
+
+from cube import resilience
+
+
+class Endpoint(object) :
+  """ 呼び出し先 (failing の間は失敗する) """
+
+  def __init__(self) :
+    self.calls = 0
+    self.failing = False
+
+  def __call__(self) :
+    self.calls += 1
+    if self.failing :
+      raise ConnectionError('refused')
+    return 'ok'
+
+
+@pytest.fixture
+def endpoint() :
+  return Endpoint()
+
+
+@pytest.fixture
+def breaker(clock) :
+  return resilience.CircuitBreaker('tests', failure_threshold=2, reset_timeout=30.0, clock=clock)
+
+
+def test_opens_after_consecutive_failures(breaker, endpoint) :
+  endpoint.failing = True
+  for _ in range(2) :
+    with pytest.raises(ConnectionError) :
+      breaker.call(endpoint)
+  assert breaker.state == resilience.STATE_OPEN
+
+  # 開いている間は呼び出さない
+  with pytest.raises(resilience.CircuitOpenError) :
+    breaker.call(endpoint)
+  assert endpoint.calls == 2
+  stats = breaker.stats()
+  assert (stats['failed'], stats['rejected'], stats['opened']) == (2, 1, 1)
+  assert 'ConnectionError: refused' in breaker.last_error
+
+
+def test_success_resets_failure_count(breaker, endpoint) :
+  endpoint.failing = True
+  with pytest.raises(ConnectionError) :
+    breaker.call(endpoint)
+  endpoint.failing = False
+  assert breaker.call(endpoint) == 'ok'
+  endpoint.failing = True
+  with pytest.raises(ConnectionError) :
+    breaker.call(endpoint)
+  assert breaker.state == resilience.STATE_CLOSED
+
+
+def test_half_open_probe_closes(breaker, endpoint, clock) :
+  endpoint.failing = True
+  for _ in range(2) :
+    with pytest.raises(ConnectionError) :
+      breaker.call(endpoint)
+
+  clock.advance(29.0)
+  assert breaker.state == resilience.STATE_OPEN
+  clock.advance(1.0)
+  assert breaker.state == resilience.STATE_HALF_OPEN
+
+  endpoint.failing = False
+  assert breaker.call(endpoint) == 'ok'
+  assert breaker.state == resilience.STATE_CLOSED
+
+
+def test_failed_probe_reopens(breaker, endpoint, clock) :
+  endpoint.failing = True
+  for _ in range(2) :
+    with pytest.raises(ConnectionError) :
+      breaker.call(endpoint)
+  clock.advance(30.0)
+
+  # 試しの1回が失敗すれば、続けて失敗した回数によらずすぐに開く
+  with pytest.raises(ConnectionError) :
+    breaker.call(endpoint)
+  assert breaker.state == resilience.STATE_OPEN
+  assert breaker.stats()['opened'] == 2
+  clock.advance(10.0)
+  with pytest.raises(resilience.CircuitOpenError) :
+    breaker.call(endpoint)
+
+
+def test_only_one_probe_while_half_open(breaker, clock) :
+  endpoint = Endpoint()
+  endpoint.failing = True
+  for _ in range(2) :
+    with pytest.raises(ConnectionError) :
+      breaker.call(endpoint)
+  clock.advance(30.0)
+
+  probing = threading.Event()
+  finish = threading.Event()
+
+  def probe() :
+    probing.set()
+    assert finish.wait(5.0)
+    return 'ok'
+
+  thread = threading.Thread(target=breaker.call, args=(probe,), daemon=True)
+  thread.start()
+  try :
+    assert probing.wait(5.0)
+    # 試しの呼び出しが終わるまでは、他の呼び出しは拒否する
+    with pytest.raises(resilience.CircuitOpenError) :
+      breaker.call(endpoint)
+  finally :
+    finish.set()
+    thread.join(5.0)
+  assert breaker.state == resilience.STATE_CLOSED
+
+
+def test_expired_deadline_is_not_a_failure(breaker, endpoint, clock) :
+  with resilience.deadline(1.0) :
+    clock.advance(1.0)
+    with pytest.raises(resilience.DeadlineExceeded) :
+      breaker.call(endpoint)
+  assert endpoint.calls == 0
+  assert breaker.stats()['failed'] == 0
+
+
+def test_isolated_call_times_out(clock) :
+  """ isolate=True の呼び出しは、戻らなくても timeout 秒 (実時間) で諦める """
+  breaker = resilience.CircuitBreaker('tests-isolated', timeout=0.05, failure_threshold=1, isolate=True, clock=clock)
+  release = threading.Event()
+  try :
+    with pytest.raises(resilience.DeadlineExceeded) :
+      breaker.call(release.wait, 5.0)
+  finally :
+    release.set()
+  stats = breaker.stats()
+  assert stats['timeouts'] == 1
+  assert stats['open']
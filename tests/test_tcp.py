@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+""" tcp.Server のメッセージの区切り方と接続の維持・切断 """
+import socket
+import threading
+import time
+
+import pytest
+
+from cube import tcp
+
+
+def free_port() -> int :
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock :
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+
+@pytest.fixture
+def serve() :
+  """ serve(target, **kwargs) でサーバを起動し、待ち受けているポートを返す """
+  servers = []
+
+  def start(target, **kwargs) :
+    port = free_port()
+    server = tcp.Server('127.0.0.1', port, target=target, daemon=True, **kwargs)
+    server.start()
+    deadline = time.monotonic() + 5.0
+    while not server.is_listen() :
+      assert time.monotonic() < deadline, 'server did not listen.'
+      time.sleep(0.01)
+    servers.append(server)
+    return server, port
+
+  yield start
+  for server in servers :
+    server.stop()
+    server.join(5.0)
+
+
+def echo(sock, address, message) :
+  sock.sendall(message.upper())
+
+
+def echo_frame(sock, address, message) :
+  tcp.send_frame(sock, message.upper())
+
+
+def test_none_framing_closes_after_handler(serve) :
+  """ FRAMING_NONE は従来どおり応答した後に接続を閉じる """
+  server, port = serve(echo)
+  with socket.create_connection(('127.0.0.1', port), timeout=5.0) as sock :
+    sock.sendall(b'ping')
+    assert sock.recv(1024) == b'PING'
+    assert sock.recv(1024) == b''
+  assert tcp.Client('127.0.0.1', port, timeout=5.0).send('abc') == 'ABC'
+
+
+def test_length_framing_keeps_connection(serve) :
+  """ FRAMING_LENGTH は分割して届いたメッセージを組み立て、同じ接続で続けて受け付ける """
+  server, port = serve(echo_frame, framing=tcp.FRAMING_LENGTH)
+  with socket.create_connection(('127.0.0.1', port), timeout=5.0) as sock :
+    data = b'first'
+    frame = tcp._HEADER.pack(len(data)) + data
+    sock.sendall(frame[:3])
+    time.sleep(0.05)
+    sock.sendall(frame[3:])
+    assert tcp.recv_frame(sock) == b'FIRST'
+
+    # 2つのメッセージを一度に送っても1つずつ処理する
+    sock.sendall(tcp._HEADER.pack(1) + b'a' + tcp._HEADER.pack(1) + b'b')
+    assert tcp.recv_frame(sock) == b'A'
+    assert tcp.recv_frame(sock) == b'B'
+  assert server.accepted == 1
+
+
+def test_keep_alive_can_be_disabled(serve) :
+  server, port = serve(echo_frame, framing=tcp.FRAMING_LENGTH, keep_alive=False)
+  with socket.create_connection(('127.0.0.1', port), timeout=5.0) as sock :
+    tcp.send_frame(sock, b'once')
+    assert tcp.recv_frame(sock) == b'ONCE'
+    assert tcp.recv_frame(sock) is None
+
+
+def test_idle_connection_is_closed(serve) :
+  """ idle_timeout 秒メッセージが無い接続は閉じる """
+  server, port = serve(echo_frame, framing=tcp.FRAMING_LENGTH, idle_timeout=0.2)
+  with socket.create_connection(('127.0.0.1', port), timeout=5.0) as sock :
+    tcp.send_frame(sock, b'hello')
+    assert tcp.recv_frame(sock) == b'HELLO'
+    started = time.monotonic()
+    assert sock.recv(1024) == b''
+    assert time.monotonic() - started < 3.0
+  assert server.active == 0
+
+
+def test_too_large_message_is_rejected(serve) :
+  server, port = serve(echo_frame, framing=tcp.FRAMING_LENGTH, max_message=16)
+  with socket.create_connection(('127.0.0.1', port), timeout=5.0) as sock :
+    sock.sendall(tcp._HEADER.pack(1024))
+    assert sock.recv(1024) == b''
+
+
+def test_connection_closed_while_busy_returns_buffer(serve) :
+  """ ハンドラの実行中に閉じた接続も、ハンドラが戻ればバッファをプールへ戻す """
+  entered = threading.Event()
+  release = threading.Event()
+
+  def slow(sock, address, message) :
+    entered.set()
+    release.wait(5.0)
+
+  server, port = serve(slow, framing=tcp.FRAMING_LENGTH)
+  with socket.create_connection(('127.0.0.1', port), timeout=5.0) as sock :
+    tcp.send_frame(sock, b'wait')
+    assert entered.wait(5.0)
+    server.stop()
+    release.set()
+    server.join(5.0)
+  assert not server.is_alive()
+  assert len(server._buffer_pool) == 1